@@ -44,6 +44,41 @@ export default function AdminSOSAlerts() {
     selectedRadius,
   ]);
 
+  // Live feed: new and resolved alerts are pushed by the server
+  useEffect(() => {
+    if (!adminCoordinates.latitude || !adminCoordinates.longitude) {
+      return;
+    }
+
+    const params = new URLSearchParams({
+      latitude: adminCoordinates.latitude,
+      longitude: adminCoordinates.longitude,
+      radius: selectedRadius,
+    });
+    const source = new EventSource(`${BACKEND_URL}/sos/stream?${params}`);
+
+    source.addEventListener("sos", (event) => {
+      const alert = JSON.parse(event.data);
+      setSosAlerts((prevAlerts) =>
+        prevAlerts.some((item) => item.id === alert.id)
+          ? prevAlerts
+          : [alert, ...prevAlerts]
+      );
+    });
+
+    source.addEventListener("resolved", (event) => {
+      const alert = JSON.parse(event.data);
+      setSosAlerts((prevAlerts) =>
+        prevAlerts.filter((item) => item.id !== alert.id)
+      );
+    });
+
+    // The server dropped events for us; reload the full list
+    source.addEventListener("resync", () => fetchSOSAlerts());
+
+    return () => source.close();
+  }, [adminCoordinates, selectedRadius]);
+
   const fetchSOSAlerts = async () => {
     if (!backendAPIClient) {
       console.error("Backend API client is not initialized.");
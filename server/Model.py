@@ -1,9 +1,17 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Float
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Float, Index, JSON, text
 from database import Base
 
 coord = {"", ""}
 
+
+def search_document(*columns):
+    """
+    Postgres tsvector over text columns. The GIN indexes below and the queries in
+    app.utils.search must spell it the same way for the index to be used.
+    """
+    return "to_tsvector('simple', " + " || ' ' || ".join(f"coalesce({column}, '')" for column in columns) + ")"
+
+
 class Users(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, index=True)
@@ -28,13 +36,22 @@ class Shelters(Base):
     address = Column(String, nullable=False)
     pincode = Column(String, nullable=False)
     images = Column(String, nullable=True)
+    derivatives = Column(JSON, nullable=True)  # {"thumbnail": url, "webp": url}
     description = Column(String, nullable=True)
     createdAt = Column(DateTime, nullable=False)
     updatedAt = Column(DateTime, nullable=False)
-    latitude = Column(Float, nullable=False)
-    longitude = Column(Float, nullable=False)
+    latitude = Column(Float, nullable=False, index=True)
+    longitude = Column(Float, nullable=False, index=True)
     userId = Column(Integer, ForeignKey("users.id"), nullable=True)
     distance = Column(Float, nullable=True)  # Distance in km
+    capacity = Column(Integer, nullable=True)  # People it can take; unknown when null
+    occupancy = Column(Integer, nullable=True)  # People there now
+
+    __table_args__ = (
+        Index(
+            "ix_shelters_search", text(search_document("name", "description")), postgresql_using="gin"
+        ).ddl_if(dialect="postgresql"),
+    )
     
 class SOS(Base):
     __tablename__ = 'sos'
@@ -46,17 +63,24 @@ class SOS(Base):
     persons = Column(Integer, nullable=True)
     userId = Column(Integer, ForeignKey("users.id"), nullable=True)
     resolved = Column(Boolean, default=False)
+    pincode = Column(String, nullable=True)  # The sender's, for the per-pincode stats
+
+    __table_args__ = (
+        Index("ix_sos_resolved_createdAt", "resolved", "createdAt"),
+        Index("ix_sos_latitude_longitude", "latitude", "longitude"),
+    )
     
 class FoodProvidingRegions(Base):
     __tablename__ = 'food'
     id = Column(Integer, primary_key=True, index=True)
     createdAt = Column(DateTime, nullable=False)
-    latitude = Column(Float, nullable=False)
-    longitude = Column(Float, nullable=False)
+    latitude = Column(Float, nullable=False, index=True)
+    longitude = Column(Float, nullable=False, index=True)
     address = Column(String, nullable=False)
     pincode = Column(String, nullable=False)
     description = Column(String, nullable=True)
     images = Column(String, nullable=True)
+    derivatives = Column(JSON, nullable=True)  # {"thumbnail": url, "webp": url}
     userId = Column(Integer, ForeignKey("users.id"), nullable=True)
     distance = Column(Float, nullable=True) 
     
@@ -68,7 +92,51 @@ class News(Base):
     createdAt = Column(DateTime, nullable=False)
     updatedAt = Column(DateTime, nullable=False)
     images = Column(String, nullable=True)
+    derivatives = Column(JSON, nullable=True)  # {"thumbnail": url, "webp": url}
     userId = Column(Integer, ForeignKey("users.id"), nullable=True)
-    latitude = Column(Float, nullable=False)
-    longitude = Column(Float, nullable=False)
+    latitude = Column(Float, nullable=False, index=True)
+    longitude = Column(Float, nullable=False, index=True)
     distance = Column(Float, nullable=True)
+
+    __table_args__ = (
+        # The feed's time window, with the coordinates to filter inside the index
+        Index("ix_news_createdAt_latitude_longitude", "createdAt", "latitude", "longitude"),
+        Index(
+            "ix_news_search", text(search_document("title", "description")), postgresql_using="gin"
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+class PincodeStats(Base):
+    # Maintained by app.utils.pincode_stats; recomputed from the tables above on reconcile
+    __tablename__ = 'pincode_stats'
+    pincode = Column(String, primary_key=True)
+    shelters = Column(Integer, nullable=False, default=0)
+    food = Column(Integer, nullable=False, default=0)
+    sos_unresolved = Column(Integer, nullable=False, default=0)
+    persons = Column(Integer, nullable=False, default=0)  # Reported by the unresolved SOS alerts
+    updatedAt = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        # The paged list, most persons waiting first
+        Index("ix_pincode_stats_persons_pincode", persons.desc(), pincode),
+    )
+
+
+class MailOutbox(Base):
+    __tablename__ = 'mail_outbox'
+    id = Column(Integer, primary_key=True, index=True)
+    recipients = Column(JSON, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    subtype = Column(String, nullable=False, default="html")
+    status = Column(String, nullable=False, default="pending")  # pending, sent, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    lastError = Column(String, nullable=True)
+    createdAt = Column(DateTime, nullable=False)
+    nextAttemptAt = Column(DateTime, nullable=False)
+    sentAt = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_mail_outbox_status_nextAttemptAt", "status", "nextAttemptAt"),
+    )
@@ -1,18 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from Model import Users as User
-from app.schemas.auth import UserRegister, UserLogin, Token, RefreshToken, RegisterResponse, LoginResponse, EmailSchema, ResetPassword
-from app.utils.auth import hash_password, verify_password, create_access_token, create_refresh_token, verify_refresh_token, create_verification_email, verify_verification_email, create_reset_token
+from app.schemas.auth import UserRegister, UserLogin, Token, RefreshToken, RegisterResponse, LoginResponse, EmailSchema, ResetPassword, UserOut
+from app.utils.auth import hash_password, verify_password, needs_rehash, create_access_token, create_refresh_token, verify_refresh_token, create_verification_email, verify_verification_email, create_reset_token
 from datetime import timedelta
-from database import get_db
-from app.utils.dependencies import get_current_user
-from fastapi_mail import FastMail, MessageSchema, MessageType
-from app.config import conf
+from database import get_async_db
+from app.utils.dependencies import get_current_user, get_admin_user
+from app.utils.mailer import enqueue_email, mailer
+from app.utils import user_cache
+from app.utils.batch_writer import user_writer
 from datetime import datetime
-from passlib.context import CryptContext
 from dotenv import load_dotenv
 import os
 import jwt
+from loguru import logger
 
 load_dotenv()
 
@@ -26,20 +28,21 @@ BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:8000")
 
 # Register User
 @router.post("/register")
-async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
+async def register_user(user_data: UserRegister, db: AsyncSession = Depends(get_async_db)):
     # Check if user already exists
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
+    existing_user = await db.scalar(select(User).where(User.email == user_data.email).limit(1))
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    existing_users = db.query(User).filter(User.phoneNumber == user_data.phoneNumber).first()
-    print(existing_users)
+    existing_users = await db.scalar(select(User).where(User.phoneNumber == user_data.phoneNumber).limit(1))
     if existing_users:
         raise HTTPException(status_code=400, detail="Phone number already registered")
     
+    # End the read so no pooled connection is held while bcrypt runs
+    await db.rollback()
     
     # Hash the password
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await hash_password(user_data.password)
     
     # ✅ Step 1: Create user (but set is_verified=False)
     new_user = User(
@@ -55,46 +58,52 @@ async def register_user(user_data: UserRegister, db: Session = Depends(get_db)):
         createdAt=datetime.utcnow(),
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
 
     # ✅ Step 2: Generate verification token
     token = create_verification_email(new_user.email)
     verification_link = f"{BACKEND_URL}/auth/verify-email?token={token}"
 
-    # ✅ Step 3: Send verification email
-    message = MessageSchema(
+    # ✅ Step 3: Queue verification email (delivered by the background mail dispatcher)
+    await enqueue_email(
+        db,
         subject="Verify your email",
         recipients=[new_user.email],
         body=f"Click the link to verify your email: <a href='{verification_link}'>Verify Now</a>",
-        subtype=MessageType.html
+        subtype="html",
     )
-    
-    fm = FastMail(conf)
-    await fm.send_message(message)
 
     return {"status": status.HTTP_201_CREATED, "detail": "Verification email sent. Please verify your email to login."}
 
 
 # Login User
 @router.post("/login")
-def login_user(user_data: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == user_data.email).first()
+async def login_user(user_data: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).where(User.email == user_data.email).limit(1))
+    password_hash = user.password if user else None
+    # Release the connection while bcrypt runs; the loaded user stays readable
+    await db.close()
     
-    if not user or not verify_password(user_data.password, user.password):
+    if not user or not await verify_password(user_data.password, password_hash):
         raise HTTPException(status_code=400, detail="Invalid email or password")
-    
-    
+
     '''Check if user is verified'''
     if not user.is_verified:
         raise HTTPException(status_code=400, detail="Email not verified. Please verify your email.")
-    
-    # update user coordinates
-    user.latitude = user_data.coordinates['latitude']
-    user.longitude = user_data.coordinates['longitude']
-    
-    db.commit()
-    db.refresh(user)
+
+    # Upgrade hashes made with a different BCRYPT_ROUNDS while we have the password
+    new_hash = await hash_password(user_data.password) if needs_rehash(password_hash) else None
+
+    # update user coordinates, batched with other logins
+    changes = {
+        "latitude": user_data.coordinates['latitude'],
+        "longitude": user_data.coordinates['longitude'],
+    }
+    if new_hash:
+        changes["password"] = new_hash
+    await user_writer.update(user.id, changes)
+    user_cache.invalidate(user.email)
 
     # Generate JWT token
     access_token = create_access_token({"sub": user.email}, timedelta(minutes=30))
@@ -110,40 +119,43 @@ def login_user(user_data: UserLogin, db: Session = Depends(get_db)):
 
 #delete User
 @router.delete("/delete")
-def delete_user(current_user: User = Depends(get_current_user) , db: Session = Depends(get_db)):
+async def delete_user(current_user: User = Depends(get_current_user) , db: AsyncSession = Depends(get_async_db)):
     
-    if not isinstance(current_user, User):
-        raise HTTPException(status_code=400, detail="Invalid user instance")
+    user = await db.get(User, current_user.id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
 
-    db.delete(current_user)  
-    db.commit()
+    await db.delete(user)  
+    await db.commit()
+    user_cache.invalidate(current_user.email)
 
     return {"message": "User deleted successfully"}
 
 # get Access Token
 @router.post("/refresh", response_model=Token)
-def refresh_token(refresh_token: RefreshToken, db: Session = Depends(get_db)):
+async def refresh_token(refresh_token: RefreshToken, db: AsyncSession = Depends(get_async_db)):
     
-    user = verify_refresh_token(refresh_token, db)
+    user = await verify_refresh_token(refresh_token, db)
   
     if not user:
         raise HTTPException(status_code=401, detail="Invalid or expired refresh token")
     
     access_token = create_access_token({"sub": user.email}, timedelta(minutes=15))
-    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token.refresh_token, status: 200}
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token.refresh_token, "status": 200}
 
 #verify email
 @router.get("/verify-email")
-async def verify_email(token: str = Query(...), db: Session = Depends(get_db)):
+async def verify_email(token: str = Query(...), db: AsyncSession = Depends(get_async_db)):
     try:
-        verify = verify_verification_email(token, db)
+        verify = await verify_verification_email(token, db)
         if not verify:
             raise HTTPException(status_code=400, detail="Invalid or expired token")
         
-        user = db.query(User).filter(User.email == verify).first()
+        user = await db.scalar(select(User).where(User.email == verify).limit(1))
         user.is_verified = True
         
-        db.commit()
+        await db.commit()
+        user_cache.invalidate(user.email)
         
         return {"status": "success", "message": "Email verified successfully. You can now log in."}
         
@@ -152,16 +164,16 @@ async def verify_email(token: str = Query(...), db: Session = Depends(get_db)):
         
         
 # Get User Profile
-@router.get("/profile")
+@router.get("/profile", response_model=UserOut)
 def get_user_profile(current_user: User = Depends(get_current_user)):
     return current_user
 
 @router.post("/send-email")
-async def send_email( payload: EmailSchema, db: Session = Depends(get_db)):
+async def send_email( payload: EmailSchema, db: AsyncSession = Depends(get_async_db)):
     
     email = payload.email
     
-    current_user = db.query(User).filter(User.email == email).first()
+    current_user = await db.scalar(select(User).where(User.email == email).limit(1))
     
     if not current_user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -169,9 +181,10 @@ async def send_email( payload: EmailSchema, db: Session = Depends(get_db)):
     reset_token = create_reset_token(current_user.email)
     reset_link = f"{FRONTEND_URL}/reset-password?token={reset_token}"
     
-    print(reset_link)
+    logger.debug(f"Password reset link for {current_user.email}: {reset_link}")
     
-    message = MessageSchema(
+    await enqueue_email(
+    db,
     subject="🔒 Reset Your Password - Secure Your Account",
     recipients=[current_user.email],
     body=f"""
@@ -210,41 +223,49 @@ async def send_email( payload: EmailSchema, db: Session = Depends(get_db)):
 
     </div>
     """,
-    subtype=MessageType.html
+    subtype="html"
 )
     
-    fm = FastMail(conf)
-    await fm.send_message(message)
-    
     return {"message": "Password reset email sent successfully"}
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@router.get("/mail-queue")
+def get_mail_queue(current_user: User = Depends(get_admin_user)):
+    """
+    Report outbound mail queue depth, delivery counters and latency.
+    """
+    return mailer.stats()
 
+@router.get("/user-cache")
+def get_user_cache_stats(current_user: User = Depends(get_admin_user)):
+    """
+    Report size and hit ratio of the token claims and user snapshot caches.
+    """
+    return user_cache.stats()
 
 
 @router.post("/reset-password")
-async def reset_password(payload: ResetPassword, db: Session = Depends(get_db)):
+async def reset_password(payload: ResetPassword, db: AsyncSession = Depends(get_async_db)):
     """Reset the user's password after verifying the reset token."""
     try:
+        token_payload = jwt.decode(payload.token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
 
-        token = payload.token
-        new_password = payload.new_password
-        
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=401, detail="Invalid token")
+    email = token_payload.get("sub")
+    if not email:
+        raise HTTPException(status_code=401, detail="Invalid token")
 
-        user = db.query(User).filter(User.email == email).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+    # Hash before touching the database so no connection is held meanwhile
+    hashed_password = await hash_password(payload.new_password)
 
-        # Hash and update the new password
-        user.password = pwd_context.hash(new_password)
-        db.commit()
+    user = await db.scalar(select(User).where(User.email == email).limit(1))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
 
-        return {"message": "Password reset successfully"}
+    # Update the new password
+    user.password = hashed_password
+    await db.commit()
+    user_cache.invalidate(user.email)
 
-    except:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return {"message": "Password reset successfully"}
     
\ No newline at end of file
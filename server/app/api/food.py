@@ -1,56 +1,47 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, status, Form, UploadFile, File
-from sqlalchemy.orm import Session
-from database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Form, UploadFile, File, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from Model import FoodProvidingRegions
-from math import radians, sin, cos, sqrt, atan2
-from app.utils.dependencies import get_current_user
+from app.utils.dependencies import get_current_user, get_admin_user
+from app.utils.distance import haversine
+from app.utils import spatial_index, response_cache, map_tiles
 from datetime import datetime   
-from app.utils.amazon import s3_upload
+from app.utils.uploads import store_image, save_image_locally
+from app.schemas.layers import FoodList, FoodImport, FoodOut, ImportSummary
+from app.utils import bulk_import
+from app.utils.batch_writer import food_writer
+from app.utils.pincode_stats import pincode_stats
 
 router = APIRouter()
 
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Haversine formula to calculate the distance (in km) between two latitude-longitude points.
-    """
-    R = 6371  # Earth radius in km
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c  # Distance in km
-
-@router.get("/food") 
-def getFood(
+@router.get("/food", response_model=FoodList, response_class=ORJSONResponse)
+async def getFood(
+    request: Request,
     latitude: float = Query(..., description="User's latitude"),
     longitude: float = Query(..., description="User's longitude"),
     dist: int = Query(10, description="Distance in km to search for shelters"),
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=500, description="Maximum number of regions to return"),
+    offset: int = Query(0, ge=0, description="Number of regions to skip"),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
-    Fetch Regions within a 10 km radius of the user's location.
+    Fetch Regions within a 10 km radius of the user's location, nearest first.
     """
-
-    food = db.query(FoodProvidingRegions).all()
-    
-    nearby_food = []
-    
-    for food_region in food:
-        if food_region.latitude is None or food_region.longitude is None:
-            continue
-        
-        distance = haversine(latitude, longitude, food_region.latitude, food_region.longitude)
-        
-        if distance <= dist:
-            nearby_food.append(food_region)
+    cached = await response_cache.search(request, FoodProvidingRegions, FoodOut, latitude, longitude, dist)
+    if cached.rows is None:
+        rows, _ = await spatial_index.find_nearby(db, FoodProvidingRegions, select(FoodProvidingRegions), *cached.area)
+        await cached.fill(rows)
+    nearby_food, total = cached.nearby(limit, offset)
             
-    if not nearby_food:
+    if not total:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No food providing regions found within {dist}  km radius",
         )
         
-    return {"food": nearby_food}
+    return cached.respond(FoodList(food=nearby_food, total=total))
         
     
 @router.post("/add") 
@@ -63,62 +54,66 @@ async def addFood(
     userLatitude: float = Form(None, description="User's latitude"),
     userLongitude: float = Form(None, description="User's longitude"),
     image: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user)
 ):
     """
     Add a new food providing region.
     """
     
-    image_path = None
-    
-    if image is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image is required.")
-    
-    photo = image.file.read()
-    
-    # check if the image is empty
-    if not photo:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty image file.")
-    
-    
-    if image:
-        timeStamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        image_path = await s3_upload(contents=photo, key=f"news/{timeStamp}_{image.filename}")
-        
-        if not image_path:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to upload image.")
+    # Validate and stream the image to S3 without reading it into memory
+    image_path, derivatives = await store_image(image)
         
     dist = haversine(latitude, longitude, userLatitude, userLongitude)
     
-    food_region = FoodProvidingRegions(
+    values = dict(
         address=address,
         pincode=pincode,
         description=description,
         latitude=latitude,
         longitude=longitude,
         images=image_path,
+        derivatives=derivatives,
         createdAt=datetime.now(),
         userId=current_user.id,
         distance=dist,
     )
-    
-    db.add(food_region)
-    db.commit()
-    db.refresh(food_region)
+    # Release the connection the user lookup may hold before waiting on the batch writer
+    await db.close()
+    food_region = FoodProvidingRegions(id=await food_writer.insert(values), **values)
+    spatial_index.upsert(food_region)
+    pincode_stats.record(pincode, food=1)
+    await response_cache.invalidate(FoodProvidingRegions, (latitude, longitude))
+    map_tiles.invalidate(FoodProvidingRegions, (latitude, longitude))
     
     return {"message": "Food providing region added successfully", "food": food_region}
 
+@router.post("/import", response_model=ImportSummary)
+async def import_food_regions(
+    file: UploadFile = File(..., description="CSV, JSON lines or GeoJSON of food providing regions"),
+    format: str = Query(None, description="csv, jsonl or geojson; guessed from the file when omitted"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: int = Depends(get_admin_user),
+):
+    """
+    Bulk add food providing regions. Each record needs address, pincode, latitude
+    and longitude (GeoJSON takes them from a Point geometry) and may have
+    description and images. Invalid rows are reported and skipped; valid rows
+    are inserted in batches.
+    """
+    fmt = bulk_import.detect_format(file, format)
+    return await bulk_import.import_rows(db, FoodProvidingRegions, FoodImport, file, fmt, current_user.id)
+
 # get food by user id
-@router.get("/get-food-regions")
-def get_food_by_user_id(
+@router.get("/get-food-regions", response_model=FoodList, response_model_exclude_unset=True, response_class=ORJSONResponse)
+async def get_food_by_user_id(
     current_user: int = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Fetch food providing regions by user ID.
     """
-    food = db.query(FoodProvidingRegions).filter(FoodProvidingRegions.userId == current_user.id).order_by(FoodProvidingRegions.createdAt.desc()).all()
+    food = (await db.scalars(select(FoodProvidingRegions).where(FoodProvidingRegions.userId == current_user.id).order_by(FoodProvidingRegions.createdAt.desc()))).all()
     
     if not food:
         raise HTTPException(
@@ -130,7 +125,7 @@ def get_food_by_user_id(
 
 # update food region by id
 @router.put("/update/{food_id}")
-def update_food_region(
+async def update_food_region(
     food_id: int,
     address: str = Form(..., description="Address of the food providing region"),
     pincode: str = Form(..., description="Pincode of the food providing region"),
@@ -138,14 +133,14 @@ def update_food_region(
     latitude: float = Form(..., description="Latitude of the food providing region"),
     longitude: float = Form(..., description="Longitude of the food providing region"),
     image: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user)
 ):
     """
     Update a food providing region by ID.
     """
     
-    food_region = db.query(FoodProvidingRegions).filter(FoodProvidingRegions.id == food_id).first()
+    food_region = await db.get(FoodProvidingRegions, food_id)
     
     if not food_region:
         raise HTTPException(
@@ -153,11 +148,10 @@ def update_food_region(
             detail="Food providing region not found",
         )
     
+    old_position = (food_region.latitude, food_region.longitude)
+    old_pincode = food_region.pincode
     if image:
-        image_path = f"images/{image.filename}"
-        with open(image_path, "wb") as buffer:
-            buffer.write(image.file.read())
-        food_region.images = image_path
+        food_region.images, food_region.derivatives = await save_image_locally(image, "images")
         
     food_region.address = address
     food_region.pincode = pincode
@@ -165,22 +159,27 @@ def update_food_region(
     food_region.latitude = latitude
     food_region.longitude = longitude
     
-    db.commit()
+    await db.commit()
+    await db.refresh(food_region)
+    spatial_index.upsert(food_region)
+    pincode_stats.moved("food", old_pincode, food_region.pincode)
+    await response_cache.invalidate(FoodProvidingRegions, old_position, (latitude, longitude))
+    map_tiles.invalidate(FoodProvidingRegions, old_position, (latitude, longitude))
     
     return {"message": "Food providing region updated successfully", "food": food_region}
 
 # delete food region by id
 @router.delete("/delete/{food_id}")
-def delete_food_region(
+async def delete_food_region(
     food_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user)
 ):
     """
     Delete a food providing region by ID.
     """
     
-    food_region = db.query(FoodProvidingRegions).filter(FoodProvidingRegions.id == food_id).first()
+    food_region = await db.get(FoodProvidingRegions, food_id)
     
     if not food_region:
         raise HTTPException(
@@ -188,7 +187,13 @@ def delete_food_region(
             detail="Food providing region not found",
         )
     
-    db.delete(food_region)
-    db.commit()
+    position = (food_region.latitude, food_region.longitude)
+    old_pincode = food_region.pincode
+    await db.delete(food_region)
+    await db.commit()
+    spatial_index.remove(FoodProvidingRegions, food_id)
+    pincode_stats.record(old_pincode, food=-1)
+    await response_cache.invalidate(FoodProvidingRegions, position)
+    map_tiles.invalidate(FoodProvidingRegions, position)
     
     return {"message": "Food providing region deleted successfully"}
\ No newline at end of file
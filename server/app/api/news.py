@@ -1,71 +1,72 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, status, Form
-from sqlalchemy.orm import Session
-from database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Form, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from Model import News
-from math import radians, sin, cos, sqrt, atan2
 from fastapi import File, UploadFile
 from datetime import datetime
 from app.utils.dependencies import get_current_user
-import os
-from app.utils.amazon import s3_upload
+from app.utils.uploads import store_image, save_image_locally
+from app.utils import spatial_index, response_cache, news_feed, search
+from app.utils.batch_writer import news_writer
+from app.schemas.layers import NewsList, NewsOut
 
 router = APIRouter()
 
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Haversine formula to calculate the distance (in km) between two latitude-longitude points.
-    """
-    R = 6371  # Earth radius in km
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c  # Distance in km
-
-
-@router.get("/news")
-def get_news(
+@router.get("/news", response_model=NewsList, response_class=ORJSONResponse)
+async def get_news(
+    request: Request,
     latitude: float = Query(..., description="Latitude of the user"),
     longitude: float = Query(..., description="Longitude of the user"),
-    distance: float = Query(5, description="Search radius in km"),
-    db: Session = Depends(get_db),
+    distance: float = Query(5, gt=0, description="Search radius in km"),
+    hours: float = Query(news_feed.NEWS_FEED_WINDOW_HOURS, gt=0, le=24 * 30, description="Only news from the last N hours"),
+    limit: int = Query(100, ge=1, le=500, description="Maximum number of news items to return"),
+    cursor: str = Query(None, description="next_cursor from the previous page"),
+    db: AsyncSession = Depends(get_async_db),
 ):
 
     """
-    Get all news within a specified distance from the user's location.
+    Get recent news within a specified distance from the user's location, ranked
+    by a mix of distance and age. Follow next_cursor for more; total is only
+    reported on the first page.
     """
-    # Fetch all news from the database
-    all_news = db.query(News).all()
-    
-    # Filter news based on distance
-    filtered_news = []
-    for news in all_news:
-        dist = haversine(latitude, longitude, news.latitude, news.longitude)
-        if dist <= distance:
-            news.distance = dist
-            
-            filtered_news.append(news)
-            
-    # Sort news by distance
-    filtered_news.sort(key=lambda x: x.distance)
-    
-    # only past 3 days news
-    filtered_news = [news for news in filtered_news if (datetime.now() - news.createdAt).days <= 3]
-    
-    #Limit to 100 results
-    filtered_news = filtered_news[:100]
+    cached = await response_cache.search(request, News, NewsOut, latitude, longitude, distance, hours=hours)
+    feed, next_cursor, total = await news_feed.page(
+        db, latitude, longitude, distance, hours=hours, limit=limit, cursor=cursor, cached=cached
+    )
     
-    if not filtered_news:
+    if not feed and not cursor:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No news found within the specified distance.")
     
-    return {
-        "news": filtered_news,
-        "count": len(filtered_news),
-    }
+    return cached.respond(NewsList(
+        news=feed,
+        count=len(feed),
+        total=total,
+        next_cursor=next_cursor,
+    ))
     
     
 
 
+@router.get("/search", response_model=NewsList, response_class=ORJSONResponse)
+async def search_news(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to look for in titles and descriptions"),
+    latitude: float = Query(None, description="Only news near this latitude"),
+    longitude: float = Query(None, description="Only news near this longitude"),
+    distance: float = Query(None, gt=0, description="Search radius in km around latitude/longitude"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of news items to return"),
+    offset: int = Query(0, ge=0, description="Number of news items to skip"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Full-text search over news titles and descriptions, most relevant first. Each
+    word matches as a prefix; pass a location and distance to search nearby only.
+    """
+    results, total = await search.search(db, News, q, latitude, longitude, distance, limit=limit, offset=offset)
+    return NewsList(news=results, count=len(results), total=total)
+
+
 UPLOAD_FOLDER = "images"
 # add news
 @router.post("/add")
@@ -75,36 +76,21 @@ async def add_news(
     image: UploadFile = File(None), 
     latitude: float = Form(...),  
     longitude: float = Form(...),  
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user),
 ):
-    image_path = None
-    
-    if image is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image is required.")
-    
-    photo = image.file.read()
-    
-    # check if the image is empty
-    if not photo:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty image file.")
-    
-    
-    if image:
-        timeStamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        image_path = await s3_upload(contents=photo, key=f"news/{timeStamp}_{image.filename}")
-        
-        if not image_path:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to upload image.")
+    # Validate and stream the image to S3 without reading it into memory
+    image_path, derivatives = await store_image(image)
         
     
         
 
     # ✅ Use "images" instead of "image" (as per DB model)
-    new_news = News(
+    values = dict(
         title=title,
         description=description,
         images=image_path,  # ✅ Fix column name
+        derivatives=derivatives,
         createdAt=datetime.now(),
         updatedAt=datetime.now(),
         userId=current_user.id,
@@ -112,23 +98,24 @@ async def add_news(
         longitude=longitude,
         distance=0,  # Placeholder for distance
     )
-    
-    db.add(new_news)
-    db.commit()
-    db.refresh(new_news)
+    # Release the connection the user lookup may hold before waiting on the batch writer
+    await db.close()
+    new_news = News(id=await news_writer.insert(values), **values)
+    spatial_index.upsert(new_news)
+    await response_cache.invalidate(News, (latitude, longitude))
     
     return {"message": "News added successfully", "news": new_news}
 
 # get upload news by user
-@router.get("/mynews")
-def get_my_news(
-    db: Session = Depends(get_db),
+@router.get("/mynews", response_model=NewsList, response_model_exclude_unset=True, response_class=ORJSONResponse)
+async def get_my_news(
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user),
 ):
     """
     Get all news uploaded by the current user.
     """
-    my_news = db.query(News).filter(News.userId == current_user.id).order_by(News.createdAt.desc()).all()
+    my_news = (await db.scalars(select(News).where(News.userId == current_user.id).order_by(News.createdAt.desc()))).all()
     
     if not my_news:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No news found for this user.")
@@ -140,58 +127,58 @@ def get_my_news(
     
 # delete news
 @router.delete("/delete/{news_id}")
-def delete_news(
+async def delete_news(
     news_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user),
 ):
     """
     Delete a news item by its ID.
     """
-    news_to_delete = db.query(News).filter(News.id == news_id, News.userId == current_user.id).first()
+    news_to_delete = await db.scalar(select(News).where(News.id == news_id, News.userId == current_user.id).limit(1))
     
     if not news_to_delete:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="News not found or not authorized to delete.")
     
-    db.delete(news_to_delete)
-    db.commit()
+    position = (news_to_delete.latitude, news_to_delete.longitude)
+    await db.delete(news_to_delete)
+    await db.commit()
+    spatial_index.remove(News, news_id)
+    await response_cache.invalidate(News, position)
     
     return {"message": "News deleted successfully"}
 
 # update news
 @router.put("/update/{news_id}")
-def update_news(
+async def update_news(
     news_id: int,
     title: str = Form(...), 
     description: str = Form(...), 
     image: UploadFile = File(None), 
     latitude: float = Form(...),  
     longitude: float = Form(...),  
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: int = Depends(get_current_user),
 ):
     """
     Update a news item by its ID.
     """
-    news_to_update = db.query(News).filter(News.id == news_id, News.userId == current_user.id).first()
+    news_to_update = await db.scalar(select(News).where(News.id == news_id, News.userId == current_user.id).limit(1))
     
     if not news_to_update:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="News not found or not authorized to update.")
     
+    old_position = (news_to_update.latitude, news_to_update.longitude)
     if image:
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        
-        image_path = f"{UPLOAD_FOLDER}/{image.filename}"
-        with open(image_path, "wb") as buffer:
-            buffer.write(image.file.read())
-            
-        news_to_update.images = image_path
+        news_to_update.images, news_to_update.derivatives = await save_image_locally(image, UPLOAD_FOLDER)
     news_to_update.title = title
     news_to_update.description = description
     news_to_update.latitude = latitude
     news_to_update.longitude = longitude
     news_to_update.updatedAt = datetime.now()
-    db.commit()
+    await db.commit()
     
-    db.refresh(news_to_update)
+    await db.refresh(news_to_update)
+    spatial_index.upsert(news_to_update)
+    await response_cache.invalidate(News, old_position, (latitude, longitude))
     return {"message": "News updated successfully", "news": news_to_update}
\ No newline at end of file
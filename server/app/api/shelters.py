@@ -1,61 +1,91 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, status, Form, UploadFile, File
-from sqlalchemy.orm import Session
-from database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Form, UploadFile, File, Request
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from Model import Shelters
-from math import radians, sin, cos, sqrt, atan2
-from app.utils.dependencies import get_current_user
+from app.utils.dependencies import get_current_user, get_admin_user
+from app.utils.distance import haversine
+from app.utils import spatial_index, response_cache, search, nearest_shelters, map_tiles
 from datetime import datetime
-from pydantic import BaseModel
-import os
-from app.utils.amazon import s3_upload
+from loguru import logger
+from app.schemas.layers import ShelterList, ShelterImport, ShelterOut, ImportSummary
+from app.utils import bulk_import
+from app.utils.batch_writer import shelter_writer
+from app.utils.pincode_stats import pincode_stats
+from app.utils.uploads import store_image, save_image_locally, release_local_image
 
 router = APIRouter()
 
-def haversine(lat1, lon1, lat2, lon2):
-    """
-    Haversine formula to calculate the distance (in km) between two latitude-longitude points.
-    """
-    R = 6371  # Earth radius in km
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c  # Distance in km
-
-@router.get("/get-shelters")
+@router.get("/get-shelters", response_model=ShelterList, response_class=ORJSONResponse)
 async def get_shelters(
+    request: Request,
     latitude: float = Query(..., description="User's latitude"),
     longitude: float = Query(..., description="User's longitude"),
     dist: int = Query(..., description="Distance in km to search for shelters"),
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=500, description="Maximum number of shelters to return"),
+    offset: int = Query(0, ge=0, description="Number of shelters to skip"),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
-    Fetch shelters within a  km radius of the user's location.
+    Fetch shelters within a  km radius of the user's location, nearest first.
     """
     
-    print(f"Received coordinates: ({latitude}, {longitude}) with distance {dist} km")
-
-    shelters = db.query(Shelters).all()
-    nearby_shelters = []
+    logger.debug(f"Received coordinates: ({latitude}, {longitude}) with distance {dist} km")
 
-    for shelter in shelters:
-        if shelter.latitude is None or shelter.longitude is None:
-            continue  # Skip shelters without valid coordinates
+    cached = await response_cache.search(request, Shelters, ShelterOut, latitude, longitude, dist)
+    if cached.rows is None:
+        rows, _ = await spatial_index.find_nearby(db, Shelters, select(Shelters), *cached.area)
+        await cached.fill(rows)
+    nearby_shelters, total = cached.nearby(limit, offset)
 
-        distance = haversine(latitude, longitude, shelter.latitude, shelter.longitude)
-        
-        if distance <= dist:
-            nearby_shelters.append(shelter)
-
-    if not nearby_shelters:
+    if not total:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No shelters found within 10 km radius",
         )
         
-    print(f"Found {len(nearby_shelters)} shelters within {dist} km of ({latitude}, {longitude})")
+    logger.debug(f"Found {total} shelters within {dist} km of ({latitude}, {longitude})")
+
+    return cached.respond(ShelterList(shelters=nearby_shelters, total=total))
 
-    return {"shelters": nearby_shelters}
+@router.get("/search", response_model=ShelterList, response_class=ORJSONResponse)
+async def search_shelters(
+    q: str = Query(..., min_length=1, max_length=200, description="Words to look for in names and descriptions"),
+    latitude: float = Query(None, description="Only shelters near this latitude"),
+    longitude: float = Query(None, description="Only shelters near this longitude"),
+    dist: float = Query(None, gt=0, description="Search radius in km around latitude/longitude"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of shelters to return"),
+    offset: int = Query(0, ge=0, description="Number of shelters to skip"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Full-text search over shelter names and descriptions, most relevant first. Each
+    word matches as a prefix; pass a location and distance to search nearby only.
+    """
+    results, total = await search.search(db, Shelters, q, latitude, longitude, dist, limit=limit, offset=offset)
+    return ShelterList(shelters=results, total=total)
+
+@router.get("/nearest", response_model=ShelterList, response_class=ORJSONResponse)
+async def get_nearest_shelters(
+    latitude: float = Query(..., ge=-90, le=90, description="User's latitude"),
+    longitude: float = Query(..., ge=-180, le=180, description="User's longitude"),
+    k: int = Query(5, ge=1, le=50, description="Number of shelters to return"),
+    max_km: float = Query(None, gt=0, description="Ignore shelters farther than this many km"),
+    has_space: bool = Query(True, description="Skip shelters known to be full"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    The k shelters nearest to the user, nearest first. Shelters within the same
+    100 m count as equally far and the one with more free places comes first.
+    """
+    shelters = await nearest_shelters.nearest(db, latitude, longitude, k, max_km, space_only=has_space)
+    if not shelters:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No shelters with space found" if has_space else "No shelters found",
+        )
+    return ShelterList(shelters=shelters, total=len(shelters))
 
 UPLOAD_FOLDER = "images"
 
@@ -70,14 +100,16 @@ async def add_shelter(
     longitude: float = Form(...),
     userLatitude: float = Form(...),
     userLongitude: float = Form(...),
-    db: Session = Depends(get_db),
+    capacity: int = Form(None, ge=0),
+    occupancy: int = Form(None, ge=0),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user),
 ):
     """
     Add a new shelter to the database.
     """
     
-    print(f"Received shelter data: {name}, {address}, {pincode}, {latitude}, {longitude}")
+    logger.debug(f"Received shelter data: {name}, {address}, {pincode}, {latitude}, {longitude}")
     
     # check latitude and longitude
     if latitude is None or longitude is None:
@@ -86,45 +118,34 @@ async def add_shelter(
             detail="Latitude and Longitude are required",
         )
 
-    # Save the image file
-    image_path = None
-    
-    if image is None:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image is required.")
-    
-    photo = image.file.read()
-    
-    # check if the image is empty
-    if not photo:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty image file.")
-    
-    
-    if image:
-        timeStamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        image_path = await s3_upload(contents=photo, key=f"news/{timeStamp}_{image.filename}")
-        
-        if not image_path:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to upload image.")
+    # Validate and stream the image to S3 without reading it into memory
+    image_path, derivatives = await store_image(image)
         
-    print(f"Image uploaded to: {image_path}")
+    logger.debug(f"Image uploaded to: {image_path}")
 
     # Create the shelter entry
-    new_shelter = Shelters(
+    values = dict(
         name=name,
         address=address,
         pincode=pincode,
         images=image_path,  # ✅ Save the image path
+        derivatives=derivatives,
         latitude=latitude,
         longitude=longitude,
         createdAt=datetime.now(),
         updatedAt=datetime.now(),
         userId=current_user.id,  # Assuming current_user has an id attribute
         distance=haversine(latitude, longitude, userLatitude, userLongitude),  # Placeholder for distance calculation
+        capacity=capacity,
+        occupancy=occupancy,
     )
-
-    db.add(new_shelter)
-    db.commit()
-    db.refresh(new_shelter)
+    # Release the connection the user lookup may hold before waiting on the batch writer
+    await db.close()
+    new_shelter = Shelters(id=await shelter_writer.insert(values), **values)
+    spatial_index.upsert(new_shelter)
+    pincode_stats.record(pincode, shelters=1)
+    await response_cache.invalidate(Shelters, (latitude, longitude))
+    map_tiles.invalidate(Shelters, (latitude, longitude))
 
     return {
         "status": 200,
@@ -132,19 +153,36 @@ async def add_shelter(
     }
     
 
+@router.post("/import", response_model=ImportSummary)
+async def import_shelters(
+    file: UploadFile = File(..., description="CSV, JSON lines or GeoJSON of shelters"),
+    format: str = Query(None, description="csv, jsonl or geojson; guessed from the file when omitted"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_admin_user),
+):
+    """
+    Bulk add shelters. Each record needs name, address, pincode, latitude and
+    longitude (GeoJSON takes them from a Point geometry) and may have description,
+    images, capacity and occupancy. Invalid rows are reported and skipped; valid rows are inserted in
+    batches.
+    """
+    fmt = bulk_import.detect_format(file, format)
+    return await bulk_import.import_rows(db, Shelters, ShelterImport, file, fmt, current_user.id)
+
+
 # get shelters by user id
-@router.get("/get-shelters-by-user")
-def get_shelters_by_user(
+@router.get("/get-shelters-by-user", response_model=ShelterList, response_model_exclude_unset=True, response_class=ORJSONResponse)
+async def get_shelters_by_user(
     current_user: str = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Fetch shelters added by a specific user.
     """
     
-    print(f"Fetching shelters for user ID: {current_user.id}")
+    logger.debug(f"Fetching shelters for user ID: {current_user.id}")
     
-    shelters = db.query(Shelters).filter(Shelters.userId == current_user.id).order_by(Shelters.createdAt.desc()).all()
+    shelters = (await db.scalars(select(Shelters).where(Shelters.userId == current_user.id).order_by(Shelters.createdAt.desc()))).all()
 
     if not shelters:
         raise HTTPException(
@@ -156,18 +194,18 @@ def get_shelters_by_user(
 
 # delete shelters by user id
 @router.delete("/delete/{shelter_id}")
-def delete_shelter(
+async def delete_shelter(
     shelter_id: int,
     current_user: str = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Delete a shelter by its ID.
     """
     
-    print(f"Deleting shelter with ID: {shelter_id} for user ID: {current_user.id}")
+    logger.debug(f"Deleting shelter with ID: {shelter_id} for user ID: {current_user.id}")
     
-    shelter = db.query(Shelters).filter(Shelters.id == shelter_id, Shelters.userId == current_user.id).first()
+    shelter = await db.scalar(select(Shelters).where(Shelters.id == shelter_id, Shelters.userId == current_user.id).limit(1))
 
     if not shelter:
         raise HTTPException(
@@ -175,19 +213,26 @@ def delete_shelter(
             detail="Shelter not found or you do not have permission to delete it",
         )
 
-    # Delete the image file if it exists
-    if shelter.images and os.path.exists(shelter.images):
-        os.remove(shelter.images)
+    image_path = shelter.images
+    position = (shelter.latitude, shelter.longitude)
+    old_pincode = shelter.pincode
+
+    await db.delete(shelter)
+    await db.commit()
+    spatial_index.remove(Shelters, shelter_id)
+    pincode_stats.record(old_pincode, shelters=-1)
+    await response_cache.invalidate(Shelters, position)
+    map_tiles.invalidate(Shelters, position)
 
-    db.delete(shelter)
-    db.commit()
+    # Delete the image file if no other row shares it
+    await release_local_image(db, image_path)
 
     return {"status": 200, "detail": "Shelter deleted successfully"}
 
 
 # update shelters by user id
 @router.put("/update/{shelter_id}")
-def update_shelter(
+async def update_shelter(
     shelter_id: int,
     name: str = Form(...),
     address: str = Form(...),
@@ -196,16 +241,19 @@ def update_shelter(
     latitude: float = Form(...),
     longitude: float = Form(...),
     description: str = Form(...),
-    db: Session = Depends(get_db),
+    capacity: int = Form(None, ge=0),
+    occupancy: int = Form(None, ge=0),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user),
 ):
     """
-    Update a shelter's details.
+    Update a shelter's details. Capacity and occupancy keep their values when
+    left out.
     """
     
-    print(f"Updating shelter with ID: {shelter_id} for user ID: {current_user.id}")
+    logger.debug(f"Updating shelter with ID: {shelter_id} for user ID: {current_user.id}")
     
-    shelter = db.query(Shelters).filter(Shelters.id == shelter_id, Shelters.userId == current_user.id).first()
+    shelter = await db.scalar(select(Shelters).where(Shelters.id == shelter_id, Shelters.userId == current_user.id).limit(1))
 
     if not shelter:
         raise HTTPException(
@@ -213,6 +261,9 @@ def update_shelter(
             detail="Shelter not found or you do not have permission to update it",
         )
 
+    old_position = (shelter.latitude, shelter.longitude)
+    old_pincode = shelter.pincode
+
     # Update the shelter's details
     shelter.name = name
     shelter.address = address
@@ -221,29 +272,65 @@ def update_shelter(
     shelter.longitude = longitude
     shelter.description = description
     shelter.pincode = pincode
+    if capacity is not None:
+        shelter.capacity = capacity
+    if occupancy is not None:
+        shelter.occupancy = occupancy
     shelter.updatedAt = datetime.now()
 
     # Save the new image if provided
+    old_image = shelter.images
     if image:
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        image_path = f"{UPLOAD_FOLDER}/{image.filename}"
-        
-        with open(image_path, "wb") as buffer:
-            buffer.write(image.file.read())
-        # Delete the old image file if it exists
-        if shelter.images and os.path.exists(shelter.images):
-            os.remove(shelter.images)
-            
-        shelter.images = image_path
-    else:
-        shelter.images = shelter.images
+        shelter.images, shelter.derivatives = await save_image_locally(image, UPLOAD_FOLDER)
     # Update the distance
     shelter.distance = haversine(latitude, longitude, shelter.latitude, shelter.longitude)
     shelter.updatedAt = datetime.now()
-    db.commit()
-    db.refresh(shelter)
+    await db.commit()
+    await db.refresh(shelter)
+    spatial_index.upsert(shelter)
+    pincode_stats.moved("shelters", old_pincode, shelter.pincode)
+    await response_cache.invalidate(Shelters, old_position, (latitude, longitude))
+    map_tiles.invalidate(Shelters, old_position, (latitude, longitude))
+
+    # Delete the old image file if it was replaced and no other row shares it
+    if old_image != shelter.images:
+        await release_local_image(db, old_image)
     
     return {
         "status": 200,
         "detail": "Shelter updated successfully",
-    }
\ No newline at end of file
+    }
+
+
+# update how many people a shelter holds
+@router.put("/occupancy/{shelter_id}")
+async def update_occupancy(
+    shelter_id: int,
+    occupancy: int = Form(..., ge=0),
+    capacity: int = Form(None, ge=0),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_current_user),
+):
+    """
+    Record how many people a shelter holds now, and optionally its capacity, without
+    resending the rest of its details.
+    """
+    shelter = await db.scalar(select(Shelters).where(Shelters.id == shelter_id, Shelters.userId == current_user.id).limit(1))
+
+    if not shelter:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Shelter not found or you do not have permission to update it",
+        )
+
+    shelter.occupancy = occupancy
+    if capacity is not None:
+        shelter.capacity = capacity
+    shelter.updatedAt = datetime.now()
+    await db.commit()
+    await db.refresh(shelter)
+    spatial_index.upsert(shelter)
+    await response_cache.invalidate(Shelters, (shelter.latitude, shelter.longitude))
+    map_tiles.invalidate(Shelters, (shelter.latitude, shelter.longitude))
+
+    return {"status": 200, "detail": "Shelter occupancy updated successfully"}
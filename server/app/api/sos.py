@@ -1,46 +1,137 @@
 
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from database import get_db
-from app.utils.dependencies import get_current_user, get_user_or_none
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import async_engine, get_async_db
+from app.utils.dependencies import get_current_user, get_user_or_none, get_admin_user
 from Model import SOS
+from app.schemas.layers import SOSList, SOSClusterList
 from datetime import datetime, timedelta
-from math import radians, sin, cos, sqrt, atan2
-from sqlalchemy import asc, desc
+from app.utils.geo import haversine_term, radius_filter, term_to_km
+from app.utils.pagination import encode_cursor, decode_cursor
+from app.utils.distance import haversine
+from app.utils.pubsub import sos_event, sos_feed
+from app.utils import map_tiles, sos_clusters
+from app.utils.rate_limit import InFlight, Limit, RateLimiter, client_ip
+from app.utils.sos_buffer import sos_buffer
+from app.utils.batch_writer import BATCH_WRITES_ENABLED, sos_writer
+from app.utils.pincode_stats import pincode_stats
+from sqlalchemy import asc, desc, select, tuple_
+from dotenv import load_dotenv
+import json
+import os
 
+load_dotenv()
 
 router = APIRouter()
 
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Submissions above any of these limits are queued in the SOS buffer, never refused
+SOS_USER_LIMIT = Limit.per_minute(
+    "sos_user", float(os.getenv("SOS_USER_RATE_PER_MINUTE", "6")), int(os.getenv("SOS_USER_BURST", "3"))
+)
+SOS_IP_LIMIT = Limit.per_minute(
+    "sos_ip", float(os.getenv("SOS_IP_RATE_PER_MINUTE", "60")), int(os.getenv("SOS_IP_BURST", "20"))
+)
+SOS_GLOBAL_LIMIT = Limit(
+    "sos_global", float(os.getenv("SOS_GLOBAL_RATE_PER_SECOND", "200")), int(os.getenv("SOS_GLOBAL_BURST", "400"))
+)
+SOS_RATE_LIMIT_ENABLED = os.getenv("SOS_RATE_LIMIT_ENABLED", "true").lower() == "true"
+
+sos_limiter = RateLimiter()
+# Once this many submissions are waiting on their own rows, the rest go to the buffer.
+# Unbatched, SQLite takes one writer at a time, so more would only wait on its lock.
+if BATCH_WRITES_ENABLED:
+    DEFAULT_CONCURRENT_WRITES = sos_writer.max_rows
+else:
+    DEFAULT_CONCURRENT_WRITES = 1 if async_engine.dialect.name == "sqlite" else 8
+sos_writes = InFlight("sos_writes", int(os.getenv("SOS_MAX_CONCURRENT_WRITES", DEFAULT_CONCURRENT_WRITES)))
+
+
 @router.post("/sos")
-def get_sos(
+async def get_sos(
+    request: Request,
+    response: Response,
     persons: int = Query(..., description="Number of persons affected"),
     latitude: float = Query(..., description="User's latitude"),
     longitude: float = Query(..., description="User's longitude"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user), 
 ):
     """
     Send SOS request with user's latitude and longitude.
     Accepts both authenticated and unauthenticated users.
+
+    Above the per user, per IP or overall rate, or while SOS_MAX_CONCURRENT_WRITES
+    alerts are already being written, the alert is accepted with 202 and saved by
+    the SOS buffer within SOS_BUFFER_FLUSH_MS, merged with any alert the same
+    signed-in user already has waiting nearby.
     """
 
-    # Set userId to None if not provided
-    
+    user_id = current_user.id if current_user else None
+    pincode = current_user.pincode if current_user else None
+    now = datetime.utcnow()
 
-    sos_request = SOS(
-        userId=current_user.id if current_user else None,
-        createdAt=datetime.utcnow(),
+    if SOS_RATE_LIMIT_ENABLED:
+        ip = client_ip(request)
+        checks = [(SOS_IP_LIMIT, ip), (SOS_GLOBAL_LIMIT, "all")]
+        if user_id is not None:
+            checks.insert(0, (SOS_USER_LIMIT, user_id))
+        if await sos_limiter.check(checks) or sos_writes.full():
+            sender = f"user:{user_id}" if user_id is not None else f"ip:{ip}"
+            pending = sos_buffer.submit(sender, user_id, pincode, latitude, longitude, persons)
+            response.status_code = status.HTTP_202_ACCEPTED
+            return {
+                "message": "🚨 SOS request received, help is on the way",
+                "latitude": pending.latitude,
+                "longitude": pending.longitude,
+                "persons": pending.persons,
+                "queued": True,
+            }
+
+    with sos_writes.hold():
+        return await save_sos(db, user_id, pincode, latitude, longitude, persons, now)
+
+
+async def save_sos(db, user_id, pincode, latitude, longitude, persons, now):
+    """Write one alert, or raise persons on the user's recent alert it repeats."""
+    # A repeat of the user's recent alert from the same place updates that alert
+    duplicate_id = sos_clusters.duplicate_of(user_id, latitude, longitude, now)
+    previous = await db.get(SOS, duplicate_id) if duplicate_id is not None else None
+    # Release the connection (the user lookup may hold one) before waiting on the batch writer
+    await db.close()
+    if previous is not None and not previous.resolved:
+        if persons and persons > (previous.persons or 0):
+            await sos_writer.update(previous.id, {"persons": persons})
+            sos_clusters.update_persons(previous.id, persons)
+            pincode_stats.record(previous.pincode, persons=persons - (previous.persons or 0))
+            map_tiles.invalidate(SOS, (previous.latitude, previous.longitude))
+        return {
+            "message": "🚨 SOS request already received, help is on the way",
+            "latitude": previous.latitude,
+            "longitude": previous.longitude,
+            "persons": max(persons or 0, previous.persons or 0),
+            "duplicate": True,
+        }
+
+    values = dict(
+        userId=user_id,
+        createdAt=now,
         issue_rectified=False,
         latitude=latitude,
         longitude=longitude,
         persons=persons if persons else 1,
+        resolved=False,
+        pincode=pincode,
     )
-
-    # Save to database
-    db.add(sos_request)
-    db.commit()
-    db.refresh(sos_request)
+    # Save to database; committed together with other alerts arriving within BATCH_FLUSH_MS
+    sos_request = SOS(id=await sos_writer.insert(values), **values)
+    sos_feed.publish(sos_event("sos", sos_request))
+    sos_clusters.add(sos_request)
+    pincode_stats.record(pincode, sos_unresolved=1, persons=sos_request.persons)
+    map_tiles.invalidate(SOS, (latitude, longitude))
 
     return {
         "message": "🚨 SOS request sent successfully!",
@@ -48,31 +139,24 @@ def get_sos(
         "longitude": longitude,
         "persons": persons
     }
-    
-    
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate the Haversine distance between two points on Earth."""
-    R = 6371  # Radius of Earth in km
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-    return round(R * c, 2)  # Distance in km
 
-@router.get("/all")
-def get_sos_alerts(
-    db: Session = Depends(get_db),
+@router.get("/all", response_model=SOSList, response_model_exclude_unset=True, response_class=ORJSONResponse)
+async def get_sos_alerts(
+    db: AsyncSession = Depends(get_async_db),
     admin_latitude: float = Query(None, description="Admin latitude"),
     admin_longitude: float = Query(None, description="Admin longitude"),
     radius: int = Query(10, description="Radius in km (5, 10, 15, 20)"),
     start_date: str = Query(None, description="Start date in YYYY-MM-DD format"),
     end_date: str = Query(None, description="End date in YYYY-MM-DD format"),
+    limit: int = Query(100, ge=1, le=500, description="Maximum number of alerts per page"),
+    cursor: str = Query(None, description="next_cursor from the previous page"),
 ):
-    """Fetch SOS alerts sorted and filtered by distance, latitude, longitude, and date."""
+    """
+    Fetch unresolved SOS alerts in a date window. With an admin location, alerts
+    are limited to the radius and sorted by distance; otherwise newest first.
+    Filtering, ordering and paging all happen in the database.
+    """
     
     # Default date range (last 2 days)
     if not start_date or not end_date:
@@ -82,40 +166,143 @@ def get_sos_alerts(
         start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
         end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
 
-    # Fetch all alerts within the date range
-    alerts = db.query(SOS).filter(
+    # only not resolved alerts within the date range (end date inclusive)
+    query = select(SOS).where(
+        SOS.resolved == False,
         SOS.createdAt >= start_date,
-        SOS.createdAt <= end_date
-    ).all()
-
-    # Compute distances and filter by radius
-    filtered_alerts = []
-    for alert in alerts:
-        if admin_latitude is not None and admin_longitude is not None:
-            alert_distance = calculate_distance(
-                admin_latitude, admin_longitude, alert.latitude, alert.longitude
-            )
-            if alert_distance <= radius:
-                alert.distance = alert_distance  # Attach distance to alert
-                filtered_alerts.append(alert)
-        else:
-            # If no admin location, just return all alerts
-            filtered_alerts.append(alert)
-
-    # only not resolved alerts
-    filtered_alerts = [alert for alert in filtered_alerts if not alert.resolved]
-    
+        SOS.createdAt < end_date + timedelta(days=1),
+    )
+
+    after = decode_cursor(cursor) if cursor else None
+    if after and not isinstance(after.get("id"), int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if admin_latitude is not None and admin_longitude is not None:
+        term = haversine_term(SOS, admin_latitude, admin_longitude)
+        query = query.add_columns(term).where(
+            radius_filter(SOS, admin_latitude, admin_longitude, radius)
+        )
+        if after:
+            if not isinstance(after.get("term"), (int, float)):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(tuple_(term, SOS.id) > tuple_(after["term"], after["id"]))
+        rows = (await db.execute(query.order_by(term, SOS.id).limit(limit + 1))).all()
+
+        alerts = []
+        for alert, alert_term in rows[:limit]:
+            alert.distance = round(term_to_km(alert_term), 2)  # Distance in km
+            alerts.append(alert)
+        next_cursor = (
+            encode_cursor({"term": rows[limit - 1][1], "id": rows[limit - 1][0].id})
+            if len(rows) > limit else None
+        )
+    else:
+        if after:
+            try:
+                last_created = datetime.fromisoformat(after["createdAt"])
+            except (KeyError, TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.where(tuple_(SOS.createdAt, SOS.id) < tuple_(last_created, after["id"]))
+        rows = (await db.scalars(query.order_by(SOS.createdAt.desc(), SOS.id.desc()).limit(limit + 1))).all()
+
+        alerts = rows[:limit]
+        next_cursor = (
+            encode_cursor({"createdAt": alerts[-1].createdAt.isoformat(), "id": alerts[-1].id})
+            if len(rows) > limit else None
+        )
+
+    return {"sos_alerts": alerts, "next_cursor": next_cursor}
+
+@router.get("/clusters", response_model=SOSClusterList, response_class=ORJSONResponse)
+def get_sos_clusters(
+    latitude: float = Query(None, description="Admin latitude"),
+    longitude: float = Query(None, description="Admin longitude"),
+    radius: int = Query(10, description="Radius in km around the admin location"),
+    min_alerts: int = Query(1, ge=1, description="Only clusters with at least this many alerts"),
+    hours: float = Query(None, gt=0, description="Only clusters with an alert in the last N hours"),
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of clusters to return"),
+):
+    """
+    Unresolved SOS alerts grouped into incidents: alerts within
+    SOS_CLUSTER_RADIUS_KM and SOS_CLUSTER_WINDOW_MINUTES of each other share a
+    cluster. Each cluster has its centroid, alert count and total persons. With a
+    location, clusters are limited to the radius and sorted by distance;
+    otherwise the clusters with the most persons come first.
+    """
+    if not sos_clusters.SOS_CLUSTERING_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="SOS clustering is disabled")
+    since = datetime.utcnow() - timedelta(hours=hours) if hours else None
+    if latitude is not None and longitude is not None:
+        clusters = sos_clusters.engine.clusters(latitude, longitude, radius, min_alerts, since)
+    else:
+        clusters = sos_clusters.engine.clusters(min_alerts=min_alerts, since=since)
+    return {"clusters": clusters[:limit], "total": len(clusters)}
+
+@router.get("/clusters/stats")
+def get_sos_cluster_stats(current_user=Depends(get_admin_user)):
+    """
+    Report alert, cluster and cell counts of the SOS clustering engine.
+    """
+    return sos_clusters.engine.stats()
 
-    return {"sos_alerts": filtered_alerts}
+@router.get("/ingress")
+def get_sos_ingress_stats(current_user=Depends(get_admin_user)):
+    """
+    Report how many SOS submissions were rate limited and the state of the
+    buffer that saves them.
+    """
+    return {
+        "rate_limit": sos_limiter.stats(),
+        "writes": sos_writes.stats(),
+        "buffer": sos_buffer.stats(),
+        "batch_writer": sos_writer.stats(),
+    }
+
+@router.get("/stream")
+async def stream_sos_alerts(
+    request: Request,
+    latitude: float = Query(..., description="Admin latitude"),
+    longitude: float = Query(..., description="Admin longitude"),
+    radius: int = Query(10, description="Radius in km (5, 10, 15, 20)"),
+):
+    """
+    Server-Sent Events feed of SOS alerts within the radius. Emits "sos" for new
+    alerts, "resolved" when an alert is resolved and "resync" when the client fell
+    behind and should reload /sos/all.
+    """
+    subscription = sos_feed.subscribe(latitude, longitude, radius)
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                data = dict(event)
+                if "latitude" in data:
+                    data["distance"] = round(
+                        haversine(latitude, longitude, data["latitude"], data["longitude"]), 2
+                    )
+                yield f"event: {data.pop('type')}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @router.put("/resolve/{sosId}")
-def get_sos_by_id(
+async def get_sos_by_id(
     sosId: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Fetch SOS alert by ID."""
     
-    sos_alert = db.query(SOS).filter(SOS.id == sosId).first()
+    sos_alert = await db.get(SOS, sosId)
     
     if not sos_alert:
         raise HTTPException(status_code=404, detail="SOS alert not found")
@@ -128,8 +315,12 @@ def get_sos_by_id(
     # Update the SOS alert to resolved
     sos_alert.resolved = True
     
-    db.commit()
-    db.refresh(sos_alert)
+    await db.commit()
+    await db.refresh(sos_alert)
+    sos_feed.publish(sos_event("resolved", sos_alert))
+    sos_clusters.remove(sos_alert.id)
+    pincode_stats.record(sos_alert.pincode, sos_unresolved=-1, persons=-(sos_alert.persons or 0))
+    map_tiles.invalidate(SOS, (sos_alert.latitude, sos_alert.longitude))
     
     
     
@@ -139,15 +330,15 @@ def get_sos_by_id(
     
 
 #resolved alerts
-@router.get("/resolved")
+@router.get("/resolved", response_model=SOSList, response_model_exclude_unset=True, response_class=ORJSONResponse)
 
-def get_resolved_sos_alerts(
-    db: Session = Depends(get_db),
+async def get_resolved_sos_alerts(
+    db: AsyncSession = Depends(get_async_db),
 ):
     """Fetch SOS alerts sorted and filtered by distance, latitude, longitude, and date."""
     # Fetch all alerts
-    alerts = db.query(SOS).filter(
+    alerts = (await db.scalars(select(SOS).where(
         SOS.resolved == True
-    ).all()
+    ))).all()
 
     return {"sos_alerts": alerts}
\ No newline at end of file
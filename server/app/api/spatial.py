@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from app.utils.dependencies import get_admin_user
+from app.utils import spatial_index
+
+router = APIRouter()
+
+
+def require_enabled():
+    if not spatial_index.SPATIAL_INDEX_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Spatial index is disabled")
+
+
+@router.get("/stats", dependencies=[Depends(require_enabled)])
+def get_index_stats(current_user=Depends(get_admin_user)):
+    """
+    Report point counts, cell counts and approximate memory use per layer.
+    """
+    layers = {name: layer.grid.stats() for name, layer in spatial_index.layers().items()}
+    return {
+        "layers": layers,
+        "memory_bytes": sum(layer["memory_bytes"] for layer in layers.values()),
+    }
+
+
+@router.get("/check", dependencies=[Depends(require_enabled)])
+async def check_index(db: AsyncSession = Depends(get_async_db), current_user=Depends(get_admin_user)):
+    """
+    Compare every layer of the index with its table.
+    """
+    layers = {name: await layer.check(db) for name, layer in spatial_index.layers().items()}
+    return {
+        "consistent": all(layer["consistent"] for layer in layers.values()),
+        "layers": layers,
+    }
+
+
+@router.post("/rebuild", dependencies=[Depends(require_enabled)])
+async def rebuild_index(db: AsyncSession = Depends(get_async_db), current_user=Depends(get_admin_user)):
+    """
+    Reload every layer of the index from the database.
+    """
+    return {"detail": "Spatial index rebuilt", "layers": await spatial_index.rebuild_all(db)}
@@ -0,0 +1,76 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from Model import PincodeStats
+from app.schemas.stats import PincodeStatsList, PincodeStatsOut
+from app.utils.dependencies import get_admin_user
+from app.utils.pincode_stats import PINCODE_STATS_ENABLED, pincode_stats
+
+router = APIRouter()
+
+
+def require_enabled():
+    if not PINCODE_STATS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Pincode stats are disabled")
+
+
+@router.get(
+    "/pincode", response_model=PincodeStatsList, response_class=ORJSONResponse, dependencies=[Depends(require_enabled)]
+)
+async def get_pincode_stats(
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of pincodes to return"),
+    offset: int = Query(0, ge=0, description="Number of pincodes to skip"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user=Depends(get_admin_user),
+):
+    """
+    Shelter, food point, unresolved SOS and affected persons counts per pincode,
+    the areas with the most persons waiting first. Pages are read in order along
+    the (persons, pincode) index of the summary table instead of sorting it, and
+    the total is the count the upkeep task keeps in memory.
+    """
+    rows = (
+        await db.scalars(
+            select(PincodeStats)
+            .order_by(PincodeStats.persons.desc(), PincodeStats.pincode)
+            .limit(limit)
+            .offset(offset)
+        )
+    ).all()
+    total = pincode_stats.pincodes
+    if total is None:
+        # Only until the startup recount has run
+        total = await db.scalar(select(func.count()).select_from(PincodeStats))
+    return PincodeStatsList(pincodes=rows, total=total)
+
+
+@router.get(
+    "/pincode/{pincode}", response_model=PincodeStatsOut, response_class=ORJSONResponse,
+    dependencies=[Depends(require_enabled)],
+)
+async def get_pincode(pincode: str, db: AsyncSession = Depends(get_async_db), current_user=Depends(get_admin_user)):
+    """
+    Counts for one pincode, by primary key. A pincode with nothing in it has all
+    counts at 0.
+    """
+    row = await db.get(PincodeStats, pincode)
+    return row if row is not None else PincodeStatsOut(pincode=pincode)
+
+
+@router.post("/pincode/reconcile", dependencies=[Depends(require_enabled)])
+async def reconcile_pincode_stats(current_user=Depends(get_admin_user)):
+    """
+    Recount every pincode from the shelter, food and SOS tables now instead of
+    waiting for the periodic recount.
+    """
+    return {"detail": "Pincode stats recounted", "pincodes": await pincode_stats.reconcile()}
+
+
+@router.get("/upkeep", dependencies=[Depends(require_enabled)])
+def get_stats_upkeep(current_user=Depends(get_admin_user)):
+    """
+    Report pending changes, flushes and recounts of the pincode stats.
+    """
+    return pincode_stats.stats()
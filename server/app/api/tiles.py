@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends, HTTPException, Path, Request, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from app.utils import map_tiles
+from app.utils.dependencies import get_admin_user
+
+router = APIRouter()
+
+
+@router.get("/stats")
+def get_tile_cache_stats(current_user=Depends(get_admin_user)):
+    """
+    Report size, hit ratio, renders and invalidations of the map tile cache.
+    """
+    return map_tiles.tile_cache.stats()
+
+
+@router.get("/{layer}/{z}/{x}/{y}")
+async def get_tile(
+    request: Request,
+    layer: str,
+    z: int = Path(..., ge=0, le=map_tiles.TILE_MAX_ZOOM, description="Zoom level"),
+    x: int = Path(..., ge=0, description="Tile column, from the west"),
+    y: int = Path(..., ge=0, description="Tile row, from the north"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    One Web Mercator tile of shelters, food points or unresolved SOS alerts, with
+    nearby rows grouped into clusters below the cluster zoom. Compact JSON:
+    `points` and `clusters` are arrays whose columns are named in
+    `point_columns` and `cluster_columns`.
+    """
+    if layer not in map_tiles.LAYERS:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown layer: {layer}")
+    if x >= 1 << z or y >= 1 << z:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"No tile {x}/{y} at zoom {z}")
+
+    (etag, body), hit = await map_tiles.tile_cache.get(
+        (layer, z, x, y), lambda: map_tiles.render(db, layer, z, x, y)
+    )
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={map_tiles.TILE_MAX_AGE}",
+        "X-Cache": "HIT" if hit else "MISS",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
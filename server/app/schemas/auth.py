@@ -1,4 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, EmailStr
 
 class UserRegister(BaseModel):
     fullName: str
@@ -43,4 +45,20 @@ class EmailSchema(BaseModel):
     
 class ResetPassword(BaseModel):
     token: str
-    new_password: str
\ No newline at end of file
+    new_password: str
+
+class UserOut(BaseModel):
+    """Public view of a user; never includes the password hash."""
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    fullName: Optional[str] = None
+    email: str
+    phoneNumber: Optional[str] = None
+    is_verified: Optional[bool] = None
+    createdAt: datetime
+    address: Optional[str] = None
+    pincode: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    admin: Optional[bool] = None
@@ -0,0 +1,152 @@
+"""
+Response models for the location based layers and SOS alerts.
+
+Handlers return ORM rows (database path) or row dicts (spatial index path);
+`from_attributes` lets these models read either. Declaring them on the routes
+keeps serialization in pydantic-core instead of jsonable_encoder.
+"""
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class Row(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ShelterOut(Row):
+    id: int
+    name: Optional[str] = None
+    address: str
+    pincode: str
+    images: Optional[str] = None
+    derivatives: Optional[dict[str, str]] = None
+    description: Optional[str] = None
+    createdAt: datetime
+    updatedAt: datetime
+    latitude: float
+    longitude: float
+    userId: Optional[int] = None
+    distance: Optional[float] = None
+    capacity: Optional[int] = None
+    occupancy: Optional[int] = None
+
+
+class FoodOut(Row):
+    id: int
+    createdAt: datetime
+    latitude: float
+    longitude: float
+    address: str
+    pincode: str
+    description: Optional[str] = None
+    images: Optional[str] = None
+    derivatives: Optional[dict[str, str]] = None
+    userId: Optional[int] = None
+    distance: Optional[float] = None
+
+
+class NewsOut(Row):
+    id: int
+    title: str
+    description: str
+    createdAt: datetime
+    updatedAt: datetime
+    images: Optional[str] = None
+    derivatives: Optional[dict[str, str]] = None
+    userId: Optional[int] = None
+    latitude: float
+    longitude: float
+    distance: Optional[float] = None
+
+
+class SOSOut(Row):
+    id: int
+    createdAt: datetime
+    issue_rectified: Optional[bool] = None
+    latitude: float
+    longitude: float
+    persons: Optional[int] = None
+    userId: Optional[int] = None
+    resolved: Optional[bool] = None
+    pincode: Optional[str] = None  # the sender's
+    distance: Optional[float] = None  # only set for searches around a location
+
+
+class SOSClusterOut(BaseModel):
+    id: int  # lowest alert id in the cluster
+    latitude: float  # centroid
+    longitude: float
+    alerts: int
+    persons: int
+    startedAt: datetime
+    updatedAt: datetime
+    distance: Optional[float] = None  # from the query location to the centroid
+
+
+class SOSClusterList(BaseModel):
+    clusters: list[SOSClusterOut]
+    total: int
+
+
+class ShelterList(BaseModel):
+    shelters: list[ShelterOut]
+    total: Optional[int] = None
+
+
+class FoodList(BaseModel):
+    food: list[FoodOut]
+    total: Optional[int] = None
+
+
+class NewsList(BaseModel):
+    news: list[NewsOut]
+    count: int
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+
+class SOSList(BaseModel):
+    sos_alerts: list[SOSOut]
+    next_cursor: Optional[str] = None
+
+
+class LocationImport(BaseModel):
+    """One record of a bulk import; unknown columns are ignored."""
+    model_config = ConfigDict(coerce_numbers_to_str=True)  # pincodes often arrive as numbers
+
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    address: str = Field(min_length=1)
+    pincode: str = Field(min_length=1)
+    description: Optional[str] = None
+    images: Optional[str] = None
+
+    def to_columns(self, now, user_id):
+        return {**self.model_dump(), "createdAt": now, "userId": user_id}
+
+
+class ShelterImport(LocationImport):
+    name: str = Field(min_length=1)
+    capacity: Optional[int] = Field(None, ge=0)
+    occupancy: Optional[int] = Field(None, ge=0)
+
+    def to_columns(self, now, user_id):
+        return {**super().to_columns(now, user_id), "updatedAt": now}
+
+
+class FoodImport(LocationImport):
+    pass
+
+
+class ImportRowError(BaseModel):
+    row: Optional[int]
+    errors: list[str]
+
+
+class ImportSummary(BaseModel):
+    inserted: int
+    failed: int
+    errors: list[ImportRowError]
+    errors_truncated: bool
+    complete: bool
@@ -0,0 +1,22 @@
+"""
+Response models for the per-pincode summary table.
+"""
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, ConfigDict
+
+
+class PincodeStatsOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    pincode: str
+    shelters: int = 0
+    food: int = 0
+    sos_unresolved: int = 0
+    persons: int = 0  # reported by the unresolved SOS alerts
+    updatedAt: Optional[datetime] = None  # None when nothing was ever counted there
+
+
+class PincodeStatsList(BaseModel):
+    pincodes: list[PincodeStatsOut]
+    total: int
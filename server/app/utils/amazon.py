@@ -1,31 +1,147 @@
-import boto3
-from loguru import logger
+import asyncio
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from loguru import logger
 from dotenv import load_dotenv
+from app.utils import metrics
 
 load_dotenv()
 
 AWS_BUCKET = os.getenv("AWS_BUCKET")
+AWS_REGION = os.getenv("AWS_REGION")
+# Point at a local S3 stand-in (moto server, MinIO) instead of AWS
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")
 
-s3 = boto3.resource(
-    's3',
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
+S3_UPLOAD_WORKERS = int(os.getenv("S3_UPLOAD_WORKERS", "8"))
+S3_UPLOAD_QUEUE = int(os.getenv("S3_UPLOAD_QUEUE", "32"))  # uploads waiting or running
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8")) * 1024 * 1024
+S3_MULTIPART_CHUNK = int(os.getenv("S3_MULTIPART_CHUNK_MB", "5")) * 1024 * 1024  # S3 minimum
+
+# Files above the threshold go up as multipart uploads in parallel parts. Each
+# part in flight is buffered, so memory is bounded by
+# workers x max_concurrency x chunk size.
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNK,
+    max_concurrency=2,
+    use_threads=True,
 )
 
-bucket = s3.Bucket(AWS_BUCKET)
+_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+_slots = asyncio.Semaphore(S3_UPLOAD_QUEUE)
+_client = None
+_client_lock = threading.Lock()
+
+upload_latencies = deque(maxlen=1000)  # (key, bytes, seconds) of recent uploads
+
+
+def get_client():
+    """
+    Shared S3 client. botocore clients are thread-safe and keep a connection pool
+    sized for the upload workers, so connections are reused across uploads.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.client(
+                    "s3",
+                    region_name=AWS_REGION,
+                    endpoint_url=AWS_S3_ENDPOINT_URL,
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                    config=Config(
+                        max_pool_connections=S3_UPLOAD_WORKERS * transfer_config.max_request_concurrency,
+                        retries={"max_attempts": 3, "mode": "standard"},
+                    ),
+                )
+    return _client
+
+
+def reset_client():
+    """Drop the cached client, e.g. after changing credentials or endpoint in tests."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def object_url(key: str) -> str:
+    if AWS_S3_ENDPOINT_URL:
+        return f"{AWS_S3_ENDPOINT_URL.rstrip('/')}/{AWS_BUCKET}/{key}"
+    return f"https://{AWS_BUCKET}.s3.amazonaws.com/{key}"
+
 
-async def s3_upload(contents: bytes, key: str):
+def _upload(fileobj, key: str, content_type: str):
+    # s3transfer may close the file object, so measure it up front
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END) - position
+    fileobj.seek(position)
+
+    start = time.perf_counter()
     try:
-        bucket.put_object( 
-            Bucket=AWS_BUCKET,
-            Key=key,
-            Body=contents,
-            ContentType="image/jpeg",  # Ensures browser renders PDF
-            ContentDisposition="inline"  # Forces display instead of download
+        get_client().upload_fileobj(
+            fileobj,
+            AWS_BUCKET,
+            key,
+            ExtraArgs={
+                "ContentType": content_type,  # Ensures browser renders the image
+                "ContentDisposition": "inline",  # Forces display instead of download
+            },
+            Config=transfer_config,
         )
-        return f"https://{AWS_BUCKET}.s3.amazonaws.com/{key}"
-    except Exception as e:
-        logger.error(f"Error uploading file: {e}")
-        return None
\ No newline at end of file
+    except Exception:
+        metrics.s3_upload_seconds.observe(time.perf_counter() - start, "error")
+        raise
+    elapsed = time.perf_counter() - start
+    metrics.s3_upload_seconds.observe(elapsed, "ok")
+    upload_latencies.append((key, size, elapsed))
+    logger.info(f"Uploaded {key} ({size} bytes) in {elapsed * 1000:.1f} ms")
+
+
+def put_fileobj(fileobj, key: str, content_type: str = "image/jpeg"):
+    """Blocking upload for worker threads and processes. Returns the object URL."""
+    _upload(fileobj, key, content_type)
+    return object_url(key)
+
+
+def object_exists(key: str) -> bool:
+    try:
+        get_client().head_object(Bucket=AWS_BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+async def s3_object_exists(key: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, object_exists, key)
+
+
+async def s3_upload_fileobj(fileobj, key: str, content_type: str = "image/jpeg"):
+    """
+    Upload a readable binary file object without blocking the event loop. At most
+    S3_UPLOAD_QUEUE uploads are queued or running; callers beyond that wait for a
+    slot. Returns the object URL, or None if the upload failed.
+    """
+    async with _slots:
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(_executor, _upload, fileobj, key, content_type)
+            return object_url(key)
+        except Exception as e:
+            logger.error(f"Error uploading file: {e}")
+            return None
+
+
+async def s3_upload(contents: bytes, key: str, content_type: str = "image/jpeg"):
+    return await s3_upload_fileobj(BytesIO(contents), key, content_type)
@@ -1,11 +1,12 @@
-import bcrypt
 import jwt
 import os
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 from dotenv import load_dotenv
+from sqlalchemy import select
 from Model import Users as User
 from app.schemas.auth import RefreshToken
+from app.utils.passwords import hash_password, verify_password, needs_rehash
 
 load_dotenv()
 
@@ -13,13 +14,6 @@ SECRET_KEY = os.getenv("SECRET_KEY", "mysecret")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
-
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -39,11 +33,11 @@ def create_refresh_token(data: dict, expires_delta: timedelta = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def verify_refresh_token(refresh_token: RefreshToken, db):
+async def verify_refresh_token(refresh_token: RefreshToken, db):
       
     try:
         payload = jwt.decode(refresh_token.refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
-        user = db.query(User).filter(User.email == payload.get("sub")).first()
+        user = await db.scalar(select(User).where(User.email == payload.get("sub")).limit(1))
         return user
     except jwt.ExpiredSignatureError:
         return None
@@ -56,7 +50,7 @@ def create_verification_email(email: str):
     payload = {"sub": email, "exp": expire.timestamp()}
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
-def verify_verification_email(token: str, db):
+async def verify_verification_email(token: str, db):
     """Verify the email verification token"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -66,7 +60,7 @@ def verify_verification_email(token: str, db):
         if email is None:
             raise HTTPException(status_code=400, detail="Invalid token")
         
-        user = db.query(User).filter(User.email == email).first()
+        user = await db.scalar(select(User).where(User.email == email).limit(1))
         
         if user is None:
             raise HTTPException(status_code=400, detail="User not found")
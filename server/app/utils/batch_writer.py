@@ -0,0 +1,255 @@
+"""
+Write-behind batching for high-frequency inserts and updates.
+
+Handlers that only need a row written (an SOS alert, a new shelter, a user's
+last known coordinates) hand the column values to the BatchWriter for that
+model instead of doing add, commit and refresh on their own session. A
+background task collects what arrives within BATCH_FLUSH_MS, or until
+BATCH_MAX_ROWS are waiting, and writes it in one transaction: one executemany
+INSERT ... RETURNING id per set of columns and one executemany UPDATE per set of
+updated columns. Several updates of the same row within a batch collapse into
+one.
+
+`insert` and `update` return a future that resolves once the batch is
+committed (to the new id for inserts), so callers that must not answer before
+the row is durable await it. With wait=False the write is fire and forget.
+
+If a batch fails, each of its writes is retried in its own transaction, so one
+bad row only fails its own caller. `stop` lets a flush in progress finish, then
+writes whatever is still queued, so nothing queued before shutdown is lost. With BATCH_WRITES_ENABLED=false every write
+is committed on its own as soon as it is queued.
+"""
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from loguru import logger
+from sqlalchemy import bindparam, insert, update
+from database import AsyncSessionLocal
+from Model import SOS, FoodProvidingRegions, News, Shelters, Users
+
+load_dotenv()
+
+BATCH_WRITES_ENABLED = os.getenv("BATCH_WRITES_ENABLED", "true").lower() == "true"
+BATCH_FLUSH_MS = float(os.getenv("BATCH_FLUSH_MS", "10"))
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "500"))
+
+
+class BatchWriter:
+    def __init__(self, model, flush_ms=BATCH_FLUSH_MS, max_rows=BATCH_MAX_ROWS, session_factory=AsyncSessionLocal):
+        self.model = model
+        self.flush_ms = flush_ms
+        self.max_rows = max_rows
+        self.session_factory = session_factory
+        self.batching = BATCH_WRITES_ENABLED
+        self._direct = set()  # unbatched writes in progress
+        self._inserts = []  # (values, future)
+        self._updates = {}  # row id -> (values, [futures])
+        self._queued = None
+        self._full = None
+        self._task = None
+        self._stopping = False
+        self.inserted = 0
+        self.updated = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.failed_writes = 0
+        self.largest_batch = 0
+        self.last_flush_seconds = None
+
+    def __len__(self):
+        return len(self._inserts) + len(self._updates)
+
+    def _future(self, wait):
+        if not wait:
+            return None
+        return asyncio.get_running_loop().create_future()
+
+    def _queue(self):
+        if self._stopping:
+            return  # stop() writes it
+        if self._task is None or self._task.done():
+            self.start()
+        self._queued.set()
+        if len(self) >= self.max_rows:
+            self._full.set()
+
+    def _write_now(self, inserts, updates):
+        task = asyncio.create_task(self._write_each(inserts, updates))
+        self._direct.add(task)
+        task.add_done_callback(self._direct.discard)
+
+    def insert(self, values, wait=True):
+        """Queue a new row. Returns a future of its id, or None with wait=False."""
+        future = self._future(wait)
+        if not self.batching:
+            self._write_now([(values, future)], {})
+            return future
+        self._inserts.append((values, future))
+        self._queue()
+        return future
+
+    def update(self, row_id, values, wait=True):
+        """Queue new values for an existing row. Returns a future, or None with wait=False."""
+        future = self._future(wait)
+        if not self.batching:
+            self._write_now([], {row_id: (values, [future] if future else [])})
+            return future
+        queued, futures = self._updates.get(row_id, ({}, []))
+        self._updates[row_id] = ({**queued, **values}, futures + [future] if future else futures)
+        self._queue()
+        return future
+
+    async def _write(self, db, inserts, updates):
+        """Execute a batch on `db`. Returns the new ids in the order of `inserts`."""
+        ids = [None] * len(inserts)
+        # executemany needs the same columns in every parameter set
+        groups = {}
+        for position, (values, _) in enumerate(inserts):
+            groups.setdefault(tuple(sorted(values)), []).append(position)
+        statement = insert(self.model).returning(self.model.id, sort_by_parameter_order=True)
+        for positions in groups.values():
+            new_ids = (await db.scalars(statement, [inserts[position][0] for position in positions])).all()
+            for position, row_id in zip(positions, new_ids):
+                ids[position] = row_id
+
+        table = self.model.__table__
+        groups = {}
+        for row_id, (values, _) in updates.items():
+            groups.setdefault(tuple(sorted(values)), []).append(dict(values, row_id=row_id))
+        for columns, rows in groups.items():
+            await db.execute(
+                update(table)
+                .where(table.c.id == bindparam("row_id"))
+                .values({column: bindparam(column) for column in columns}),
+                rows,
+            )
+        await db.commit()
+        return ids
+
+    async def flush(self):
+        """Write everything queued. Returns the number of writes committed."""
+        inserts, self._inserts = self._inserts, []
+        updates, self._updates = self._updates, {}
+        if not inserts and not updates:
+            return 0
+        started = time.perf_counter()
+        try:
+            async with self.session_factory() as db:
+                ids = await self._write(db, inserts, updates)
+        except Exception as e:
+            self.failed_batches += 1
+            logger.warning(f"Batch of {len(inserts) + len(updates)} {self.model.__tablename__} writes failed, retrying one by one: {e}")
+            written = await self._write_each(inserts, updates)
+        else:
+            for (_, future), row_id in zip(inserts, ids):
+                if future is not None and not future.done():
+                    future.set_result(row_id)
+            for _, futures in updates.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(None)
+            written = len(inserts) + len(updates)
+            self.inserted += len(inserts)
+            self.updated += len(updates)
+
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(inserts) + len(updates))
+        self.last_flush_seconds = time.perf_counter() - started
+        return written
+
+    async def _write_each(self, inserts, updates):
+        written = 0
+        for entry in [([entry], {}) for entry in inserts] + [([], {row_id: entry}) for row_id, entry in updates.items()]:
+            futures = [future for _, future in entry[0]] + [future for _, fs in entry[1].values() for future in fs]
+            try:
+                async with self.session_factory() as db:
+                    ids = await self._write(db, *entry)
+            except Exception as e:
+                self.failed_writes += 1
+                logger.error(f"Could not write {self.model.__tablename__} row: {e}")
+                for future in futures:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                continue
+            written += 1
+            self.inserted += len(entry[0])
+            self.updated += len(entry[1])
+            for future in futures:
+                if future is not None and not future.done():
+                    future.set_result(ids[0] if ids else None)
+        return written
+
+    async def run(self):
+        while not self._stopping:
+            await self._queued.wait()
+            if not self._stopping and len(self) < self.max_rows and self.flush_ms > 0:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            self._queued.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"{self.model.__tablename__} batch writer failed")
+
+    def start(self):
+        """Start flushing on the running event loop."""
+        self._queued = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Finish the flush in progress, write everything still queued and stop."""
+        self._stopping = True
+        try:
+            if self._task is not None:
+                # Wake run() from its waits; it exits after its current flush
+                self._queued.set()
+                self._full.set()
+                await self._task
+                self._task = None
+            while len(self):
+                await self.flush()
+            if self._direct:
+                await asyncio.gather(*self._direct)
+        finally:
+            self._stopping = False
+
+    def stats(self):
+        return {
+            "table": self.model.__tablename__,
+            "batching": self.batching,
+            "queued": len(self),
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "batches": self.batches,
+            "largest_batch": self.largest_batch,
+            "failed_batches": self.failed_batches,
+            "failed_writes": self.failed_writes,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+sos_writer = BatchWriter(SOS)
+user_writer = BatchWriter(Users)
+shelter_writer = BatchWriter(Shelters)
+food_writer = BatchWriter(FoodProvidingRegions)
+news_writer = BatchWriter(News)
+
+WRITERS = (sos_writer, user_writer, shelter_writer, food_writer, news_writer)
+
+
+async def stop():
+    """Flush and stop every writer."""
+    for writer in WRITERS:
+        await writer.stop()
+
+
+def stats():
+    return {writer.model.__tablename__: writer.stats() for writer in WRITERS}
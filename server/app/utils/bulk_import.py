@@ -0,0 +1,315 @@
+"""
+Bulk import of location rows (shelters, food regions) from CSV, JSON lines or
+GeoJSON uploads.
+
+The upload is parsed as a stream: records are read from the spooled upload file
+in batches of IMPORT_BATCH_SIZE on a worker thread, validated one by one
+against a pydantic schema, and each batch of valid rows goes to the database as
+one executemany INSERT ... RETURNING id and one commit. A row that fails
+validation is reported with its row number and does not stop the import.
+
+The spatial index and the response cache are updated once, after the last
+batch, rather than once per row.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from itertools import islice
+from fastapi import HTTPException, UploadFile, status
+from loguru import logger
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+from app.utils import spatial_index, response_cache, map_tiles
+from app.utils.pincode_stats import LAYERS, pincode_stats
+
+load_dotenv()
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+
+FORMATS = ("csv", "jsonl", "geojson")
+
+
+class RowError(Exception):
+    """A record that could not be parsed into a dict."""
+
+
+def detect_format(upload: UploadFile, requested=None):
+    """Pick the format from the query, then the file extension, then the content type."""
+    if requested:
+        if requested not in FORMATS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unsupported format {requested!r}, expected one of {', '.join(FORMATS)}",
+            )
+        return requested
+    name = (upload.filename or "").lower()
+    content_type = (upload.content_type or "").lower()
+    if name.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if name.endswith((".jsonl", ".ndjson")) or "ndjson" in content_type or "jsonl" in content_type:
+        return "jsonl"
+    if name.endswith((".geojson", ".geojsonl", ".geojsons")) or "geo+json" in content_type or "geo+json-seq" in content_type:
+        return "geojson"
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Cannot tell the file format; pass format=csv, jsonl or geojson",
+    )
+
+
+def _text(binary):
+    # utf-8-sig drops the byte order mark spreadsheet exports like to add
+    return io.TextIOWrapper(binary, encoding="utf-8-sig", newline="")
+
+
+def _csv_records(text):
+    reader = csv.DictReader(text)
+    for record in reader:
+        if None in record:
+            yield reader.line_num, RowError("More values than header columns")
+            continue
+        yield reader.line_num, {key.strip(): ((value or "").strip() or None) for key, value in record.items() if key}
+
+
+def _jsonl_records(text):
+    for number, line in enumerate(text, start=1):
+        line = line.strip().lstrip("\x1e")  # RFC 8142 record separator
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, RowError(f"Invalid JSON: {e}")
+            continue
+        yield number, record
+
+
+def _feature_to_record(feature):
+    """Flatten a GeoJSON Point feature into a row dict."""
+    if not isinstance(feature, dict) or feature.get("type") != "Feature":
+        raise RowError("Not a GeoJSON Feature")
+    geometry = feature.get("geometry") or {}
+    coordinates = geometry.get("coordinates")
+    if geometry.get("type") != "Point" or not isinstance(coordinates, list) or len(coordinates) < 2:
+        raise RowError("Feature geometry must be a Point")
+    record = dict(feature.get("properties") or {})
+    # GeoJSON positions are [longitude, latitude]
+    record["longitude"], record["latitude"] = coordinates[0], coordinates[1]
+    return record
+
+
+class _JSONStream:
+    """
+    Minimal pull parser over a text stream for the top level of a GeoJSON
+    document, so a FeatureCollection's features can be decoded one at a time.
+    """
+
+    def __init__(self, text, chunk_size=64 * 1024):
+        self.text = text
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.text.read(self.chunk_size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+
+    def peek(self):
+        """Next non-whitespace character, or "" at the end of the stream."""
+        # str.isspace also covers the RS separator of GeoJSON text sequences
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.position}")
+        self.position += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number may continue in the next chunk
+            if end == len(self.buffer) and isinstance(value, (int, float)):
+                start = self.position
+                if self._fill():
+                    continue
+                end -= start
+            self.position = end
+            return value
+
+
+def _feature(number, feature):
+    try:
+        return number, _feature_to_record(feature)
+    except RowError as e:
+        return number, e
+
+
+def _geojson_records(text):
+    """
+    Yield the features of a FeatureCollection one at a time. A sequence of
+    Feature objects (GeoJSON text sequences or newline-delimited features) is
+    accepted too.
+    """
+    stream = _JSONStream(text)
+    number = 0
+    while stream.peek():
+        stream.expect("{")
+        members = {}
+        while stream.peek() != "}":
+            key = stream.value()
+            stream.expect(":")
+            if key == "features":
+                stream.expect("[")
+                while stream.peek() != "]":
+                    number += 1
+                    yield _feature(number, stream.value())
+                    if stream.peek() == ",":
+                        stream.expect(",")
+                stream.expect("]")
+            else:
+                members[key] = stream.value()
+            if stream.peek() == ",":
+                stream.expect(",")
+        stream.expect("}")
+
+        if members.get("type") == "Feature":
+            number += 1
+            yield _feature(number, members)
+        elif members.get("type") != "FeatureCollection":
+            raise ValueError(f"Unsupported GeoJSON type {members.get('type')!r}")
+
+
+READERS = {"csv": _csv_records, "jsonl": _jsonl_records, "geojson": _geojson_records}
+
+
+def read_records(binary, fmt):
+    """Yield (row number, dict or RowError) from a binary file object."""
+    text = _text(binary)
+    try:
+        yield from READERS[fmt](text)
+    finally:
+        # Leave the upload's file open for FastAPI to close
+        text.detach()
+
+
+def _next_batch(records, size):
+    """Up to `size` records, and the parse error that cut the stream short, if any."""
+    batch = []
+    try:
+        for record in islice(records, size):
+            batch.append(record)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return batch, f"Could not parse the rest of the upload: {e}"
+    return batch, None
+
+
+def _validation_messages(error: ValidationError):
+    return [
+        f"{'.'.join(str(part) for part in item['loc']) or 'row'}: {item['msg']}"
+        for item in error.errors()
+    ]
+
+
+async def import_rows(db, model, schema, upload: UploadFile, fmt, user_id):
+    """
+    Validate and insert every record of `upload` into `model`'s table. `schema`
+    validates one record and maps it to column values with `to_columns`.
+
+    Returns a summary with the number of inserted and failed rows and up to
+    MAX_REPORTED_ERRORS per-row errors as {"row": number, "errors": [...]}. If the
+    file itself stops parsing, the rows before that point are kept, the error is
+    reported with row None and `complete` is false.
+    """
+    records = read_records(upload.file, fmt)
+    summary = {"inserted": 0, "failed": 0, "errors": [], "complete": True}
+    indexed = spatial_index.get_index(model) is not None
+    new_rows = []
+    positions = set()
+    counted = LAYERS.get(model)
+    statement = insert(model).returning(model.id, sort_by_parameter_order=True)
+
+    def reject(number, messages):
+        summary["failed"] += 1
+        if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+            summary["errors"].append({"row": number, "errors": messages})
+
+    async def flush(numbers, values):
+        try:
+            ids = (await db.scalars(statement, values)).all()
+            await db.commit()
+        except SQLAlchemyError as e:
+            await db.rollback()
+            logger.warning(f"Bulk import batch into {model.__tablename__} failed: {e}")
+            for number in numbers:
+                reject(number, ["Database rejected the batch this row was in"])
+            return
+        summary["inserted"] += len(ids)
+        for row_id, row in zip(ids, values):
+            positions.add((row["latitude"], row["longitude"]))
+            if counted:
+                pincode_stats.record(row["pincode"], **{counted: 1})
+            if indexed:
+                new_rows.append(dict(row, id=row_id))
+
+    while True:
+        batch, parse_error = await run_in_threadpool(_next_batch, records, IMPORT_BATCH_SIZE)
+
+        numbers, values = [], []
+        now = datetime.now()
+        for number, record in batch:
+            if isinstance(record, RowError):
+                reject(number, [str(record)])
+                continue
+            if not isinstance(record, dict):
+                reject(number, ["Record must be an object"])
+                continue
+            try:
+                row = schema.model_validate(record)
+            except ValidationError as e:
+                reject(number, _validation_messages(e))
+                continue
+            numbers.append(number)
+            values.append(row.to_columns(now, user_id))
+        if values:
+            await flush(numbers, values)
+
+        if parse_error:
+            summary["complete"] = False
+            summary["errors"].append({"row": None, "errors": [parse_error]})
+            break
+        if len(batch) < IMPORT_BATCH_SIZE:
+            break
+    records.close()
+
+    # One index and cache update for the whole import
+    spatial_index.insert_many(model, new_rows)
+    if positions:
+        await response_cache.invalidate(model, *positions)
+        map_tiles.invalidate(model, *positions)
+
+    logger.info(
+        f"Imported {summary['inserted']} rows into {model.__tablename__}, {summary['failed']} rejected"
+    )
+    summary["errors_truncated"] = summary["failed"] > MAX_REPORTED_ERRORS
+    return summary
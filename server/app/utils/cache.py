@@ -0,0 +1,168 @@
+"""
+Cache building blocks.
+
+`TTLCache` is the in-process LRU-with-expiry used by the auth and response
+caches. Cache backends give the response cache one async interface over
+either that in-process LRU or a shared store, so several workers can share
+entries and invalidations:
+
+    get(key) -> bytes | None      set(key, value, ttl)
+    get_many(keys) -> list        incr(key) -> int
+
+Select one with RESPONSE_CACHE_BACKEND=memory (default) or redis, plus
+REDIS_URL. The redis backend needs the `redis` package.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+MAX_ENTRY_TTL = 24 * 3600
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_matching(self, predicate):
+        """Drop every entry whose key satisfies `predicate`. Returns how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class MemoryBackend:
+    """Per-process LRU. Counters are plain dict entries and never evicted."""
+
+    name = "memory"
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.entries = TTLCache(maxsize, MAX_ENTRY_TTL)
+        self.counters = {}
+
+    async def get(self, key):
+        return self.entries.get(key)
+
+    async def get_many(self, keys):
+        return [self.counters.get(key, 0) for key in keys]
+
+    async def set(self, key, value, ttl):
+        self.entries.set(key, value, ttl)
+
+    async def incr(self, key):
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+    def stats(self):
+        return {"backend": self.name, **self.entries.stats()}
+
+
+class RedisBackend:
+    """Shared backend on Redis; entries expire by TTL and eviction is left to Redis."""
+
+    name = "redis"
+
+    def __init__(self, url=REDIS_URL, client=None):
+        if client is None:
+            try:
+                from redis import asyncio as redis
+            except ImportError:
+                raise RuntimeError("RESPONSE_CACHE_BACKEND=redis needs the redis package")
+            client = redis.from_url(url)
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        value = await self.client.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def get_many(self, keys):
+        return [int(value or 0) for value in await self.client.mget(keys)]
+
+    async def set(self, key, value, ttl):
+        await self.client.set(key, value, ex=max(1, int(ttl)))
+
+    async def incr(self, key):
+        return await self.client.incr(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+def create_backend(name=RESPONSE_CACHE_BACKEND):
+    if name == "memory":
+        return MemoryBackend()
+    if name == "redis":
+        return RedisBackend()
+    raise ValueError(f"Unknown cache backend: {name}")
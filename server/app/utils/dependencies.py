@@ -3,10 +3,11 @@ from fastapi.security import OAuth2PasswordBearer
 import jwt
 import os
 from dotenv import load_dotenv
-from database import get_db
-from sqlalchemy.orm import Session
+from database import get_async_db
+from sqlalchemy.ext.asyncio import AsyncSession
 from Model import Users as User
 from typing import Optional
+from app.utils import user_cache
 
 load_dotenv()
 
@@ -16,52 +17,69 @@ ALGORITHM = "HS256"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    
-    print(token)
-    
+
+def decode_email(token: str):
+    """
+    Email a token was issued for, from the claims cache or by decoding it.
+    Raises jwt.InvalidTokenError (incl. ExpiredSignatureError) for bad tokens.
+    """
+    email = user_cache.claims.get(token)
+    if email is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email = payload.get("sub")  # Extract email from token
+        user_cache.cache_claims(token, payload)
+    return email
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """
+    Returns a read-only UserSnapshot of the authenticated user; rows are cached
+    in app.utils.user_cache, so most requests don't touch the database.
+    """
     if not token:
         raise HTTPException(status_code=401, detail="Authentication token is required")
 
     try:
-        # Decode the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")  # Extract email from token
+        email = decode_email(token)
         
         if not email:
             raise HTTPException(status_code=401, detail="Invalid authentication token")
 
-        # Query the user
-        user = db.query(User).filter(User.email == email).first()
+        # Look up the user
+        user = await user_cache.get_user(email, db)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        return user  # You can return a dict or Pydantic model instead
+        return user
 
     except:  
-        print(token)
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def get_user_or_none(token: Optional[str] = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_admin_user(current_user: User = Depends(get_current_user)):
+    """
+    Returns the current user if they are an admin, otherwise raises 403.
+    """
+    if not current_user.admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+
+async def get_user_or_none(token: Optional[str] = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     """
     Returns user if a valid token is provided, otherwise returns "No token provided".
     """
-    
-    print(token)
     if not token:
         return {"message": "No token provided"}
 
     try:
-        # Decode JWT token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")  # Extract email from token
+        email = decode_email(token)
 
         if not email:
             return {"message": "Invalid token"}
 
-        # Query the user
-        user = db.query(User).filter(User.email == email).first()
+        # Look up the user
+        user = await user_cache.get_user(email, db)
         if not user:
             return {"message": "User not found"}
 
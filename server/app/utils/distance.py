@@ -0,0 +1,81 @@
+"""
+Great-circle distance helpers shared by every router.
+
+`haversine` is the scalar form for single pairs. For many points, build a
+`Points` set once (contiguous float64 arrays with the radians conversions cached)
+and use the vectorized `distances` / `within_radius` kernels.
+"""
+from math import radians, sin, cos, sqrt, asin
+import numpy as np
+
+EARTH_RADIUS_KM = 6371  # Earth radius in km
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Haversine formula to calculate the distance (in km) between two latitude-longitude points.
+    """
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(min(a, 1.0)))  # Distance in km
+
+
+class Points:
+    """
+    A batch of coordinates stored as contiguous float64 arrays, with the radians
+    and cosine of latitude computed once so repeated queries only pay for the
+    distance kernel itself.
+    """
+
+    __slots__ = ("latitudes", "longitudes", "lat_rad", "lon_rad", "cos_lat")
+
+    def __init__(self, latitudes, longitudes):
+        self.latitudes = np.ascontiguousarray(latitudes, dtype=np.float64)
+        self.longitudes = np.ascontiguousarray(longitudes, dtype=np.float64)
+        if self.latitudes.shape != self.longitudes.shape:
+            raise ValueError("latitudes and longitudes must have the same shape")
+        self.lat_rad = np.radians(self.latitudes)
+        self.lon_rad = np.radians(self.longitudes)
+        self.cos_lat = np.cos(self.lat_rad)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a point set from objects with latitude/longitude attributes."""
+        count = len(rows)
+        latitudes = np.fromiter((row.latitude for row in rows), dtype=np.float64, count=count)
+        longitudes = np.fromiter((row.longitude for row in rows), dtype=np.float64, count=count)
+        return cls(latitudes, longitudes)
+
+    def __len__(self):
+        return len(self.latitudes)
+
+
+def distances(points, latitude, longitude):
+    """
+    Distances in km from (latitude, longitude) to every point, as a float64 array.
+    """
+    lat0 = radians(latitude)
+    lon0 = radians(longitude)
+
+    a = np.sin((points.lat_rad - lat0) * 0.5)
+    np.square(a, out=a)
+    b = np.sin((points.lon_rad - lon0) * 0.5)
+    np.square(b, out=b)
+    b *= points.cos_lat
+    b *= cos(lat0)
+    a += b
+
+    np.minimum(a, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * EARTH_RADIUS_KM
+    return a
+
+
+def within_radius(points, center, radius_km):
+    """
+    Boolean mask of the points lying within `radius_km` of `center`, a
+    (latitude, longitude) pair.
+    """
+    return distances(points, center[0], center[1]) <= radius_km
@@ -0,0 +1,112 @@
+from math import radians, degrees, sin, cos, sqrt, atan2, asin, pi
+import numpy as np
+from sqlalchemy import and_, or_, func
+from app.utils.distance import EARTH_RADIUS_KM, Points, distances
+
+KM_PER_DEGREE_LAT = 111.195  # Length of one degree of latitude in km
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Return (min_lat, max_lat, min_lon, max_lon) of a box that fully contains the
+    circle of `radius_km` around the point. Longitudes may fall outside [-180, 180]
+    when the circle crosses the antimeridian; `bbox_filter` handles the wrap.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    min_lat = max(latitude - dlat, -90.0)
+    max_lat = min(latitude + dlat, 90.0)
+
+    # Near the poles the circle covers every longitude
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        return min_lat, max_lat, -180.0, 180.0
+
+    ratio = sin(radians(dlat)) / cos(radians(latitude))
+    if ratio >= 1:
+        return min_lat, max_lat, -180.0, 180.0
+
+    dlon = degrees(atan2(ratio, sqrt(1 - ratio ** 2)))
+    return min_lat, max_lat, longitude - dlon, longitude + dlon
+
+
+def bbox_filter(model, latitude, longitude, radius_km):
+    """
+    SQL filter restricting `model` rows to the bounding box around the point, so the
+    indexed latitude/longitude columns do the coarse work.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    lat_filter = model.latitude.between(min_lat, max_lat)
+
+    if min_lon <= -180.0 and max_lon >= 180.0:
+        return lat_filter
+    if min_lon < -180.0:
+        lon_filter = or_(model.longitude >= min_lon + 360, model.longitude <= max_lon)
+    elif max_lon > 180.0:
+        lon_filter = or_(model.longitude >= min_lon, model.longitude <= max_lon - 360)
+    else:
+        lon_filter = model.longitude.between(min_lon, max_lon)
+
+    return and_(lat_filter, lon_filter)
+
+
+def haversine_term(model, latitude, longitude):
+    """
+    SQL expression for the haversine term `a` between the point and each row. It
+    grows monotonically with distance, so it can filter and order rows in the
+    database without needing asin; `term_to_km` converts it back to km.
+    """
+    lat0 = radians(latitude)
+    lon0 = radians(longitude)
+    row_lat = func.radians(model.latitude)
+    row_lon = func.radians(model.longitude)
+    return (
+        func.power(func.sin((row_lat - lat0) / 2), 2)
+        + cos(lat0) * func.cos(row_lat) * func.power(func.sin((row_lon - lon0) / 2), 2)
+    )
+
+
+def distance_km_term(model, latitude, longitude):
+    """SQL expression for the great-circle distance in km between the point and each row."""
+    return 2 * EARTH_RADIUS_KM * func.asin(func.sqrt(haversine_term(model, latitude, longitude)))
+
+
+def radius_term_limit(radius_km):
+    """Largest haversine term that still lies within `radius_km`."""
+    return sin(min(radius_km / (2 * EARTH_RADIUS_KM), pi / 2)) ** 2
+
+
+def term_to_km(term):
+    """Convert a haversine term computed by the database into km."""
+    return 2 * EARTH_RADIUS_KM * asin(sqrt(min(max(term, 0.0), 1.0)))
+
+
+def radius_filter(model, latitude, longitude, radius_km):
+    """
+    Exact radius filter evaluated by the database. The bounding box comes first so
+    the coordinate indexes narrow the rows before any trigonometry runs.
+    """
+    return and_(
+        bbox_filter(model, latitude, longitude, radius_km),
+        haversine_term(model, latitude, longitude) <= radius_term_limit(radius_km),
+    )
+
+
+async def nearby(db, statement, model, latitude, longitude, radius_km, limit=None, offset=0):
+    """
+    Run the select `statement` restricted to the bounding box around the point and
+    compute exact distances only for the candidates.
+
+    Returns (rows, total) where rows is the requested page of (row, distance) pairs
+    sorted by distance and total is the number of rows inside the radius.
+    """
+    result = await db.execute(statement.where(bbox_filter(model, latitude, longitude, radius_km)))
+    candidates = result.scalars().all()
+    if not candidates:
+        return [], 0
+
+    candidate_distances = distances(Points.from_rows(candidates), latitude, longitude)
+    inside = np.flatnonzero(candidate_distances <= radius_km)
+    order = inside[np.argsort(candidate_distances[inside], kind="stable")]
+
+    total = len(order)
+    end = offset + limit if limit is not None else None
+    return [(candidates[i], float(candidate_distances[i])) for i in order[offset:end]], total
@@ -0,0 +1,108 @@
+"""
+Post-upload image processing.
+
+Originals are stored under their SHA-256 (images/<digest>.<ext>), so the same
+photo uploaded twice is stored once. Each new original gets derivatives, a small
+WebP thumbnail for list cards and a bounded full-size WebP. They are rendered in
+a process pool after the request has returned. Their URLs are deterministic, so
+they are saved with the row immediately; until the worker finishes, clients fall
+back to the original in `images`. If the worker fails, app.utils.uploads clears
+the URLs again.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from loguru import logger
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+from app.utils import amazon
+
+load_dotenv()
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+STORAGE_PREFIX = "images"
+
+# name -> (longest side in px, WebP quality)
+DERIVATIVES = {
+    "thumbnail": (320, 75),
+    "webp": (1600, 82),
+}
+LAST_DERIVATIVE = list(DERIVATIVES)[-1]  # written last by process_image
+
+_pool = None
+
+
+def original_key(digest: str, extension: str) -> str:
+    return f"{STORAGE_PREFIX}/{digest}{extension}"
+
+
+def derivative_key(digest: str, name: str) -> str:
+    return f"{STORAGE_PREFIX}/{digest}_{name}.webp"
+
+
+def derivative_urls(digest: str, folder: str = None) -> dict:
+    """URLs (S3) or paths (local `folder`) the derivatives of `digest` are stored at."""
+    if folder is not None:
+        return {name: f"{folder}/{digest}_{name}.webp" for name in DERIVATIVES}
+    return {name: amazon.object_url(derivative_key(digest, name)) for name in DERIVATIVES}
+
+
+def render(source_path: str, max_side: int, quality: int) -> BytesIO:
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format="WEBP", quality=quality, method=4)
+    output.seek(0)
+    return output
+
+
+def process_image(source_path: str, digest: str, folder: str = None, keep_source: bool = False):
+    """
+    Render every derivative of an original and store it in S3, or in the local
+    `folder`. Runs in the worker pool; removes the source afterwards (a staged
+    copy) unless `keep_source`.
+    """
+    try:
+        for name, (max_side, quality) in DERIVATIVES.items():
+            output = render(source_path, max_side, quality)
+            if folder is not None:
+                with open(f"{folder}/{digest}_{name}.webp", "wb") as target:
+                    target.write(output.getbuffer())
+            else:
+                amazon.put_fileobj(output, derivative_key(digest, name), "image/webp")
+        return digest
+    finally:
+        if not keep_source:
+            os.remove(source_path)
+
+
+def _log_result(future):
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error(f"Image derivative generation failed: {error}")
+
+
+def submit(source_path: str, digest: str, folder: str = None, keep_source: bool = False):
+    """Queue derivative generation for an original without waiting for it."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    future = asyncio.get_running_loop().run_in_executor(_pool, process_image, source_path, digest, folder, keep_source)
+    future.add_done_callback(_log_result)
+    return future
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
@@ -0,0 +1,315 @@
+"""
+Background mail dispatcher.
+
+Handlers call `enqueue_email`, which writes the message to the mail_outbox
+table and returns straight away; nothing waits on SMTP in the request path.
+A single dispatcher task per worker claims due messages in batches and sends
+them over one pooled SMTP connection. It retries failures with exponential
+backoff and keeps queue depth and delivery latency metrics. Because the outbox
+lives in the database, pending messages survive restarts.
+
+Claims are leases: a message is claimed by pushing its nextAttemptAt forward, so
+several workers can share the outbox and a crashed send is retried once the
+lease expires. Delivery is at-least-once.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+import aiosmtplib
+from loguru import logger
+from sqlalchemy import update
+from starlette.concurrency import run_in_threadpool
+from dotenv import load_dotenv
+from database import SessionLocal
+from Model import MailOutbox
+from app.config import conf
+from app.utils import metrics
+
+load_dotenv()
+
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "6"))
+MAIL_RETRY_BASE_SECONDS = float(os.getenv("MAIL_RETRY_BASE_SECONDS", "30"))
+MAIL_LEASE_SECONDS = int(os.getenv("MAIL_LEASE_SECONDS", "300"))
+MAIL_POLL_SECONDS = float(os.getenv("MAIL_POLL_SECONDS", "30"))
+MAIL_IDLE_SECONDS = float(os.getenv("MAIL_IDLE_SECONDS", "30"))  # close idle SMTP connections
+
+
+def default_smtp_options():
+    return {
+        "hostname": conf.MAIL_SERVER,
+        "port": conf.MAIL_PORT,
+        "username": conf.MAIL_USERNAME if conf.USE_CREDENTIALS else None,
+        "password": conf.MAIL_PASSWORD.get_secret_value() if conf.USE_CREDENTIALS else None,
+        "start_tls": conf.MAIL_STARTTLS,
+        "use_tls": conf.MAIL_SSL_TLS,
+        "timeout": conf.TIMEOUT,
+    }
+
+
+class MailDispatcher:
+    def __init__(self, session_factory=SessionLocal, smtp_options=None, sender=None):
+        self.session_factory = session_factory
+        self.smtp_options = smtp_options or default_smtp_options()
+        self.sender = sender or conf.MAIL_FROM
+        self._smtp = None
+        self._last_used = 0.0
+        self._wakeup = None
+        self._loop = None
+        self._task = None
+        self._inflight = []  # ids of claimed messages not yet recorded
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=1000)  # seconds from enqueue to delivery
+
+    # -- producer side ----------------------------------------------------
+
+    async def enqueue(self, db, subject, recipients, body, subtype="html"):
+        """Persist a message for delivery (on an AsyncSession) and wake the dispatcher. Returns its id."""
+        now = datetime.utcnow()
+        message = MailOutbox(
+            recipients=list(recipients),
+            subject=subject,
+            body=body,
+            subtype=subtype,
+            status="pending",
+            attempts=0,
+            createdAt=now,
+            nextAttemptAt=now,
+        )
+        db.add(message)
+        await db.commit()
+        self.wake()
+        return message.id
+
+    def wake(self):
+        """Tell the dispatcher new mail is due. Safe to call from any thread."""
+        if self._loop is not None and self._wakeup is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # -- outbox access (runs in the threadpool) ---------------------------
+
+    def _claim_batch(self):
+        now = datetime.utcnow()
+        lease = now + timedelta(seconds=MAIL_LEASE_SECONDS)
+        db = self.session_factory()
+        try:
+            due = (
+                db.query(MailOutbox.id, MailOutbox.nextAttemptAt)
+                .filter(MailOutbox.status == "pending", MailOutbox.nextAttemptAt <= now)
+                .order_by(MailOutbox.nextAttemptAt)
+                .limit(MAIL_BATCH_SIZE)
+                .all()
+            )
+            claimed = []
+            for message_id, next_attempt in due:
+                # Only one worker wins the conditional update for a given row
+                result = db.execute(
+                    update(MailOutbox)
+                    .where(MailOutbox.id == message_id, MailOutbox.nextAttemptAt == next_attempt)
+                    .values(nextAttemptAt=lease)
+                )
+                if result.rowcount == 1:
+                    claimed.append(message_id)
+            db.commit()
+            if not claimed:
+                return []
+            return [
+                {
+                    "id": row.id,
+                    "recipients": row.recipients,
+                    "subject": row.subject,
+                    "body": row.body,
+                    "subtype": row.subtype,
+                    "attempts": row.attempts,
+                    "createdAt": row.createdAt,
+                }
+                for row in db.query(MailOutbox).filter(MailOutbox.id.in_(claimed))
+            ]
+        finally:
+            db.close()
+
+    def _record(self, delivered, failures):
+        now = datetime.utcnow()
+        db = self.session_factory()
+        try:
+            if delivered:
+                db.execute(
+                    update(MailOutbox)
+                    .where(MailOutbox.id.in_(delivered))
+                    .values(status="sent", sentAt=now, lastError=None)
+                )
+            for message_id, attempts, error in failures:
+                if attempts >= MAIL_MAX_ATTEMPTS:
+                    values = {"status": "failed"}
+                else:
+                    delay = MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                    values = {"nextAttemptAt": now + timedelta(seconds=delay)}
+                db.execute(
+                    update(MailOutbox)
+                    .where(MailOutbox.id == message_id)
+                    .values(attempts=attempts, lastError=error[:500], **values)
+                )
+            db.commit()
+        finally:
+            db.close()
+
+    def _release(self, message_ids):
+        """Hand claimed messages back so the next dispatcher sends them straight away."""
+        db = self.session_factory()
+        try:
+            db.execute(
+                update(MailOutbox)
+                .where(MailOutbox.id.in_(message_ids), MailOutbox.status == "pending")
+                .values(nextAttemptAt=datetime.utcnow())
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def _next_due_in(self):
+        db = self.session_factory()
+        try:
+            next_attempt = (
+                db.query(MailOutbox.nextAttemptAt)
+                .filter(MailOutbox.status == "pending")
+                .order_by(MailOutbox.nextAttemptAt)
+                .limit(1)
+                .scalar()
+            )
+        finally:
+            db.close()
+        if next_attempt is None:
+            return MAIL_POLL_SECONDS
+        return min(MAIL_POLL_SECONDS, max(0.0, (next_attempt - datetime.utcnow()).total_seconds()))
+
+    def queue_depth(self):
+        db = self.session_factory()
+        try:
+            return db.query(MailOutbox).filter(MailOutbox.status == "pending").count()
+        finally:
+            db.close()
+
+    # -- SMTP -------------------------------------------------------------
+
+    async def _connection(self):
+        if self._smtp is not None and self._smtp.is_connected:
+            return self._smtp
+        self._smtp = aiosmtplib.SMTP(**self.smtp_options)
+        await self._smtp.connect()
+        return self._smtp
+
+    async def _close_connection(self):
+        if self._smtp is not None:
+            try:
+                if self._smtp.is_connected:
+                    await self._smtp.quit()
+            except aiosmtplib.SMTPException:
+                self._smtp.close()
+            self._smtp = None
+
+    def _build(self, message):
+        email = EmailMessage()
+        email["Subject"] = message["subject"]
+        email["From"] = self.sender
+        email["To"] = ", ".join(message["recipients"])
+        email.set_content(message["body"], subtype=message["subtype"])
+        return email
+
+    async def _send_batch(self, batch):
+        delivered = []
+        failures = []
+        for message in batch:
+            started = time.perf_counter()
+            try:
+                smtp = await self._connection()
+                await smtp.send_message(self._build(message))
+                metrics.email_send_seconds.observe(time.perf_counter() - started, "ok")
+                delivered.append(message["id"])
+                self.latencies.append((datetime.utcnow() - message["createdAt"]).total_seconds())
+            except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                metrics.email_send_seconds.observe(time.perf_counter() - started, "error")
+                logger.warning(f"Sending mail {message['id']} failed: {e}")
+                failures.append((message["id"], message["attempts"] + 1, str(e)))
+                await self._close_connection()
+        self._last_used = time.monotonic()
+
+        self.sent += len(delivered)
+        for _, attempts, _ in failures:
+            if attempts >= MAIL_MAX_ATTEMPTS:
+                self.failed += 1
+            else:
+                self.retried += 1
+        await run_in_threadpool(self._record, delivered, failures)
+
+    # -- lifecycle --------------------------------------------------------
+
+    async def run(self):
+        while True:
+            try:
+                batch = await run_in_threadpool(self._claim_batch)
+                if batch:
+                    self._inflight = [message["id"] for message in batch]
+                    await self._send_batch(batch)
+                    self._inflight = []
+                    continue
+
+                if self._smtp is not None and time.monotonic() - self._last_used > MAIL_IDLE_SECONDS:
+                    await self._close_connection()
+
+                timeout = await run_in_threadpool(self._next_due_in)
+                if self._smtp is not None:
+                    timeout = min(timeout, MAIL_IDLE_SECONDS)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Mail dispatcher error: {e}")
+                await asyncio.sleep(MAIL_RETRY_BASE_SECONDS)
+
+    def start(self):
+        """Start dispatching on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            # Don't make a restart wait out the lease on messages we never finished
+            await run_in_threadpool(self._release, self._inflight)
+            self._inflight = []
+        await self._close_connection()
+        self._loop = None
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queue_depth": self.queue_depth(),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "latency_p50_seconds": latencies[len(latencies) // 2] if latencies else None,
+            "latency_p99_seconds": latencies[int(len(latencies) * 0.99)] if latencies else None,
+        }
+
+
+mailer = MailDispatcher()
+
+
+async def enqueue_email(db, subject, recipients, body, subtype="html"):
+    return await mailer.enqueue(db, subject, recipients, body, subtype)
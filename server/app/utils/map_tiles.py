@@ -0,0 +1,293 @@
+"""
+Map tiles of shelters, food points and unresolved SOS alerts, clustered on the
+server so a map zoomed out over a state draws a few hundred markers instead of
+every row.
+
+Tiles follow the Web Mercator XYZ scheme of slippy maps: at zoom z the world is
+2^z by 2^z tiles of TILE_SIZE pixels, x growing east and y south. Each tile is
+split into square cells of TILE_CLUSTER_PX pixels and the database groups the
+tile's rows by cell. A cell holding one row comes back as a point, a fuller one
+as a cluster with its count, centroid and totals (free places, persons). Cells
+never straddle tiles, so every row is in exactly one tile per zoom level. From
+TILE_CLUSTER_MAX_ZOOM on, where a tile spans a few hundred metres, tiles list
+every row.
+
+Tiles are compact JSON: the column names once, then one array per point or
+cluster. Rendered tiles are kept in an in-process LRU of TILE_CACHE_SIZE tiles
+for up to TILE_CACHE_TTL seconds. A write drops only the tiles holding the
+row's old and new position, one per zoom level; a tile that was rendering while
+the write committed is still served but not cached. Concurrent requests for a
+tile that is not cached wait on one render. Other workers see a write once
+their copy expires.
+"""
+import asyncio
+import hashlib
+import os
+from math import atan, degrees, floor, log, pi, radians, sinh, tan
+import orjson
+from dotenv import load_dotenv
+from sqlalchemy import case, func, select
+from Model import FoodProvidingRegions, SOS, Shelters
+from app.utils.cache import TTLCache
+
+load_dotenv()
+
+TILE_SIZE = 256
+TILE_CLUSTER_PX = int(os.getenv("TILE_CLUSTER_PX", "32"))
+TILE_MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "18"))
+TILE_CLUSTER_MAX_ZOOM = int(os.getenv("TILE_CLUSTER_MAX_ZOOM", "17"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "20000"))
+TILE_CACHE_TTL = float(os.getenv("TILE_CACHE_TTL", "300"))
+TILE_MAX_AGE = int(os.getenv("TILE_MAX_AGE", "30"))
+# Writes touching more positions than this (imports) drop the whole layer
+TILE_INVALIDATE_MAX_POSITIONS = int(os.getenv("TILE_INVALIDATE_MAX_POSITIONS", "1000"))
+
+# Cells per tile side
+GRID = max(1, TILE_SIZE // TILE_CLUSTER_PX)
+# Web Mercator stops here; rows nearer the poles go to the edge tiles
+MAX_LATITUDE = 85.0511287798
+
+
+class Layer:
+    def __init__(self, model, fields=(), totals=None, where=()):
+        self.model = model
+        self.fields = fields  # columns listed on points
+        self.totals = totals or {}  # name -> term added up on clusters
+        self.where = where
+
+    @property
+    def point_columns(self):
+        return ["id", "latitude", "longitude", *self.fields]
+
+    @property
+    def cluster_columns(self):
+        return ["latitude", "longitude", "count", *self.totals]
+
+
+_free_places = case(
+    (Shelters.capacity.is_(None), 0),
+    (Shelters.capacity - func.coalesce(Shelters.occupancy, 0) > 0, Shelters.capacity - func.coalesce(Shelters.occupancy, 0)),
+    else_=0,
+)
+
+LAYERS = {
+    "shelters": Layer(Shelters, ("name", "capacity", "occupancy"), {"free": _free_places}),
+    "food": Layer(FoodProvidingRegions, ("address",)),
+    "sos": Layer(SOS, ("persons",), {"persons": func.coalesce(SOS.persons, 0)}, (SOS.resolved == False,)),
+}
+LAYER_OF_MODEL = {layer.model: name for name, layer in LAYERS.items()}
+
+
+def _clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+def tile_of(latitude, longitude, z):
+    """(x, y) of the tile holding the point at zoom z."""
+    n = 1 << z
+    latitude = _clamp(latitude, -MAX_LATITUDE, MAX_LATITUDE)
+    x = floor((longitude + 180) / 360 * n)
+    y = floor((1 - log(tan(pi / 4 + radians(latitude) / 2)) / pi) / 2 * n)
+    return _clamp(x, 0, n - 1), _clamp(y, 0, n - 1)
+
+
+def _row_latitude(y, n):
+    """Latitude of the northern edge of tile row y."""
+    return degrees(atan(sinh(pi * (1 - 2 * y / n))))
+
+
+def _in_tile(model, z, x, y):
+    """Conditions for rows inside the tile, including the poles and 180° on the edge tiles."""
+    n = 1 << z
+    west, east = x / n * 360 - 180, (x + 1) / n * 360 - 180
+    conditions = [model.longitude >= west, model.longitude <= 180 if x == n - 1 else model.longitude < east]
+    if y == 0:
+        conditions.append(model.latitude <= 90)
+    else:
+        conditions.append(model.latitude < _row_latitude(y, n))
+    if y == n - 1:
+        conditions.append(model.latitude >= -90)
+    else:
+        conditions.append(model.latitude >= _row_latitude(y + 1, n))
+    return conditions
+
+
+def _cell_terms(model, z, x, y):
+    """Cell column and row of each row within its tile, possibly one off the edge for rounding."""
+    n = 1 << z
+    latitude = case(
+        (model.latitude > MAX_LATITUDE, MAX_LATITUDE),
+        (model.latitude < -MAX_LATITUDE, -MAX_LATITUDE),
+        else_=model.latitude,
+    )
+    column = func.floor(((model.longitude + 180) / 360 * n - x) * GRID)
+    mercator = func.ln(func.tan(pi / 4 + latitude * (pi / 360)))
+    row = func.floor(((1 - mercator / pi) / 2 * n - y) * GRID)
+    return column, row
+
+
+async def _clustered(db, layer, z, x, y):
+    model = layer.model
+    column, row = _cell_terms(model, z, x, y)
+    rows = (
+        select(
+            column.label("cell_x"),
+            row.label("cell_y"),
+            model.id,
+            model.latitude,
+            model.longitude,
+            *(getattr(model, field) for field in layer.fields),
+            *(term.label(f"total_{name}") for name, term in layer.totals.items()),
+        )
+        .where(*_in_tile(model, z, x, y), *layer.where)
+        .subquery()
+    )
+    statement = select(
+        rows.c.cell_x,
+        rows.c.cell_y,
+        func.count(),
+        func.sum(rows.c.latitude),
+        func.sum(rows.c.longitude),
+        func.min(rows.c.id),
+        *(func.max(rows.c[field]) for field in layer.fields),
+        *(func.sum(rows.c[f"total_{name}"]) for name in layer.totals),
+    ).group_by(rows.c.cell_x, rows.c.cell_y)
+
+    field_count = len(layer.fields)
+    cells = {}
+    for cell_x, cell_y, count, sum_lat, sum_lon, first_id, *values in await db.execute(statement):
+        key = (_clamp(int(cell_x), 0, GRID - 1), _clamp(int(cell_y), 0, GRID - 1))
+        totals = [value or 0 for value in values[field_count:]]
+        cell = cells.get(key)
+        if cell is None:
+            cells[key] = [count, sum_lat, sum_lon, first_id, values[:field_count], totals]
+        else:
+            # Only when rounding put a row on the wrong side of a cell edge
+            cell[0] += count
+            cell[1] += sum_lat
+            cell[2] += sum_lon
+            cell[5] = [a + b for a, b in zip(cell[5], totals)]
+
+    points, clusters = [], []
+    for count, sum_lat, sum_lon, first_id, fields, totals in cells.values():
+        latitude, longitude = round(sum_lat / count, 6), round(sum_lon / count, 6)
+        if count == 1:
+            points.append([first_id, latitude, longitude, *fields])
+        else:
+            clusters.append([latitude, longitude, count, *totals])
+    return points, clusters
+
+
+async def _unclustered(db, layer, z, x, y):
+    model = layer.model
+    statement = (
+        select(model.id, model.latitude, model.longitude, *(getattr(model, field) for field in layer.fields))
+        .where(*_in_tile(model, z, x, y), *layer.where)
+        .order_by(model.id)
+    )
+    return [list(row) for row in await db.execute(statement)], []
+
+
+async def render(db, name, z, x, y):
+    """The tile as a dict ready for JSON."""
+    layer = LAYERS[name]
+    if z >= TILE_CLUSTER_MAX_ZOOM:
+        points, clusters = await _unclustered(db, layer, z, x, y)
+    else:
+        points, clusters = await _clustered(db, layer, z, x, y)
+    return {
+        "layer": name,
+        "z": z,
+        "x": x,
+        "y": y,
+        "count": len(points) + sum(cluster[2] for cluster in clusters),
+        "point_columns": layer.point_columns,
+        "points": points,
+        "cluster_columns": layer.cluster_columns,
+        "clusters": clusters,
+    }
+
+
+class TileCache:
+    """Rendered tiles as (etag, body), by (layer, z, x, y)."""
+
+    def __init__(self, maxsize=TILE_CACHE_SIZE, ttl=TILE_CACHE_TTL):
+        self.entries = TTLCache(maxsize, ttl)
+        self._rendering = {}  # key -> Future of the render in progress
+        self._stale = set()  # keys written to while rendering
+        self.renders = 0
+        self.invalidated = 0
+
+    async def get(self, key, render):
+        """The cached tile, or the result of `render()` (a dict), stored unless a write raced it."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry, True
+        pending = self._rendering.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending), False
+
+        future = asyncio.get_running_loop().create_future()
+        self._rendering[key] = future
+        try:
+            body = orjson.dumps(await render())
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # raised here; waiters, if any, get it too
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._rendering[key]
+            stale = key in self._stale
+            self._stale.discard(key)
+
+        entry = ('"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"', body)
+        self.renders += 1
+        if not stale:
+            self.entries.set(key, entry)
+        future.set_result(entry)
+        return entry, False
+
+    def invalidate(self, name, positions):
+        """Drop the tiles of layer `name` holding any of `positions`, at every zoom level."""
+        positions = [(lat, lon) for lat, lon in positions if lat is not None and lon is not None]
+        if not positions:
+            return
+        if len(positions) > TILE_INVALIDATE_MAX_POSITIONS:
+            self.invalidated += self.entries.pop_matching(lambda key: key[0] == name)
+            self._stale.update(key for key in self._rendering if key[0] == name)
+            return
+        for z in range(TILE_MAX_ZOOM + 1):
+            for x, y in {tile_of(latitude, longitude, z) for latitude, longitude in positions}:
+                key = (name, z, x, y)
+                self.entries.pop(key)
+                if key in self._rendering:
+                    self._stale.add(key)
+                self.invalidated += 1
+
+    def stats(self):
+        return {
+            **self.entries.stats(),
+            "renders": self.renders,
+            "rendering": len(self._rendering),
+            "invalidated": self.invalidated,
+            "max_zoom": TILE_MAX_ZOOM,
+            "cluster_max_zoom": TILE_CLUSTER_MAX_ZOOM,
+            "cluster_px": TILE_CLUSTER_PX,
+        }
+
+
+tile_cache = TileCache()
+
+
+def invalidate(model, *positions):
+    """
+    Drop the cached tiles that may show a row of `model` at any of `positions`,
+    given as (latitude, longitude) pairs. Call after committing a write, with
+    both the old and the new position when a row moves.
+    """
+    name = LAYER_OF_MODEL.get(model)
+    if name is not None:
+        tile_cache.invalidate(name, positions)
@@ -0,0 +1,324 @@
+"""
+Request metrics in the Prometheus text format, and an opt-in profiler for slow
+requests.
+
+MetricsMiddleware times every HTTP request by method, route template and
+status, and counts the SQL statements each request runs and the time spent in
+them, through cursor events on the engines passed to instrument_engine. S3
+uploads and mail delivery record their own timings. GET /metrics renders all
+of it, plus the gauges registered with `gauge`, for a Prometheus scrape.
+
+Requests slower than SLOW_REQUEST_MS are logged with their query count. With
+PROFILER_ENABLED (or PUT /metrics/profiler) a thread samples the event loop's
+stack every PROFILER_INTERVAL_MS, and the samples taken while a slow request
+ran are written to PROFILER_DIR as folded stacks, for flamegraph.pl, inferno
+or speedscope. The loop is shared, so the profile shows whatever held the loop
+while the request waited, which is usually why it was slow.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from loguru import logger
+from sqlalchemy import event
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+PROFILER_DIR = os.getenv("PROFILER_DIR", "profiles")
+PROFILER_MAX_FILES = int(os.getenv("PROFILER_MAX_FILES", "100"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Histogram:
+    """Cumulative histogram per label set. Safe to observe from worker threads."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                total += count
+                labels = _labels(self.labels + ("le",), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {total}"
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {values[-1]}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+class Gauge:
+    """Value read from a callback at scrape time."""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        REGISTRY.append(self)
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"Could not read metric {self.name}: {e}")
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {value}"
+
+
+def gauge(name, help, read):
+    return Gauge(name, help, read)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time to answer HTTP requests", ("method", "route", "status")
+)
+request_queries = Histogram(
+    "http_request_db_queries", "SQL statements run per HTTP request", ("method", "route"), COUNT_BUCKETS
+)
+request_db_seconds = Histogram(
+    "http_request_db_seconds", "Time spent in SQL statements per HTTP request", ("method", "route")
+)
+query_seconds = Histogram("db_query_duration_seconds", "SQL statement time", ("operation",), QUERY_BUCKETS)
+s3_upload_seconds = Histogram("s3_upload_duration_seconds", "S3 upload time", ("outcome",))
+email_send_seconds = Histogram("email_send_duration_seconds", "SMTP send time per message", ("outcome",))
+
+_in_progress = 0
+gauge("http_requests_in_progress", "HTTP requests being answered", lambda: _in_progress)
+
+
+# Database
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Set per request; SQLAlchemy runs async drivers in greenlets that share the context
+_current = ContextVar("request_metrics", default=None)
+
+OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK"}
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    operation = statement.lstrip()[:8].split(None, 1)[0].upper() if statement.strip() else ""
+    query_seconds.observe(elapsed, operation if operation in OPERATIONS else "OTHER")
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+
+def _error(context):
+    # after_cursor_execute doesn't fire for failed statements
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    """Time the statements of a sync engine (for an AsyncEngine, pass its sync_engine)."""
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+    event.listen(engine, "handle_error", _error)
+
+
+# Profiler
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None and len(stack) < 128:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Profiler:
+    """Samples one thread's stack on an interval and keeps the last few seconds of samples."""
+
+    def __init__(self, interval_ms=PROFILER_INTERVAL_MS, keep_seconds=60):
+        self.interval = interval_ms / 1000
+        self._samples = deque(maxlen=max(1, int(keep_seconds / self.interval)))  # (time, folded stack)
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+        self.captured = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Sample the calling thread, normally the event loop's."""
+        if self.running:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._samples.clear()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._samples.append((time.perf_counter(), _fold(frame)))
+
+    def capture(self, started, ended, method, route, status):
+        """Write the samples taken between `started` and `ended` to PROFILER_DIR. Returns the path."""
+        stacks = Counter(stack for at, stack in list(self._samples) if started <= at <= ended)
+        if not stacks:
+            return None
+        os.makedirs(PROFILER_DIR, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        path = os.path.join(
+            PROFILER_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{method}-{name}-{status}-{(ended - started) * 1000:.0f}ms.folded"
+        )
+        with open(path, "w") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        self.captured += 1
+        profiles = sorted(entry.path for entry in os.scandir(PROFILER_DIR) if entry.name.endswith(".folded"))
+        for old in profiles[:-PROFILER_MAX_FILES]:
+            os.remove(old)
+        return path
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "slow_request_ms": SLOW_REQUEST_MS,
+            "directory": os.path.abspath(PROFILER_DIR),
+            "captured": self.captured,
+        }
+
+
+profiler = Profiler()
+
+
+# Middleware
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency, status and database work per route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        global _in_progress
+        stats = RequestStats()
+        token = _current.set(stats)
+        response = {"status": 500, "streaming": False}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["streaming"] = any(
+                    name == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", ())
+                )
+            await send(message)
+
+        _in_progress += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            ended = time.perf_counter()
+            _in_progress -= 1
+            _current.reset(token)
+            self.record(scope, response, stats, started, ended)
+
+    def record(self, scope, response, stats, started, ended):
+        # Label by route template so path parameters don't multiply the series
+        route = getattr(scope.get("route"), "path", None) or "unmatched"
+        method = scope["method"]
+        status = response["status"]
+        elapsed = ended - started
+        request_seconds.observe(elapsed, method, route, status)
+        request_queries.observe(stats.queries, method, route)
+        request_db_seconds.observe(stats.db_seconds, method, route)
+
+        # Event streams stay open by design
+        if response["streaming"] or elapsed * 1000 < SLOW_REQUEST_MS:
+            return
+        logger.warning(
+            f"Slow request {method} {route} {status} took {elapsed * 1000:.0f} ms, "
+            f"{stats.queries} queries ({stats.db_seconds * 1000:.0f} ms in the database)"
+        )
+        if profiler.running:
+            try:
+                path = profiler.capture(started, ended, method, route, status)
+            except OSError as e:
+                logger.error(f"Could not write profile: {e}")
+            else:
+                if path:
+                    logger.info(f"Profile of the slow request written to {path}")
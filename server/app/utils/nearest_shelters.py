@@ -0,0 +1,88 @@
+"""
+The k shelters nearest to a point, for routing people during an evacuation.
+
+Shelters rank by distance rounded down to NEAREST_TIE_KM (100 m by default):
+shelters in the same step count as equally far, and the one with the most free
+places comes first. Shelters whose capacity is unknown rank after those with
+room, and with `has_space` shelters known to be full are skipped altogether.
+
+With the in-memory spatial index enabled the answer comes from a best-first
+search of the grid (GridIndex.nearest), which only looks at the cells around
+the point. Otherwise the database ranks the shelters inside a radius that
+grows from NEAREST_START_KM until it is certain to hold the k best.
+"""
+import os
+from dotenv import load_dotenv
+from sqlalchemy import case, func, or_, select
+from Model import Shelters
+from app.utils import spatial_index
+from app.utils.geo import distance_km_term, radius_filter
+
+load_dotenv()
+
+NEAREST_TIE_KM = float(os.getenv("NEAREST_TIE_KM", "0.1"))
+NEAREST_START_KM = float(os.getenv("NEAREST_START_KM", "5"))
+# Past this radius the database ranks every shelter instead of growing it further
+NEAREST_RADIUS_LIMIT_KM = 2000
+
+
+def free_places(capacity, occupancy):
+    """Places left, or None when the capacity is unknown."""
+    if capacity is None:
+        return None
+    return capacity - (occupancy or 0)
+
+
+def has_space(shelter):
+    places = free_places(shelter["capacity"], shelter["occupancy"])
+    return places is None or places > 0
+
+
+def _tie_break(shelter):
+    # More free places first; unknown capacity after any shelter with room
+    return -max(free_places(shelter["capacity"], shelter["occupancy"]) or 0, 0)
+
+
+async def nearest(db, latitude, longitude, k, max_km=None, space_only=True):
+    """
+    The k best shelters around the point, best first, with `distance` set on
+    each. Rows are dicts from the index and ORM objects from the database.
+    """
+    index = spatial_index.get_index(Shelters)
+    if index is not None:
+        results = index.nearest(
+            latitude, longitude, k, max_km,
+            where=has_space if space_only else None,
+            tie_break=_tie_break,
+            resolution_km=NEAREST_TIE_KM,
+        )
+        for shelter, distance in results:
+            shelter["distance"] = distance
+        return [shelter for shelter, _ in results]
+
+    distance = distance_km_term(Shelters, latitude, longitude)
+    free = case((Shelters.capacity.is_(None), 0), else_=Shelters.capacity - func.coalesce(Shelters.occupancy, 0))
+    statement = (
+        select(Shelters, distance)
+        .order_by(func.floor(distance / NEAREST_TIE_KM), case((free > 0, free), else_=0).desc(), distance, Shelters.id)
+        .limit(k)
+    )
+    if space_only:
+        statement = statement.where(or_(Shelters.capacity.is_(None), free > 0))
+
+    radius = NEAREST_START_KM if max_km is None else min(NEAREST_START_KM, max_km)
+    while True:
+        if radius > NEAREST_RADIUS_LIMIT_KM and max_km is None:
+            rows = (await db.execute(statement)).all()
+            break
+        rows = (await db.execute(statement.where(radius_filter(Shelters, latitude, longitude, radius)))).all()
+        if max_km is not None and radius >= max_km:
+            break
+        # Done once the radius covers the whole distance step of the k-th shelter
+        if len(rows) == k and (rows[-1][1] // NEAREST_TIE_KM + 1) * NEAREST_TIE_KM <= radius:
+            break
+        radius = radius * 4 if max_km is None else min(radius * 4, max_km)
+
+    for shelter, shelter_distance in rows:
+        shelter.distance = shelter_distance
+    return [shelter for shelter, _ in rows]
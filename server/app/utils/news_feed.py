@@ -0,0 +1,177 @@
+"""
+Nearby news feed ranked by distance and recency, paged by cursor.
+
+A feed only considers news posted in the last `hours` (NEWS_FEED_WINDOW_HOURS
+by default) inside the search radius, so the createdAt and coordinate indexes
+narrow the rows before anything is scored. Each item scores
+
+    (1 - w) * distance / radius + w * age / window,   w = NEWS_FEED_RECENCY_WEIGHT
+
+from 0 for a story posted right here just now to 1 for one as far and as old
+as the feed reaches, and items are ordered by (score, id) in the database.
+
+A cursor carries the reference time of the feed's first page along with the
+score and id of the last item served. Later pages are scored against the same
+time, so they continue exactly where the previous page stopped; news posted in
+the meantime shows up on the next first page rather than shifting the pages.
+
+With the in-memory spatial index enabled, the candidates and their scores come
+from the index instead. Searches going through the response cache take their
+candidates from the cached rows around the caller's grid cell and are scored
+here, not in the database, so the cursors of their pages always compare alike.
+A cursor from before the cached rows were fetched gets its candidates fetched
+afresh.
+"""
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import DateTime, Float, func, literal, select, tuple_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from Model import News
+from app.utils import response_cache, spatial_index
+from app.utils.geo import distance_km_term, radius_filter
+from app.utils.pagination import decode_cursor, encode_cursor
+
+load_dotenv()
+
+NEWS_FEED_WINDOW_HOURS = float(os.getenv("NEWS_FEED_WINDOW_HOURS", "96"))
+NEWS_FEED_RECENCY_WEIGHT = float(os.getenv("NEWS_FEED_RECENCY_WEIGHT", "0.5"))
+
+
+class hours_between(FunctionElement):
+    """Hours from the first datetime expression to the second, as a float."""
+    type = Float()
+    name = "hours_between"
+    inherit_cache = True
+
+
+@compiles(hours_between)
+def _hours_between(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"(EXTRACT(EPOCH FROM ({end} - {start})) / 3600.0)"
+
+
+@compiles(hours_between, "sqlite")
+def _hours_between_sqlite(element, compiler, **kw):
+    start, end = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"((julianday({end}) - julianday({start})) * 24.0)"
+
+
+def score(distance_km, age_hours, radius_km, hours):
+    weight = NEWS_FEED_RECENCY_WEIGHT
+    return (1 - weight) * distance_km / radius_km + weight * age_hours / hours
+
+
+def _read_cursor(cursor):
+    after = decode_cursor(cursor)
+    try:
+        now = datetime.fromisoformat(after["now"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after.get("score"), (int, float)) or not isinstance(after.get("id"), int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return now, after["score"], after["id"]
+
+
+def _rank(candidates, now, after, radius_km, hours, limit):
+    """
+    Score (item, createdAt, id, distance) candidates from the window and keep the
+    limit + 1 best after the cursor. Returns (rows, total).
+    """
+    scored = [
+        (score(distance, (now - created_at).total_seconds() / 3600, radius_km, hours), item_id, item, distance)
+        for item, created_at, item_id, distance in candidates
+    ]
+    total = None if after else len(scored)
+    return sorted(entry for entry in scored if not after or entry[:2] > tuple(after))[:limit + 1], total
+
+
+def _field(item, name):
+    return item[name] if isinstance(item, dict) else getattr(item, name)
+
+
+async def _fetch(db, latitude, longitude, radius_km, since, now=None):
+    """News in the radius posted after `since` (and by `now`), with `distance` set, from the index or the database."""
+    window = [News.createdAt > since]
+    if now is not None:
+        window.append(News.createdAt <= now)
+    rows, _ = await spatial_index.find_nearby(
+        db, News, select(News).where(*window), latitude, longitude, radius_km,
+        where=lambda item: since < item["createdAt"] and (now is None or item["createdAt"] <= now),
+    )
+    return rows
+
+
+async def page(db, latitude, longitude, radius_km, hours=NEWS_FEED_WINDOW_HOURS, limit=100, cursor=None, cached=None):
+    """
+    One page of the feed around the point. Returns (news, next_cursor, total),
+    best first with `distance` set on every item; total counts the whole feed
+    and is only computed for the first page (None with a cursor). `cached` is a
+    response cache search for this point, radius and window.
+    """
+    if cursor:
+        now, *after = _read_cursor(cursor)
+    else:
+        now, after = datetime.now(), None
+    since = now - timedelta(hours=hours)
+
+    if cached is not None and cached.caching:
+        # Scored here rather than in the database, so the cursors of cached pages always compare alike
+        if now >= datetime.fromtimestamp(cached.built):
+            if cached.rows is None:
+                built_since = datetime.fromtimestamp(cached.built) - timedelta(hours=hours)
+                await cached.fill(await _fetch(db, *cached.area, built_since))
+            found = [(item, distance) for item, distance in cached.within() if since < item.createdAt <= now]
+        else:
+            # A cursor from before the cached rows were fetched; they may not reach back far enough
+            found = [(item, _field(item, "distance")) for item in await _fetch(db, latitude, longitude, radius_km, since, now)]
+        rows, total = _rank(
+            ((item, _field(item, "createdAt"), _field(item, "id"), distance) for item, distance in found),
+            now, after, radius_km, hours, limit,
+        )
+        rows = [
+            (item_score, item_id, response_cache.with_distance(item, distance), distance)
+            for item_score, item_id, item, distance in rows
+        ]
+        return _page(rows, now, limit, total)
+
+    index = spatial_index.get_index(News)
+    if index is not None:
+        rows, total = _rank(
+            (
+                (item, item["createdAt"], item["id"], distance)
+                for item, distance in index.nearby(
+                    latitude, longitude, radius_km, where=lambda item: since < item["createdAt"] <= now
+                )[0]
+            ),
+            now, after, radius_km, hours, limit,
+        )
+        for item_score, _, item, distance in rows:
+            item["distance"] = distance
+    else:
+        distance = distance_km_term(News, latitude, longitude)
+        item_score = score(distance, hours_between(News.createdAt, literal(now, DateTime())), radius_km, hours)
+        window = (
+            News.createdAt > since,
+            News.createdAt <= now,
+            radius_filter(News, latitude, longitude, radius_km),
+        )
+        query = select(item_score, News.id, News, distance).where(*window)
+        if after:
+            query = query.where(tuple_(item_score, News.id) > tuple_(*after))
+        rows = (await db.execute(query.order_by(item_score, News.id).limit(limit + 1))).all()
+        total = None if after else await db.scalar(select(func.count()).select_from(News).where(*window))
+        for _, _, item, item_distance in rows:
+            item.distance = item_distance
+    return _page(rows, now, limit, total)
+
+
+def _page(rows, now, limit, total):
+    news = [item for _, _, item, _ in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last_score, last_id = rows[limit - 1][:2]
+        next_cursor = encode_cursor({"now": now.isoformat(), "score": last_score, "id": last_id})
+    return news, next_cursor, total
@@ -0,0 +1,100 @@
+"""
+Password hashing service.
+
+bcrypt is deliberately slow, so hashing and verification run in a process pool
+rather than on the event loop or the request threadpool, where a login storm
+would otherwise starve every other request. The number of jobs admitted at once
+is bounded; beyond that, requests are shed with 503 instead of piling up.
+
+The cost factor comes from BCRYPT_ROUNDS. Hashes made with another cost still
+verify, and `needs_rehash` tells the login handler to upgrade them.
+
+This module is imported by the pool's worker processes, so it must stay free of
+database and application imports.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+from fastapi import HTTPException, status
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_QUEUE = int(os.getenv("PASSWORD_QUEUE", str(PASSWORD_WORKERS * 16)))  # jobs admitted at once
+
+_pool = None
+_pending = 0
+
+
+def _hash(password: bytes, rounds: int) -> str:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _verify(password: bytes, hashed: bytes) -> bool:
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+async def _run(fn, *args):
+    global _pending
+    if _pending >= PASSWORD_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please retry shortly.",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password.encode("utf-8"), BCRYPT_ROUNDS)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run(_verify, plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+
+
+def hash_rounds(hashed_password: str):
+    """Cost factor of a bcrypt hash ($2b$12$...), or None if it is not one."""
+    parts = hashed_password.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    return hash_rounds(hashed_password) != BCRYPT_ROUNDS
+
+
+def warm_up():
+    """Start the worker processes now so the first logins don't pay for it."""
+    pool = _get_pool()
+    for future in [pool.submit(hash_rounds, "") for _ in range(PASSWORD_WORKERS)]:
+        future.result()
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
@@ -0,0 +1,205 @@
+"""
+Per-pincode counts of shelters, food points, unresolved SOS alerts and the
+persons those alerts report, kept in the pincode_stats table so dashboards read
+one row per area instead of the lists underneath.
+
+Write handlers call `record` with their change once it is committed. Changes
+are added up in memory and applied every PINCODE_STATS_FLUSH_MS as one upsert
+per pincode (count = count + change), so a burst of SOS alerts from one area
+costs one row write, not one per alert. Every PINCODE_STATS_RECONCILE_SECONDS,
+and at startup, the table is recounted from the base tables, which repairs
+anything the changes missed: rows written by scripts, changes lost when a
+process stopped before flushing, rows removed along with their user. A write
+that commits while the recount runs may be counted twice or not at all until
+the next recount.
+
+SOS alerts count under the pincode of the user who sent them, copied onto the
+alert when it is saved. Anonymous alerts have no pincode and are not counted.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from loguru import logger
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import AsyncSessionLocal
+from Model import FoodProvidingRegions, PincodeStats, SOS, Shelters
+
+load_dotenv()
+
+PINCODE_STATS_ENABLED = os.getenv("PINCODE_STATS_ENABLED", "true").lower() == "true"
+PINCODE_STATS_FLUSH_MS = float(os.getenv("PINCODE_STATS_FLUSH_MS", "1000"))
+PINCODE_STATS_RECONCILE_SECONDS = float(os.getenv("PINCODE_STATS_RECONCILE_SECONDS", "600"))
+
+COUNTS = ("shelters", "food", "sos_unresolved", "persons")
+# Tables counted one per row, and the count each goes to
+LAYERS = {Shelters: "shelters", FoodProvidingRegions: "food"}
+
+
+def _upsert(dialect):
+    """INSERT of a row of changes that adds them to the pincode's row if it exists."""
+    statement = (postgresql_insert if dialect == "postgresql" else sqlite_insert)(PincodeStats)
+    return statement.on_conflict_do_update(
+        index_elements=[PincodeStats.pincode],
+        set_={
+            **{count: getattr(PincodeStats, count) + getattr(statement.excluded, count) for count in COUNTS},
+            "updatedAt": statement.excluded.updatedAt,
+        },
+    )
+
+
+class PincodeCounter:
+    def __init__(self):
+        self._changes = {}  # pincode -> {count: change}
+        # A flush must not land between a recount's reads and its writes
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._pincodes = None  # pincodes with a row, known from the first recount on
+        self.flushes = 0
+        self.flush_failures = 0
+        self.reconciles = 0
+        self.last_reconciled = None
+        self.last_reconcile_seconds = None
+
+    def __len__(self):
+        return len(self._changes)
+
+    @property
+    def pincodes(self):
+        """
+        Rows in pincode_stats as of this process's last recount and its own flushes
+        since, or None before the first recount.
+        """
+        return len(self._pincodes) if self._pincodes is not None else None
+
+    def record(self, pincode, **changes):
+        """Add `changes` (e.g. shelters=1, persons=-4) to the pincode's counts."""
+        if not PINCODE_STATS_ENABLED or not pincode:
+            return
+        pending = self._changes.setdefault(pincode, dict.fromkeys(COUNTS, 0))
+        for count, change in changes.items():
+            pending[count] += change
+
+    def moved(self, count, old_pincode, new_pincode):
+        """Move one row counted in `count` from one pincode to another."""
+        if old_pincode != new_pincode:
+            self.record(old_pincode, **{count: -1})
+            self.record(new_pincode, **{count: 1})
+
+    def _restore(self, changes):
+        for pincode, pending in changes.items():
+            self.record(pincode, **pending)
+
+    async def flush(self):
+        """Apply the changes recorded so far. Returns the number of pincodes written."""
+        async with self._lock:
+            changes, self._changes = self._changes, {}
+            rows = [
+                dict(pending, pincode=pincode, updatedAt=datetime.now())
+                for pincode, pending in changes.items()
+                if any(pending.values())
+            ]
+            if not rows:
+                return 0
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(_upsert(db.bind.dialect.name), rows)
+                    await db.commit()
+            except Exception:
+                self.flush_failures += 1
+                self._restore(changes)
+                raise
+            if self._pincodes is not None:
+                self._pincodes.update(row["pincode"] for row in rows)
+            self.flushes += 1
+            return len(rows)
+
+    async def reconcile(self):
+        """Recount every pincode from the base tables. Returns the number of pincodes."""
+        async with self._lock:
+            started = time.perf_counter()
+            # Everything recorded so far is committed, so the recount includes it
+            self._changes = {}
+            counts = {}
+
+            def add(rows, *names):
+                for pincode, *values in rows:
+                    if pincode:
+                        counts.setdefault(pincode, dict.fromkeys(COUNTS, 0)).update(zip(names, values))
+
+            async with AsyncSessionLocal() as db:
+                for model, name in LAYERS.items():
+                    add(await db.execute(select(model.pincode, func.count()).group_by(model.pincode)), name)
+                add(
+                    await db.execute(
+                        select(SOS.pincode, func.count(), func.coalesce(func.sum(SOS.persons), 0))
+                        .where(SOS.resolved == False, SOS.pincode.is_not(None))
+                        .group_by(SOS.pincode)
+                    ),
+                    "sos_unresolved", "persons",
+                )
+                now = datetime.now()
+                await db.execute(delete(PincodeStats))
+                if counts:
+                    await db.execute(
+                        insert(PincodeStats), [dict(values, pincode=pincode, updatedAt=now) for pincode, values in counts.items()]
+                    )
+                await db.commit()
+
+            self._pincodes = set(counts)
+            self.reconciles += 1
+            self.last_reconciled = datetime.now()
+            self.last_reconcile_seconds = time.perf_counter() - started
+            logger.info(f"Recounted pincode stats for {len(counts)} pincodes in {self.last_reconcile_seconds:.2f}s")
+            return len(counts)
+
+    async def run(self):
+        next_reconcile = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() >= next_reconcile:
+                    await self.reconcile()
+                    next_reconcile = time.monotonic() + PINCODE_STATS_RECONCILE_SECONDS
+                await asyncio.sleep(PINCODE_STATS_FLUSH_MS / 1000)
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pincode stats upkeep failed: {e}")
+                await asyncio.sleep(PINCODE_STATS_FLUSH_MS / 1000)
+
+    def start(self):
+        """Recount, then keep flushing and recounting on the running event loop."""
+        if PINCODE_STATS_ENABLED:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                await self.flush()
+            except Exception:
+                logger.warning(f"Pincode stats changes for {len(self)} pincodes were not saved; the next recount restores them")
+
+    def stats(self):
+        return {
+            "enabled": PINCODE_STATS_ENABLED,
+            "pending_pincodes": len(self._changes),
+            "pincodes": self.pincodes,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "reconciles": self.reconciles,
+            "last_reconciled": self.last_reconciled,
+            "last_reconcile_seconds": self.last_reconcile_seconds,
+        }
+
+
+pincode_stats = PincodeCounter()
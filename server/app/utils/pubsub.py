@@ -0,0 +1,152 @@
+"""
+In-process publish/subscribe for location based events.
+
+Subscribers register a centre and radius and get a bounded asyncio queue. Each
+published event carries a latitude/longitude and is fanned out only to the
+subscribers whose circle contains it. A subscriber that falls behind has its
+queue cleared and receives a single "resync" event so it can reload the full
+list instead of silently missing alerts.
+
+`publish` is safe to call from the sync route handlers, which run in the
+threadpool: the fan-out is handed to the event loop the subscribers live on.
+"""
+import asyncio
+import itertools
+import os
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from app.utils.distance import Points, distances
+
+load_dotenv()
+
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("PUBSUB_QUEUE_SIZE", "100"))
+
+RESYNC_EVENT = {"type": "resync"}
+
+
+class Subscription:
+    def __init__(self, broker, sub_id, latitude, longitude, radius_km, queue_size):
+        self.broker = broker
+        self.id = sub_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_km = radius_km
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflows = 0
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too slow to keep up: drop the backlog and ask for a reload
+            self.overflows += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+
+    async def get(self, timeout=None):
+        """Wait for the next event; returns None on timeout."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class GeoBroker:
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._centres = None  # (Points, radii, subscriptions) cache for fan-out
+        self.published = 0
+        self.delivered = 0
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, latitude, longitude, radius_km):
+        """Register a subscriber. Must be called from the event loop."""
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(
+            self, next(self._ids), latitude, longitude, radius_km, self.queue_size
+        )
+        with self._lock:
+            self._subscribers[subscription.id] = subscription
+            self._centres = None
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if self._subscribers.pop(subscription.id, None) is not None:
+                self._centres = None
+
+    def _matching(self, latitude, longitude):
+        with self._lock:
+            if self._centres is None:
+                subscriptions = list(self._subscribers.values())
+                centres = Points(
+                    [s.latitude for s in subscriptions], [s.longitude for s in subscriptions]
+                )
+                radii = np.fromiter(
+                    (s.radius_km for s in subscriptions), dtype=np.float64, count=len(subscriptions)
+                )
+                self._centres = (centres, radii, subscriptions)
+            centres, radii, subscriptions = self._centres
+
+        if not subscriptions:
+            return []
+        inside = distances(centres, latitude, longitude) <= radii
+        return [subscriptions[i] for i in np.flatnonzero(inside)]
+
+    def _fanout(self, event):
+        self.published += 1
+        for subscription in self._matching(event["latitude"], event["longitude"]):
+            subscription.deliver(event)
+            self.delivered += 1
+
+    def publish(self, event):
+        """
+        Send an event with "latitude" and "longitude" keys to every subscriber
+        whose radius contains it.
+        """
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._fanout(event)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._fanout, event)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "delivered": self.delivered,
+            "overflows": sum(s.overflows for s in list(self._subscribers.values())),
+        }
+
+
+sos_feed = GeoBroker()
+
+
+def sos_event(event_type, alert):
+    """Payload pushed to /sos/stream subscribers."""
+    return {
+        "type": event_type,
+        "id": alert.id,
+        "latitude": alert.latitude,
+        "longitude": alert.longitude,
+        "persons": alert.persons,
+        "createdAt": alert.createdAt.isoformat(),
+        "resolved": alert.resolved,
+    }
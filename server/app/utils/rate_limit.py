@@ -0,0 +1,208 @@
+"""
+Token-bucket rate limiting.
+
+A bucket holds up to `burst` tokens and refills at `rate` tokens per second;
+each request takes one from every bucket it is checked against, and only when
+all of them have one, so a request turned away by one limit (a flooding user)
+costs nothing from the others (the global budget). Buckets live in a backend chosen with
+RATE_LIMIT_BACKEND: "memory" keeps them in this process (bounded LRU; an
+evicted bucket is simply full again), "redis" shares them between workers
+through REDIS_URL, with the refill and take done atomically in a Lua script.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from loguru import logger
+from app.utils.cache import REDIS_URL, TTLCache
+
+load_dotenv()
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_BUCKETS = int(os.getenv("RATE_LIMIT_BUCKETS", "100000"))
+TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() == "true"
+
+
+class Limit:
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate  # tokens per second
+        self.burst = burst
+
+    @classmethod
+    def per_minute(cls, name, per_minute, burst):
+        return cls(name, per_minute / 60, burst)
+
+    @property
+    def refill_seconds(self):
+        """Time for an empty bucket to fill up again."""
+        return self.burst / self.rate
+
+
+class MemoryBuckets:
+    name = "memory"
+
+    def __init__(self, maxsize=RATE_LIMIT_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _cache(self, limit):
+        cache = self._buckets.get(limit.name)
+        if cache is None:
+            cache = self._buckets[limit.name] = TTLCache(self.maxsize, limit.refill_seconds)
+        return cache
+
+    async def take_all(self, checks):
+        """
+        Take a token from the bucket of every (Limit, key) in `checks`, or from none
+        of them. Returns the first limit without a token, or None.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            exhausted = None
+            for limit, key in checks:
+                cache = self._cache(limit)
+                tokens, updated = cache.get(key) or (limit.burst, now)
+                tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+                if tokens < 1 and exhausted is None:
+                    exhausted = limit
+                buckets.append((cache, key, tokens))
+            for cache, key, tokens in buckets:
+                cache.set(key, (tokens if exhausted else tokens - 1, now))
+            return exhausted
+
+
+# KEYS the buckets; ARGV rate and burst of each in turn. Takes a token from every
+# bucket or from none, and returns the 1-based index of the first empty one (0
+# when all had a token). Uses the server clock so workers agree.
+TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local levels = {}
+local empty = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 and empty == 0 then
+        empty = i
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local tokens = levels[i]
+    if empty == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return empty
+"""
+
+
+class RedisBuckets:
+    name = "redis"
+
+    def __init__(self, url=REDIS_URL, client=None):
+        if client is None:
+            try:
+                from redis import asyncio as redis
+            except ImportError:
+                raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package")
+            client = redis.from_url(url)
+        self.client = client
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    async def take_all(self, checks):
+        keys = [f"rl:{limit.name}:{key}" for limit, key in checks]
+        args = [value for limit, _ in checks for value in (limit.rate, limit.burst)]
+        try:
+            empty = await self._take(keys=keys, args=args)
+        except Exception as e:
+            # Fail open: an unreachable limiter must not turn requests away
+            logger.warning(f"Rate limit check failed, allowing request: {e}")
+            return None
+        return checks[empty - 1][0] if empty else None
+
+
+def create_buckets(name=RATE_LIMIT_BACKEND):
+    if name == "memory":
+        return MemoryBuckets()
+    if name == "redis":
+        return RedisBuckets()
+    raise ValueError(f"Unknown rate limit backend: {name}")
+
+
+def client_ip(request):
+    """Client address, taken from X-Forwarded-For only behind a trusted proxy."""
+    if TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimiter:
+    """Checks a request against several limits, e.g. per user, per IP and global."""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or create_buckets()
+        self.allowed = 0
+        self.limited = {}
+
+    async def check(self, checks):
+        """
+        `checks` is a list of (Limit, key), narrowest first. Returns the name of
+        the first limit that is exhausted, or None when every bucket had a token.
+        Tokens are only taken when every bucket had one.
+        """
+        exhausted = await self.buckets.take_all(checks)
+        if exhausted is not None:
+            self.limited[exhausted.name] = self.limited.get(exhausted.name, 0) + 1
+            return exhausted.name
+        self.allowed += 1
+        return None
+
+    def stats(self):
+        return {"backend": self.buckets.name, "allowed": self.allowed, "limited": dict(self.limited)}
+
+
+class InFlight:
+    """
+    Bounds how many requests do some expensive work at once, e.g. their own
+    database write. Meant for use on the event loop, so no locking.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.peak = 0
+        self.full_count = 0
+
+    def full(self):
+        if self.active >= self.limit:
+            self.full_count += 1
+            return True
+        return False
+
+    @contextmanager
+    def hold(self):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            yield
+        finally:
+            self.active -= 1
+
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "peak": self.peak, "full": self.full_count}
@@ -0,0 +1,266 @@
+"""
+Response cache for the public radius searches (shelters, food and news).
+
+Queries are snapped to a grid of RESPONSE_CACHE_GRID_DEG degrees and every
+request in a grid cell shares one entry: all rows within the requested radius
+(rounded up to 0.1 km) plus the cell's half-diagonal of the cell's centre.
+That is a superset of what any caller in the cell can see, so each request,
+hit or miss, filters the entry to its own exact point and radius, measures
+`distance` from that point and pages the result. Snapping only decides which
+requests share an entry, never which rows or distances a caller gets.
+Searches wider than RESPONSE_CACHE_MAX_RADIUS_KM, and areas holding more than
+RESPONSE_CACHE_MAX_ROWS rows, are answered without the cache.
+
+Invalidation uses versions instead of deleting keys. The world is split into
+coarse tiles of RESPONSE_CACHE_TILE_DEG degrees, each with its own counter. A
+cache key includes the counters of every tile its search box overlaps, so a write
+that bumps the tiles at a row's old and new position retires exactly the entries
+that could contain the row. Searches that overlap too many tiles use a
+layer-wide counter instead, which every write also bumps. Versions are read
+before the rows are fetched, so an entry built while a write commits is
+stored under a key that is already retired.
+
+Responses carry an ETag and a Last-Modified time (when the entry was built), and
+clients can revalidate with If-None-Match or If-Modified-Since to get a 304.
+Entries live RESPONSE_CACHE_TTL seconds.
+"""
+import hashlib
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from math import ceil, floor
+import numpy as np
+from dotenv import load_dotenv
+from fastapi import Response
+from pydantic import BaseModel, TypeAdapter
+from app.utils.cache import create_backend
+from app.utils.distance import Points, distances, haversine
+from app.utils.geo import bounding_box
+
+load_dotenv()
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_MAX_AGE = int(os.getenv("RESPONSE_CACHE_MAX_AGE", "30"))
+GRID_DEG = float(os.getenv("RESPONSE_CACHE_GRID_DEG", "0.005"))  # ~550 m
+TILE_DEG = float(os.getenv("RESPONSE_CACHE_TILE_DEG", "0.5"))
+MAX_TILES = int(os.getenv("RESPONSE_CACHE_MAX_TILES", "64"))
+MAX_RADIUS_KM = float(os.getenv("RESPONSE_CACHE_MAX_RADIUS_KM", "50"))
+MAX_ROWS = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", "5000"))
+
+backend = create_backend() if RESPONSE_CACHE_ENABLED else None
+
+
+def snap(value):
+    if GRID_DEG <= 0:
+        return value
+    return round(round(value / GRID_DEG) * GRID_DEG, 6)
+
+
+def _half_diagonal_km(latitude, longitude):
+    """Farthest any point of the grid cell centred here can be from its centre."""
+    if GRID_DEG <= 0:
+        return 0.0
+    half = GRID_DEG / 2
+    # Cells are widest on the side nearer the equator
+    return max(
+        haversine(latitude, longitude, latitude + half, longitude + half),
+        haversine(latitude, longitude, latitude - half, longitude + half),
+    ) + 0.001  # the snapped centre is rounded to 6 decimals
+
+
+def _tile(latitude, longitude):
+    return floor(latitude / TILE_DEG), floor((longitude + 180) / TILE_DEG) % int(round(360 / TILE_DEG))
+
+
+def _version_keys(layer, latitude, longitude, radius_km):
+    """Version counters an entry for this search depends on."""
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+    rows = range(floor(min_lat / TILE_DEG), floor(max_lat / TILE_DEG) + 1)
+    cols = range(floor((min_lon + 180) / TILE_DEG), floor((max_lon + 180) / TILE_DEG) + 1)
+    if max_lon - min_lon >= 360 or len(rows) * len(cols) > MAX_TILES:
+        return [f"rc:v:{layer}:*"]
+    lon_tiles = int(round(360 / TILE_DEG))
+    return [f"rc:v:{layer}:{row}:{col % lon_tiles}" for row in rows for col in cols]
+
+
+def _http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _respond(request, body, etag, last_modified, cache_status):
+    headers = {
+        "ETag": etag,
+        "Last-Modified": _http_date(last_modified),
+        "Cache-Control": f"public, max-age={RESPONSE_CACHE_MAX_AGE}",
+        "X-Cache": cache_status,
+    }
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _position(row):
+    if isinstance(row, dict):
+        return row["latitude"], row["longitude"]
+    return row.latitude, row.longitude
+
+
+def _row_id(row):
+    return row["id"] if isinstance(row, dict) else row.id
+
+
+def with_distance(row, distance):
+    """The row with `distance` set, copying cached (pydantic) rows rather than changing them."""
+    if isinstance(row, dict):
+        row["distance"] = distance
+    elif isinstance(row, BaseModel):
+        return row.model_copy(update={"distance": distance})
+    else:
+        row.distance = distance
+    return row
+
+
+class CachedSearch:
+    """
+    One radius search going through the cache. `rows` holds the entry on a hit.
+    On a miss, fetch every row within `area` (latitude, longitude, radius) and
+    pass them to `fill`. Then `within` and `nearby` answer for the caller's own
+    point and radius, and `respond` builds the response.
+    """
+
+    def __init__(self, request, layer, item_type, latitude, longitude, radius, params):
+        self.request = request
+        self.layer = layer
+        self.adapter = TypeAdapter(list[item_type])
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        self.params = params
+        self.area = (latitude, longitude, radius)
+        self.key = None
+        self.rows = None
+        self.built = time.time()
+        self.hit = False
+
+    @property
+    def caching(self):
+        """Whether this search goes through the cache at all."""
+        return self.key is not None
+
+    async def lookup(self):
+        latitude, longitude = snap(self.latitude), snap(self.longitude)
+        radius = round(ceil(self.radius * 10) / 10 + _half_diagonal_km(latitude, longitude), 6)
+        self.area = (latitude, longitude, radius)
+        version_keys = _version_keys(self.layer, latitude, longitude, radius)
+        versions = await backend.get_many(version_keys)
+        digest = hashlib.blake2b(
+            repr((version_keys, versions, self.params)).encode(), digest_size=12
+        ).hexdigest()
+        self.key = f"rc:{self.layer}:{latitude}:{longitude}:{radius}:{digest}"
+
+        entry = await backend.get(self.key)
+        if entry is not None:
+            built, body = entry.split(b"\n", 1)
+            self.built = float(built)
+            self.rows = self.adapter.validate_json(body)
+            self.hit = True
+        return self
+
+    async def fill(self, rows):
+        """
+        Use `rows`, every row within `area`, and cache them if there are not too
+        many. Cached searches keep them as response models, as a hit would.
+        """
+        if not self.caching:
+            self.rows = rows
+            return
+        self.rows = self.adapter.validate_python(rows)
+        if len(rows) <= MAX_ROWS:
+            body = self.adapter.dump_json(self.rows)
+            await backend.set(self.key, b"%f\n%s" % (self.built, body), RESPONSE_CACHE_TTL)
+
+    def within(self):
+        """(row, distance) for each row within the caller's radius, measured from the caller's point."""
+        if not self.rows:
+            return []
+        row_distances = distances(
+            Points(*zip(*(_position(row) for row in self.rows))), self.latitude, self.longitude
+        )
+        return [
+            (self.rows[i], float(row_distances[i]))
+            for i in np.flatnonzero(row_distances <= self.radius)
+        ]
+
+    def nearby(self, limit=None, offset=0):
+        """(page of rows nearest first with `distance` set, total within the radius)."""
+        found = sorted(self.within(), key=lambda pair: (pair[1], _row_id(pair[0])))
+        end = offset + limit if limit is not None else None
+        return [with_distance(row, distance) for row, distance in found[offset:end]], len(found)
+
+    def respond(self, payload):
+        """Serialize the response model `payload` into the response."""
+        body = payload.model_dump_json().encode()
+        if not self.caching:
+            return Response(content=body, media_type="application/json")
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        return _respond(self.request, body, etag, int(self.built), "HIT" if self.hit else "MISS")
+
+
+async def search(request, model, item_type, latitude, longitude, radius, **params):
+    """
+    Look a radius search up in the cache. `item_type` is the response model of
+    one row and `params` holds every other argument the cached rows depend on
+    (not paging, which is applied per request).
+    """
+    cached = CachedSearch(request, model.__tablename__, item_type, latitude, longitude, radius, params)
+    if backend is None or radius > MAX_RADIUS_KM:
+        return cached
+    return await cached.lookup()
+
+
+async def invalidate(model, *positions):
+    """
+    Retire cached searches that may include a row at any of `positions`, given as
+    (latitude, longitude) pairs. Call after committing a write, with both the old
+    and the new position when a row moves.
+    """
+    if backend is None:
+        return
+    layer = model.__tablename__
+    tiles = {
+        _tile(latitude, longitude)
+        for latitude, longitude in positions
+        if latitude is not None and longitude is not None
+    }
+    for row, col in tiles:
+        await backend.incr(f"rc:v:{layer}:{row}:{col}")
+    await backend.incr(f"rc:v:{layer}:*")
+
+
+def stats():
+    if backend is None:
+        return {"enabled": False}
+    return {
+        **backend.stats(),
+        "enabled": True,
+        "ttl_seconds": RESPONSE_CACHE_TTL,
+        "grid_deg": GRID_DEG,
+        "tile_deg": TILE_DEG,
+        "max_radius_km": MAX_RADIUS_KM,
+        "max_rows": MAX_ROWS,
+    }
@@ -0,0 +1,151 @@
+"""
+Full-text search over news (title, description) and shelters (name,
+description).
+
+Postgres answers from GIN indexes on a tsvector of the text columns (declared
+on the models, migration 0006). SQLite answers from FTS5 tables that triggers
+keep in step with the base tables, created by create_index at startup. Either
+way every insert, update and delete, whichever route, batch writer or import
+makes it, updates the index in its own transaction.
+
+Every word of a query must match the start of a word in the row, so "floo rel"
+finds "Flood relief camp". The 'simple' configuration does no stemming and
+keeps stop words: posts mix English with Indian languages, and prefix matching
+already covers most inflections. SQLite also folds accents; Postgres would
+need the unaccent extension for that. Results are ranked by relevance (BM25 on
+SQLite, ts_rank_cd on Postgres) with matches in the first column (title or
+name) weighted above the description, and can be restricted to a radius.
+"""
+import unicodedata
+from fastapi import HTTPException, status
+from sqlalchemy import column, func, literal_column, select, table
+from Model import News, Shelters, search_document
+from app.utils.geo import distance_km_term, radius_filter
+
+MAX_TERMS = 8
+
+# model -> (first column, description column)
+SEARCHABLE = {News: ("title", "description"), Shelters: ("name", "description")}
+
+# BM25 weight of the first column relative to the description
+FIRST_COLUMN_WEIGHT = 4.0
+
+def fts_table(model):
+    return f"{model.__tablename__}_fts"
+
+
+def _sqlite_statements(model):
+    """DDL of the FTS5 table of `model` and the triggers keeping it in sync."""
+    name = model.__tablename__
+    fts = fts_table(model)
+    first, second = SEARCHABLE[model]
+    columns = f"{first}, {second}"
+    new = f"new.id, new.{first}, new.{second}"
+    old = f"'delete', old.id, old.{first}, old.{second}"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, content='{name}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {name} BEGIN "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES ({new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {name} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ({old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {columns} ON {name} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ({old}); "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES ({new}); END",
+    ]
+
+
+def create_index(connection):
+    """
+    Create the SQLite FTS5 tables and triggers if they are missing, indexing the
+    rows already there. Postgres gets its GIN indexes from the models instead.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for model in SEARCHABLE:
+        fts = fts_table(model)
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)
+        ).first()
+        for statement in _sqlite_statements(model):
+            connection.exec_driver_sql(statement)
+        if not exists:
+            connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _words(text):
+    # Combining marks (Devanagari vowel signs, nukta) belong to the word, though \w excludes them
+    word = []
+    for character in text:
+        if character.isalnum() or unicodedata.category(character).startswith("M"):
+            word.append(character)
+        elif word:
+            yield "".join(word)
+            word = []
+    if word:
+        yield "".join(word)
+
+
+def terms(query):
+    words = list(_words(query.lower()))[:MAX_TERMS]
+    if not words:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search query has no words")
+    return words
+
+
+def _sqlite_search(model, words):
+    """(select of model and rank, match condition); lower rank is better."""
+    fts = table(fts_table(model), column("rowid"))
+    fts_column = literal_column(fts.name)
+    rank = func.bm25(fts_column, FIRST_COLUMN_WEIGHT, 1.0).label("relevance")
+    match = fts_column.op("MATCH")(" ".join(f'"{word}"*' for word in words))
+    statement = select(model, rank).select_from(fts.join(model.__table__, model.id == fts.c.rowid))
+    return statement, match, rank
+
+
+def _postgres_search(model, words):
+    """(select of model and rank, match condition); lower rank is better."""
+    first, second = SEARCHABLE[model]
+    query = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{word}:*" for word in words))
+    match = literal_column(search_document(first, second)).op("@@")(query)
+    weighted = literal_column(
+        f"setweight(to_tsvector('simple', coalesce({first}, '')), 'A') || "
+        f"setweight(to_tsvector('simple', coalesce({second}, '')), 'B')"
+    )
+    rank = (-func.ts_rank_cd(weighted, query)).label("relevance")
+    return select(model, rank), match, rank
+
+
+async def search(db, model, query, latitude=None, longitude=None, radius_km=None, limit=20, offset=0):
+    """
+    Rows of `model` matching every word of `query`, most relevant first, and the
+    total number of matches. With a point and radius only rows inside it count,
+    and each row gets its `distance`.
+    """
+    words = terms(query)
+    if db.bind.dialect.name == "sqlite":
+        statement, match, rank = _sqlite_search(model, words)
+    else:
+        statement, match, rank = _postgres_search(model, words)
+
+    conditions = [match]
+    geo = latitude is not None and longitude is not None and radius_km is not None
+    if geo:
+        conditions.append(radius_filter(model, latitude, longitude, radius_km))
+        statement = statement.add_columns(distance_km_term(model, latitude, longitude))
+
+    rows = (await db.execute(statement.where(*conditions).order_by(rank, model.id).limit(limit).offset(offset))).all()
+    if offset == 0 and len(rows) < limit:
+        total = len(rows)
+    else:
+        total = await db.scalar(
+            statement.with_only_columns(func.count(model.id)).where(*conditions).order_by(None)
+        )
+
+    results = []
+    for row in rows:
+        item = row[0]
+        if geo:
+            item.distance = row[2]
+        results.append(item)
+    return results, total
@@ -0,0 +1,222 @@
+"""
+Write-behind buffer for SOS submissions that arrive above the rate limits.
+
+Rate limited submissions are never rejected. They are held here and written by
+a background task every SOS_BUFFER_FLUSH_MS, or sooner once SOS_BUFFER_BATCH
+alerts are waiting, through the SOS batch writer. Repeats are coalesced on
+the way in: a submission within SOS_DEDUP_METERS of an alert the same signed-in
+user already has waiting raises that alert's persons instead of adding another,
+and at flush time an alert that repeats the user's recent saved alert updates
+that row. Anonymous alerts are only known by their IP, which a whole camp's
+Wi-Fi or a carrier NAT may share, so each is kept as its own alert. Nothing is dropped: a failed flush puts the batch back
+and is retried, and shutdown flushes whatever is left.
+
+Flushed alerts are published to /sos/stream and clustered like any other.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from dotenv import load_dotenv
+from loguru import logger
+from Model import SOS
+from app.utils import map_tiles, sos_clusters
+from app.utils.batch_writer import sos_writer
+from app.utils.distance import haversine
+from app.utils.pincode_stats import pincode_stats
+from app.utils.pubsub import sos_event, sos_feed
+
+load_dotenv()
+
+SOS_BUFFER_FLUSH_MS = float(os.getenv("SOS_BUFFER_FLUSH_MS", "200"))
+SOS_BUFFER_BATCH = int(os.getenv("SOS_BUFFER_BATCH", "500"))
+SOS_BUFFER_RETRY_SECONDS = float(os.getenv("SOS_BUFFER_RETRY_SECONDS", "1"))
+
+
+class PendingAlert:
+    __slots__ = ("user_id", "pincode", "latitude", "longitude", "persons", "createdAt", "reports")
+
+    def __init__(self, user_id, pincode, latitude, longitude, persons, created_at):
+        self.user_id = user_id
+        self.pincode = pincode
+        self.latitude = latitude
+        self.longitude = longitude
+        self.persons = persons
+        self.createdAt = created_at
+        self.reports = 1
+
+    def absorb(self, other):
+        self.persons = max(self.persons, other.persons)
+        self.createdAt = min(self.createdAt, other.createdAt)
+        self.reports += other.reports
+
+
+class SOSBuffer:
+    def __init__(self):
+        self._pending = {}  # sender -> [PendingAlert]
+        self._size = 0
+        self._wakeup = None
+        self._task = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.inserted = 0
+        self.merged = 0  # repeats of an already saved alert
+        self.flushes = 0
+        self.flush_failures = 0
+        self.last_flush_seconds = None
+
+    def __len__(self):
+        return self._size
+
+    def submit(self, sender, user_id, pincode, latitude, longitude, persons):
+        """Queue an alert for `sender` (user id or client IP). Returns the pending alert."""
+        alert = PendingAlert(user_id, pincode, latitude, longitude, persons or 1, datetime.utcnow())
+        self.submitted += 1
+        pending = self._coalesce(sender, alert)
+        if self._size >= SOS_BUFFER_BATCH and self._wakeup is not None:
+            self._wakeup.set()
+        return pending
+
+    def _coalesce(self, sender, alert, counted=True):
+        queue = self._pending.setdefault(sender, [])
+        if alert.user_id is not None:
+            for pending in queue:
+                if haversine(pending.latitude, pending.longitude, alert.latitude, alert.longitude) <= sos_clusters.DEDUP_KM:
+                    pending.absorb(alert)
+                    if counted:
+                        self.coalesced += 1
+                    return pending
+        queue.append(alert)
+        self._size += 1
+        return alert
+
+    def _take(self):
+        pending, self._pending, self._size = self._pending, {}, 0
+        return pending
+
+    def _restore(self, pending):
+        """Put a batch that failed to flush back in front of anything newer."""
+        newer, self._pending, self._size = self._pending, {}, 0
+        # Already counted when they were submitted
+        for sender, alerts in pending.items():
+            for alert in alerts:
+                self._coalesce(sender, alert, counted=False)
+        for sender, alerts in newer.items():
+            for alert in alerts:
+                self._coalesce(sender, alert)
+
+    async def flush(self):
+        """Write everything pending through the SOS batch writer. Returns the number of alerts written."""
+        pending = self._take()
+        if not pending:
+            return 0
+        started = time.perf_counter()
+
+        writes = []  # (sender, alert, previous alert id or None, its persons, future)
+        for sender, queue in pending.items():
+            for alert in queue:
+                previous = sos_clusters.duplicate_of(alert.user_id, alert.latitude, alert.longitude, alert.createdAt)
+                previous_persons = None if previous is None else (sos_clusters.engine.persons_of(previous) or 0)
+                if previous is None:
+                    future = sos_writer.insert({
+                        "userId": alert.user_id,
+                        "createdAt": alert.createdAt,
+                        "issue_rectified": False,
+                        "latitude": alert.latitude,
+                        "longitude": alert.longitude,
+                        "persons": alert.persons,
+                        "resolved": False,
+                        "pincode": alert.pincode,
+                    })
+                elif alert.persons > previous_persons:
+                    # Only ever raise persons on the saved alert
+                    future = sos_writer.update(previous, {"persons": alert.persons})
+                else:
+                    self.merged += 1
+                    continue
+                writes.append((sender, alert, previous, previous_persons, future))
+
+        results = await asyncio.gather(*(future for *_, future in writes), return_exceptions=True)
+        failed = {}
+        for (sender, alert, previous, previous_persons, _), result in zip(writes, results):
+            if isinstance(result, Exception):
+                failed.setdefault(sender, []).append(alert)
+            elif previous is None:
+                saved = SOS(
+                    id=result, userId=alert.user_id, createdAt=alert.createdAt, latitude=alert.latitude,
+                    longitude=alert.longitude, persons=alert.persons, resolved=False, pincode=alert.pincode,
+                )
+                sos_feed.publish(sos_event("sos", saved))
+                sos_clusters.add(saved)
+                pincode_stats.record(alert.pincode, sos_unresolved=1, persons=alert.persons)
+                map_tiles.invalidate(SOS, (alert.latitude, alert.longitude))
+                self.inserted += 1
+            else:
+                position = sos_clusters.engine.position_of(previous)
+                if position is not None:
+                    map_tiles.invalidate(SOS, position)
+                sos_clusters.update_persons(previous, alert.persons)
+                # The saved alert came from the same sender, so from the same pincode
+                pincode_stats.record(alert.pincode, persons=alert.persons - previous_persons)
+                self.merged += 1
+
+        self.flushes += 1
+        self.last_flush_seconds = time.perf_counter() - started
+        if failed:
+            self.flush_failures += 1
+            self._restore(failed)
+            count = sum(len(alerts) for alerts in failed.values())
+            logger.error(f"{count} buffered SOS alerts could not be saved, will retry")
+            raise RuntimeError(f"{count} buffered SOS alerts could not be saved")
+        return len(writes)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), SOS_BUFFER_FLUSH_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(SOS_BUFFER_RETRY_SECONDS)
+
+    def start(self):
+        """Start flushing on the running event loop."""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self, attempts=5):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for attempt in range(attempts):
+            try:
+                await self.flush()
+                return
+            except Exception:
+                await asyncio.sleep(SOS_BUFFER_RETRY_SECONDS)
+        if self._size:
+            logger.critical(f"{self._size} buffered SOS alerts could not be saved on shutdown")
+
+    def stats(self):
+        return {
+            "pending": self._size,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "inserted": self.inserted,
+            "merged_into_saved": self.merged,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+sos_buffer = SOSBuffer()
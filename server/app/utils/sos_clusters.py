@@ -0,0 +1,458 @@
+"""
+Incremental spatio-temporal clustering of unresolved SOS alerts.
+
+Two alerts are linked when they are at most SOS_CLUSTER_RADIUS_KM apart and
+their createdAt times differ by at most SOS_CLUSTER_WINDOW_MINUTES. A cluster is
+a connected group of linked alerts, i.e. DBSCAN with a minimum of one point, so
+a single alert is a cluster of its own.
+
+Alerts are bucketed in a grid of cells whose diagonal is the link radius, one
+window long in time, so the alerts of a cell always share a cluster. Adding an
+alert only looks at the neighbouring cells, and stops scanning a cell as soon
+as its cluster is known; merging moves the smaller cluster's cells into the
+larger one. Removing an alert (resolved, or older than
+SOS_CLUSTER_RETENTION_HOURS) can only split its cluster if it emptied its cell
+or was the cell's last link to a neighbouring cell. Such clusters are marked
+dirty and re-linked locally, cell by cell among their own cells, the next time
+clusters are read.
+
+The engine also spots repeated reports: an alert from the same user within
+SOS_DEDUP_SECONDS and SOS_DEDUP_METERS of their previous unresolved alert is
+reported as a duplicate of it.
+
+Like the spatial index, the engine is per process. It is loaded from the
+database on startup and kept current by the SOS handlers.
+"""
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from math import cos, floor, radians, sqrt
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import select
+from Model import SOS
+from app.utils.distance import Points, distances, haversine
+from app.utils.geo import bounding_box, KM_PER_DEGREE_LAT
+
+load_dotenv()
+
+SOS_CLUSTERING_ENABLED = os.getenv("SOS_CLUSTERING_ENABLED", "true").lower() == "true"
+CLUSTER_RADIUS_KM = float(os.getenv("SOS_CLUSTER_RADIUS_KM", "0.5"))
+CLUSTER_WINDOW_SECONDS = float(os.getenv("SOS_CLUSTER_WINDOW_MINUTES", "60")) * 60
+RETENTION_SECONDS = float(os.getenv("SOS_CLUSTER_RETENTION_HOURS", "48")) * 3600
+DEDUP_SECONDS = float(os.getenv("SOS_DEDUP_SECONDS", "600"))
+DEDUP_KM = float(os.getenv("SOS_DEDUP_METERS", "200")) / 1000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp(created_at):
+    """Seconds since the epoch for the naive UTC datetimes stored on SOS rows."""
+    return (created_at - EPOCH).total_seconds()
+
+
+class Alert:
+    __slots__ = ("id", "latitude", "longitude", "time", "persons", "user_id", "cell")
+
+    def __init__(self, alert_id, latitude, longitude, time, persons, user_id):
+        self.id = alert_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.time = time
+        self.persons = persons
+        self.user_id = user_id
+        self.cell = None
+
+
+class Cell:
+    """Alerts sharing a grid cell and time bucket; always one cluster."""
+
+    __slots__ = ("key", "alerts", "cluster")
+
+    def __init__(self, key):
+        self.key = key
+        self.alerts = set()
+        self.cluster = None
+
+
+class Cluster:
+    __slots__ = ("id", "cells", "count", "persons", "sum_lat", "sum_lon", "first", "last")
+
+    def __init__(self, cluster_id):
+        self.id = cluster_id
+        self.cells = set()
+        self.count = 0
+        self.persons = 0
+        self.sum_lat = 0.0
+        self.sum_lon = 0.0
+        self.first = float("inf")
+        self.last = float("-inf")
+
+    def add_alert(self, alert):
+        self.count += 1
+        self.persons += alert.persons
+        self.sum_lat += alert.latitude
+        self.sum_lon += alert.longitude
+        self.first = min(self.first, alert.time)
+        self.last = max(self.last, alert.time)
+
+    def remove_alert(self, alert):
+        # first/last are recomputed when the cluster is settled
+        self.count -= 1
+        self.persons -= alert.persons
+        self.sum_lat -= alert.latitude
+        self.sum_lon -= alert.longitude
+
+    def take(self, cell):
+        """Make `cell` and its alerts part of this cluster."""
+        cell.cluster = self
+        self.cells.add(cell)
+        for alert in cell.alerts:
+            self.add_alert(alert)
+
+    def absorb(self, other):
+        for cell in other.cells:
+            cell.cluster = self
+        self.cells |= other.cells
+        self.id = min(self.id, other.id)
+        self.count += other.count
+        self.persons += other.persons
+        self.sum_lat += other.sum_lat
+        self.sum_lon += other.sum_lon
+        self.first = min(self.first, other.first)
+        self.last = max(self.last, other.last)
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "latitude": self.sum_lat / self.count,
+            "longitude": self.sum_lon / self.count,
+            "alerts": self.count,
+            "persons": self.persons,
+            "startedAt": EPOCH + timedelta(seconds=self.first),
+            "updatedAt": EPOCH + timedelta(seconds=self.last),
+        }
+
+
+class ClusterEngine:
+    def __init__(self, radius_km=CLUSTER_RADIUS_KM, window_seconds=CLUSTER_WINDOW_SECONDS,
+                 retention_seconds=RETENTION_SECONDS):
+        self.radius_km = radius_km
+        self.window = window_seconds
+        self.retention = retention_seconds
+        # A cell's diagonal is the link radius, so alerts sharing a cell and a
+        # time bucket (one window long) are always linked to each other
+        self.cell_deg = radius_km / sqrt(2) / KM_PER_DEGREE_LAT
+        self.lon_cells = max(1, int(360 / self.cell_deg))
+        self._near = (radius_km * 0.99) ** 2
+        self._far = (radius_km * 1.01) ** 2
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._cells = {}  # (row, col, time bucket) -> Cell
+        self._alerts = {}  # id -> Alert
+        self._clusters = set()
+        self._dirty = set()  # may have split
+        self._stale = set()  # first/last may be out of date
+        self._latest_by_user = {}  # user id -> Alert
+        self._arrivals = deque()  # Alert in insertion order, for expiry
+        self.merges = 0
+        self.splits = 0
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def _key(self, latitude, longitude, time):
+        return (
+            floor(latitude / self.cell_deg),
+            floor((longitude + 180) / self.cell_deg) % self.lon_cells,
+            floor(time / self.window),
+        )
+
+    def _keys_near(self, latitude, longitude, radius_km, bucket):
+        """Keys of the cells within `radius_km` of the point, in adjacent time buckets."""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_km)
+        rows = range(floor(min_lat / self.cell_deg), floor(max_lat / self.cell_deg) + 1)
+        col_lo = floor((min_lon + 180) / self.cell_deg)
+        col_hi = floor((max_lon + 180) / self.cell_deg)
+        if col_hi - col_lo + 1 >= self.lon_cells:
+            cols = range(self.lon_cells)
+        else:
+            cols = [col % self.lon_cells for col in range(col_lo, col_hi + 1)]
+        return [(row, col, bucket + step) for row in rows for col in cols for step in (-1, 0, 1)]
+
+    def _linked(self, a, b):
+        if abs(a.time - b.time) > self.window:
+            return False
+        # Flat-earth estimate first; haversine only decides the close calls
+        dy = (a.latitude - b.latitude) * KM_PER_DEGREE_LAT
+        dx = (a.longitude - b.longitude) * KM_PER_DEGREE_LAT * cos(radians(a.latitude))
+        estimate = dx * dx + dy * dy
+        if estimate > self._far:
+            return False
+        if estimate < self._near:
+            return True
+        return haversine(a.latitude, a.longitude, b.latitude, b.longitude) <= self.radius_km
+
+    def _cells_linked(self, a, b):
+        return any(self._linked(x, y) for x in a.alerts for y in b.alerts)
+
+    def add(self, alert_id, latitude, longitude, created_at, persons=1, user_id=None):
+        """Insert an alert and link it into its cluster."""
+        with self._lock:
+            if alert_id in self._alerts:
+                return
+            alert = Alert(alert_id, latitude, longitude, timestamp(created_at), persons or 1, user_id)
+            self._expire(alert.time)
+            key = self._key(latitude, longitude, alert.time)
+            cell = self._cells.get(key)
+
+            # Clusters this alert links to; a cell is skipped once its cluster is known
+            found = set()
+            if cell is not None:
+                found.add(cell.cluster)
+            for near in self._keys_near(latitude, longitude, self.radius_km, key[2]):
+                other = self._cells.get(near)
+                if other is None or other is cell or other.cluster in found:
+                    continue
+                if any(self._linked(alert, member) for member in other.alerts):
+                    found.add(other.cluster)
+
+            if found:
+                target = max(found, key=lambda cluster: len(cluster.cells))
+                for cluster in found - {target}:
+                    target.absorb(cluster)
+                    self._clusters.discard(cluster)
+                    for pending in (self._dirty, self._stale):
+                        if cluster in pending:
+                            pending.discard(cluster)
+                            pending.add(target)
+                    self.merges += 1
+            else:
+                target = Cluster(alert_id)
+                self._clusters.add(target)
+
+            if cell is None:
+                cell = self._cells[key] = Cell(key)
+                cell.cluster = target
+                target.cells.add(cell)
+            cell.alerts.add(alert)
+            alert.cell = cell
+            target.add_alert(alert)
+
+            self._alerts[alert_id] = alert
+            self._arrivals.append(alert)
+            if user_id is not None:
+                self._latest_by_user[user_id] = alert
+
+    def remove(self, alert_id):
+        """Drop an alert (resolved or deleted). Returns False if it was not tracked."""
+        with self._lock:
+            alert = self._alerts.pop(alert_id, None)
+            if alert is None:
+                return False
+            self._detach(alert)
+            return True
+
+    def _detach(self, alert):
+        cell = alert.cell
+        cluster = cell.cluster
+        cell.alerts.discard(alert)
+        cluster.remove_alert(alert)
+        if not cell.alerts:
+            del self._cells[cell.key]
+            cluster.cells.discard(cell)
+        if self._latest_by_user.get(alert.user_id) is alert:
+            del self._latest_by_user[alert.user_id]
+
+        if not cluster.cells:
+            self._clusters.discard(cluster)
+            self._dirty.discard(cluster)
+            self._stale.discard(cluster)
+        elif not cell.alerts or self._was_bridge(alert, cell):
+            self._dirty.add(cluster)
+        elif alert.time in (cluster.first, cluster.last):
+            self._stale.add(cluster)
+
+    def _was_bridge(self, alert, cell):
+        """
+        Whether removing `alert` from the still occupied `cell` may have cut a
+        link between the cell and a neighbouring cell of the same cluster. If
+        every neighbour it linked to is still linked to the cell, the cluster
+        stays connected.
+        """
+        for key in self._keys_near(alert.latitude, alert.longitude, self.radius_km, cell.key[2]):
+            other = self._cells.get(key)
+            if other is None or other is cell or other.cluster is not cell.cluster:
+                continue
+            if any(self._linked(alert, member) for member in other.alerts) and not self._cells_linked(cell, other):
+                return True
+        return False
+
+    def _expire(self, now):
+        cutoff = now - self.retention
+        while self._arrivals and self._arrivals[0].time < cutoff:
+            alert = self._arrivals.popleft()
+            if self._alerts.get(alert.id) is alert:
+                del self._alerts[alert.id]
+                self._detach(alert)
+        # Removed alerts stay in the deque until they reach the front
+        if len(self._arrivals) > 2 * len(self._alerts) + 1024:
+            self._arrivals = deque(alert for alert in self._arrivals if self._alerts.get(alert.id) is alert)
+
+    def persons_of(self, alert_id):
+        """Persons on a tracked (unresolved) alert, None if it is not tracked."""
+        with self._lock:
+            alert = self._alerts.get(alert_id)
+            return alert.persons if alert is not None else None
+
+    def position_of(self, alert_id):
+        """(latitude, longitude) of a tracked (unresolved) alert, None if it is not tracked."""
+        with self._lock:
+            alert = self._alerts.get(alert_id)
+            return (alert.latitude, alert.longitude) if alert is not None else None
+
+    def update_persons(self, alert_id, persons):
+        with self._lock:
+            alert = self._alerts.get(alert_id)
+            if alert is not None:
+                alert.cell.cluster.persons += persons - alert.persons
+                alert.persons = persons
+
+    def _settle(self):
+        """Re-link the cells of clusters that lost alerts, splitting where needed."""
+        reach = self.radius_km * 1.5  # link radius plus half a cell diagonal
+        while self._stale:
+            cluster = self._stale.pop()
+            if cluster in self._dirty:
+                continue
+            times = [alert.time for cell in cluster.cells for alert in cell.alerts]
+            cluster.first, cluster.last = min(times), max(times)
+        while self._dirty:
+            cluster = self._dirty.pop()
+            self._clusters.discard(cluster)
+            remaining = set(cluster.cells)
+            while remaining:
+                start = remaining.pop()
+                component = Cluster(min(alert.id for alert in start.alerts))
+                component.take(start)
+                frontier = [start]
+                while frontier:
+                    cell = frontier.pop()
+                    row, col, bucket = cell.key
+                    latitude = (row + 0.5) * self.cell_deg
+                    longitude = (col + 0.5) * self.cell_deg - 180
+                    for key in self._keys_near(latitude, longitude, reach, bucket):
+                        other = self._cells.get(key)
+                        if other in remaining and self._cells_linked(cell, other):
+                            remaining.discard(other)
+                            component.id = min(component.id, min(alert.id for alert in other.alerts))
+                            component.take(other)
+                            frontier.append(other)
+                self._clusters.add(component)
+                if remaining:
+                    self.splits += 1
+
+    def duplicate_of(self, user_id, latitude, longitude, created_at):
+        """The id of the user's previous alert if this one repeats it, else None."""
+        if user_id is None:
+            return None
+        with self._lock:
+            previous = self._latest_by_user.get(user_id)
+            if previous is None or timestamp(created_at) - previous.time > DEDUP_SECONDS:
+                return None
+            if haversine(latitude, longitude, previous.latitude, previous.longitude) > DEDUP_KM:
+                return None
+            return previous.id
+
+    def clusters(self, latitude=None, longitude=None, radius_km=None, min_alerts=1, since=None):
+        """
+        Cluster summaries, optionally only those whose centroid lies within the
+        radius (nearest first) and that were active at or after `since`.
+        Without a location the clusters with the most persons come first.
+        """
+        since = None if since is None else timestamp(since)
+        with self._lock:
+            self._expire(timestamp(datetime.utcnow()))
+            self._settle()
+            summaries = [
+                cluster.summary() for cluster in self._clusters
+                if cluster.count >= min_alerts and (since is None or cluster.last >= since)
+            ]
+
+        if latitude is None or longitude is None:
+            summaries.sort(key=lambda summary: (-summary["persons"], summary["id"]))
+            return summaries
+        if not summaries:
+            return []
+        centroid_distances = distances(
+            Points([s["latitude"] for s in summaries], [s["longitude"] for s in summaries]), latitude, longitude
+        )
+        inside = np.flatnonzero(centroid_distances <= radius_km) if radius_km is not None else np.arange(len(summaries))
+        order = inside[np.argsort(centroid_distances[inside], kind="stable")]
+        results = []
+        for i in order:
+            summaries[i]["distance"] = round(float(centroid_distances[i]), 2)
+            results.append(summaries[i])
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    async def rebuild(self, db):
+        """Reload unresolved alerts within the retention period from the database."""
+        since = datetime.utcnow() - timedelta(seconds=self.retention)
+        rows = await db.stream(
+            select(SOS.id, SOS.latitude, SOS.longitude, SOS.createdAt, SOS.persons, SOS.userId)
+            .where(SOS.resolved == False, SOS.createdAt >= since)
+            .order_by(SOS.createdAt, SOS.id)
+            .execution_options(yield_per=5000)
+        )
+        self.clear()
+        async for row in rows:
+            self.add(*row)
+        return len(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "alerts": len(self._alerts),
+                "clusters": len(self._clusters),
+                "dirty_clusters": len(self._dirty),
+                "stale_clusters": len(self._stale),
+                "cells": len(self._cells),
+                "merges": self.merges,
+                "splits": self.splits,
+                "radius_km": self.radius_km,
+                "window_minutes": self.window / 60,
+                "retention_hours": self.retention / 3600,
+            }
+
+
+engine = ClusterEngine()
+
+
+def add(alert):
+    """Cluster a newly saved SOS row."""
+    if SOS_CLUSTERING_ENABLED:
+        engine.add(alert.id, alert.latitude, alert.longitude, alert.createdAt, alert.persons, alert.userId)
+
+
+def remove(alert_id):
+    """Drop a resolved SOS alert from its cluster."""
+    if SOS_CLUSTERING_ENABLED:
+        engine.remove(alert_id)
+
+
+def duplicate_of(user_id, latitude, longitude, created_at):
+    if not SOS_CLUSTERING_ENABLED:
+        return None
+    return engine.duplicate_of(user_id, latitude, longitude, created_at)
+
+
+def update_persons(alert_id, persons):
+    if SOS_CLUSTERING_ENABLED:
+        engine.update_persons(alert_id, persons)
@@ -0,0 +1,448 @@
+"""
+Optional in-process spatial index for the location based tables.
+
+Each layer (shelters, food, news) keeps a uniform latitude/longitude grid of row
+snapshots so radius and nearest-neighbour queries can be answered without a
+database round-trip. The index is built on startup and kept current by the
+add/update/delete handlers. Enable it with SPATIAL_INDEX_ENABLED=true.
+
+The index is per process: with several workers, a write only reaches the index of
+the worker that handled it until the next rebuild.
+"""
+import heapq
+import os
+import sys
+import threading
+from math import floor, cos, sin, asin, radians
+from dotenv import load_dotenv
+from sqlalchemy import select
+from Model import Shelters, FoodProvidingRegions, News
+import numpy as np
+from app.utils.distance import EARTH_RADIUS_KM, Points, distances
+from app.utils.geo import bounding_box, nearby, KM_PER_DEGREE_LAT
+
+load_dotenv()
+
+SPATIAL_INDEX_ENABLED = os.getenv("SPATIAL_INDEX_ENABLED", "false").lower() == "true"
+CELL_SIZE_DEG = float(os.getenv("SPATIAL_INDEX_CELL_DEG", "0.05"))  # ~5.5 km cells
+
+
+def snapshot(row):
+    """Copy the column values of an ORM row into a plain dict."""
+    return {column.name: getattr(row, column.name) for column in row.__table__.columns}
+
+
+class GridIndex:
+    """
+    Uniform grid over latitude/longitude. Cells are keyed by integer
+    (row, col) and hold {id: (latitude, longitude, payload)}.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE_DEG):
+        self.cell_size = cell_size
+        self.lon_cells = int(round(360 / cell_size))
+        self._cells = {}
+        self._points = {}  # id -> cell key
+        self._arrays = {}  # cell key -> (ids, Points, payloads), see _cell_arrays
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, latitude, longitude):
+        row = floor(latitude / self.cell_size)
+        col = floor((longitude + 180) / self.cell_size) % self.lon_cells
+        return row, col
+
+    def insert(self, point_id, latitude, longitude, payload=None):
+        """Insert a point, replacing any previous entry with the same id."""
+        with self._lock:
+            self.remove(point_id)
+            key = self._cell(latitude, longitude)
+            self._cells.setdefault(key, {})[point_id] = (latitude, longitude, payload)
+            self._arrays.pop(key, None)
+            self._points[point_id] = key
+
+    def remove(self, point_id):
+        """Remove a point. Returns False if it was not indexed."""
+        with self._lock:
+            key = self._points.pop(point_id, None)
+            if key is None:
+                return False
+            cell = self._cells[key]
+            del cell[point_id]
+            self._arrays.pop(key, None)
+            if not cell:
+                del self._cells[key]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._cells = {}
+            self._points = {}
+            self._arrays = {}
+
+    def get(self, point_id):
+        """Return (latitude, longitude, payload) for an indexed id, or None."""
+        with self._lock:
+            key = self._points.get(point_id)
+            return None if key is None else self._cells[key][point_id]
+
+    def items(self):
+        """Snapshot of (id, latitude, longitude, payload) for every point."""
+        with self._lock:
+            return [
+                (point_id, lat, lon, payload)
+                for cell in self._cells.values()
+                for point_id, (lat, lon, payload) in cell.items()
+            ]
+
+    def _cells_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        row_lo = floor(min_lat / self.cell_size)
+        row_hi = floor(max_lat / self.cell_size)
+        if max_lon - min_lon >= 360:
+            cols = range(self.lon_cells)
+        else:
+            col_lo = floor((min_lon + 180) / self.cell_size)
+            col_hi = floor((max_lon + 180) / self.cell_size)
+            cols = [col % self.lon_cells for col in range(col_lo, col_hi + 1)]
+
+        # For very large boxes it is cheaper to walk the populated cells
+        if (row_hi - row_lo + 1) * len(cols) > len(self._cells):
+            col_set = set(cols)
+            return [
+                cell for (row, col), cell in self._cells.items()
+                if row_lo <= row <= row_hi and col in col_set
+            ]
+
+        cells = []
+        for row in range(row_lo, row_hi + 1):
+            for col in cols:
+                cell = self._cells.get((row, col))
+                if cell:
+                    cells.append(cell)
+        return cells
+
+    def within(self, latitude, longitude, radius_km):
+        """Return [(id, distance_km, payload)] for points inside the radius, nearest first."""
+        with self._lock:
+            cells = self._cells_in_box(*bounding_box(latitude, longitude, radius_km))
+            candidates = [
+                (point_id, lat, lon, payload)
+                for cell in cells
+                for point_id, (lat, lon, payload) in cell.items()
+            ]
+
+        if not candidates:
+            return []
+
+        points = Points([c[1] for c in candidates], [c[2] for c in candidates])
+        candidate_distances = distances(points, latitude, longitude)
+        inside = np.flatnonzero(candidate_distances <= radius_km)
+        order = inside[np.argsort(candidate_distances[inside], kind="stable")]
+        return [
+            (candidates[i][0], float(candidate_distances[i]), candidates[i][3]) for i in order
+        ]
+
+    def _ring_bound(self, latitude, ring):
+        """Lower bound (km) on the distance to any point outside rings 0..ring."""
+        gap = ring * self.cell_size
+        lat_bound = gap * KM_PER_DEGREE_LAT
+        if gap >= 90:
+            return lat_bound
+        lon_bound = EARTH_RADIUS_KM * asin(min(1.0, cos(radians(latitude)) * sin(radians(gap))))
+        return min(lat_bound, lon_bound)
+
+    def _ring_cells(self, row0, col0, ring):
+        if ring == 0:
+            yield row0, col0
+            return
+        for row in (row0 - ring, row0 + ring):
+            for col in range(col0 - ring, col0 + ring + 1):
+                yield row, col % self.lon_cells
+        for row in range(row0 - ring + 1, row0 + ring):
+            yield row, (col0 - ring) % self.lon_cells
+            yield row, (col0 + ring) % self.lon_cells
+
+    def _cell_bound(self, latitude, longitude, key):
+        """Lower bound (km) on the distance from the point to anything in the cell."""
+        row, col = key
+        south = row * self.cell_size
+        lat_gap = max(0.0, south - latitude, latitude - south - self.cell_size)
+        # Degrees east of the cell's western edge, wrapped into [0, 360)
+        offset = (longitude - (col * self.cell_size - 180)) % 360
+        lon_gap = 0.0 if offset <= self.cell_size else min(offset - self.cell_size, 360 - offset)
+        bound = lat_gap * KM_PER_DEGREE_LAT
+        if 0 < lon_gap < 90:
+            # Distance to the great circle of the nearer meridian edge
+            bound = max(bound, EARTH_RADIUS_KM * asin(min(1.0, cos(radians(latitude)) * sin(radians(lon_gap)))))
+        return bound
+
+    def _cell_arrays(self, key):
+        """(ids, Points, payloads) of a cell, built on first use and dropped when the cell changes."""
+        arrays = self._arrays.get(key)
+        if arrays is None:
+            entries = list(self._cells[key].items())
+            arrays = self._arrays[key] = (
+                [point_id for point_id, _ in entries],
+                Points([entry[0] for _, entry in entries], [entry[1] for _, entry in entries]),
+                [entry[2] for _, entry in entries],
+            )
+        return arrays
+
+    def nearest(self, latitude, longitude, k, max_km=None, where=None, tie_break=None, resolution_km=None):
+        """
+        Best-first k-nearest-neighbour search. Populated cells are visited in order
+        of the least distance anything inside them could have, rings of cells being
+        added outwards only as that order needs them, and the search stops as soon
+        as no unvisited cell can hold a point that beats the k-th best. Within a
+        cell, distances come from one vectorised call over the cell's arrays.
+
+        Points rank by distance, then by `tie_break(payload)` (lower first), then
+        by id. With `resolution_km`, distances are first rounded down to that step,
+        so points in the same step count as equally far and `tie_break` decides.
+
+        Returns [(id, distance_km, payload)] best first.
+        """
+        if k <= 0:
+            return []
+
+        def step(distance):
+            return floor(distance / resolution_km) if resolution_km else distance
+
+        best = []  # max-heap of negated (step, tie, distance, id)
+        payloads = {}
+
+        def beaten(bound):
+            # Nothing at `bound` or beyond can enter the k best
+            return (max_km is not None and bound > max_km) or (len(best) == k and step(bound) > -best[0][0])
+
+        def scan(key):
+            ids, points, cell_payloads = self._cell_arrays(key)
+            cell_distances = distances(points, latitude, longitude)
+            limit = max_km
+            if len(best) == k:
+                worst = -best[0][0]
+                worst_km = (worst + 1) * resolution_km if resolution_km else worst
+                limit = worst_km if limit is None else min(limit, worst_km)
+            candidates = np.flatnonzero(cell_distances <= limit) if limit is not None else np.arange(len(ids))
+            order = candidates[np.argsort(cell_distances[candidates], kind="stable")]
+            for i in order.tolist():
+                distance = float(cell_distances[i])
+                rank = step(distance)
+                if len(best) == k and rank > -best[0][0]:
+                    break
+                payload = cell_payloads[i]
+                if where is not None and not where(payload):
+                    continue
+                entry = (-rank, -tie_break(payload) if tie_break else 0, -distance, -ids[i])
+                if len(best) < k:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    dropped = heapq.heappushpop(best, entry)
+                    payloads.pop(-dropped[3], None)
+                else:
+                    continue
+                payloads[ids[i]] = payload
+
+        with self._lock:
+            row0, col0 = self._cell(latitude, longitude)
+            frontier = []  # heap of (cell bound, key)
+            ring = 0
+            while True:
+                # Add rings while they could hold something nearer than the best queued cell
+                while ring is not None and (not frontier or self._next_ring_bound(latitude, ring) <= frontier[0][0]):
+                    if beaten(self._next_ring_bound(latitude, ring)):
+                        ring = None
+                    elif (2 * ring + 1) ** 2 > len(self._cells):
+                        # Once the block outgrows the populated cells, queue the rest directly
+                        for key in self._cells:
+                            if max(abs(key[0] - row0), self._col_distance(key[1], col0)) >= ring:
+                                heapq.heappush(frontier, (self._cell_bound(latitude, longitude, key), key))
+                        ring = None
+                    else:
+                        for key in self._ring_cells(row0, col0, ring):
+                            if key in self._cells:
+                                heapq.heappush(frontier, (self._cell_bound(latitude, longitude, key), key))
+                        ring += 1
+                if not frontier:
+                    break
+                bound, key = heapq.heappop(frontier)
+                if beaten(bound):
+                    break
+                scan(key)
+
+        results = sorted(best, reverse=True)
+        return [(-entry[3], -entry[2], payloads[-entry[3]]) for entry in results]
+
+    def _next_ring_bound(self, latitude, ring):
+        """Lower bound (km) on the distance to any cell of `ring`."""
+        return 0.0 if ring == 0 else self._ring_bound(latitude, ring - 1)
+
+    def _col_distance(self, col, col0):
+        diff = abs(col - col0) % self.lon_cells
+        return min(diff, self.lon_cells - diff)
+
+    def memory_usage(self):
+        """Approximate bytes held by the grid structures and payload dicts."""
+        with self._lock:
+            size = sys.getsizeof(self._cells) + sys.getsizeof(self._points)
+            for key, cell in self._cells.items():
+                size += sys.getsizeof(key) + sys.getsizeof(cell)
+                for entry in cell.values():
+                    size += sys.getsizeof(entry)
+                    payload = entry[2]
+                    if isinstance(payload, dict):
+                        size += sys.getsizeof(payload)
+                        size += sum(sys.getsizeof(value) for value in payload.values())
+            return size
+
+    def stats(self):
+        return {
+            "points": len(self._points),
+            "cells": len(self._cells),
+            "cell_size_deg": self.cell_size,
+            "memory_bytes": self.memory_usage(),
+        }
+
+
+class LayerIndex:
+    """GridIndex of row snapshots for one table."""
+
+    def __init__(self, model):
+        self.model = model
+        self.grid = GridIndex()
+
+    def upsert(self, row):
+        if row.latitude is None or row.longitude is None:
+            self.grid.remove(row.id)
+            return
+        self.grid.insert(row.id, row.latitude, row.longitude, snapshot(row))
+
+    def remove(self, row_id):
+        self.grid.remove(row_id)
+
+    async def rebuild(self, db):
+        """Reload every row of the table into a fresh grid."""
+        grid = GridIndex(self.grid.cell_size)
+        rows = await db.stream_scalars(select(self.model).execution_options(yield_per=1000))
+        async for row in rows:
+            if row.latitude is not None and row.longitude is not None:
+                grid.insert(row.id, row.latitude, row.longitude, snapshot(row))
+        self.grid = grid
+        return len(grid)
+
+    def nearby(self, latitude, longitude, radius_km, limit=None, offset=0, where=None):
+        """
+        Same contract as geo.nearby: returns (rows, total) where rows is a page of
+        (row dict, distance) pairs sorted by distance. `where` optionally filters
+        on the row dict.
+        """
+        results = [
+            (dict(payload), distance)
+            for _, distance, payload in self.grid.within(latitude, longitude, radius_km)
+            if where is None or where(payload)
+        ]
+        total = len(results)
+        end = offset + limit if limit is not None else None
+        return results[offset:end], total
+
+    def nearest(self, latitude, longitude, k, max_km=None, where=None, tie_break=None, resolution_km=None):
+        """Return the k nearest (row dict, distance) pairs; see GridIndex.nearest for the ranking."""
+        return [
+            (dict(payload), distance)
+            for _, distance, payload in self.grid.nearest(
+                latitude, longitude, k, max_km, where, tie_break, resolution_km
+            )
+        ]
+
+    async def check(self, db):
+        """Compare the index with the table and report drift."""
+        result = await db.execute(select(self.model.id, self.model.latitude, self.model.longitude))
+        rows = {
+            row_id: (lat, lon)
+            for row_id, lat, lon in result
+            if lat is not None and lon is not None
+        }
+        indexed = {point_id: (lat, lon) for point_id, lat, lon, _ in self.grid.items()}
+
+        missing = sorted(set(rows) - set(indexed))
+        stale = sorted(set(indexed) - set(rows))
+        moved = sorted(
+            row_id for row_id in set(rows) & set(indexed) if rows[row_id] != indexed[row_id]
+        )
+        return {
+            "rows": len(rows),
+            "indexed": len(indexed),
+            "missing": missing,
+            "stale": stale,
+            "moved": moved,
+            "consistent": not (missing or stale or moved),
+        }
+
+
+_layers = {
+    model.__tablename__: LayerIndex(model)
+    for model in (Shelters, FoodProvidingRegions, News)
+}
+
+
+def get_index(model):
+    """Return the LayerIndex for a model, or None when the index is disabled."""
+    if not SPATIAL_INDEX_ENABLED:
+        return None
+    return _layers.get(model.__tablename__)
+
+
+def upsert(row):
+    """Add or move a row in its layer's index after a write."""
+    index = get_index(type(row))
+    if index is not None:
+        index.upsert(row)
+
+
+def remove(model, row_id):
+    """Drop a deleted row from its layer's index."""
+    index = get_index(model)
+    if index is not None:
+        index.remove(row_id)
+
+
+def insert_many(model, rows):
+    """Add freshly inserted rows, given as column dicts, to their layer's index."""
+    index = get_index(model)
+    if index is None:
+        return
+    columns = [column.name for column in model.__table__.columns]
+    for row in rows:
+        index.grid.insert(row["id"], row["latitude"], row["longitude"], {name: row.get(name) for name in columns})
+
+
+def layers():
+    return _layers
+
+
+async def rebuild_all(db):
+    """Rebuild every layer. Returns {layer: points indexed}."""
+    return {name: await layer.rebuild(db) for name, layer in _layers.items()}
+
+
+async def find_nearby(db, model, statement, latitude, longitude, radius_km, limit=None, offset=0, where=None):
+    """
+    Radius search answered from the in-memory index when it is enabled and from the
+    database (geo.nearby over the select `statement`) otherwise. `where` is the
+    in-memory equivalent of any filter already applied to `statement`.
+
+    Returns (rows, total) nearest first, with `distance` set on every row. Rows are
+    ORM objects from the database path and dicts from the index path.
+    """
+    index = get_index(model)
+    if index is not None:
+        results, total = index.nearby(latitude, longitude, radius_km, limit, offset, where)
+        for row, distance in results:
+            row["distance"] = distance
+    else:
+        results, total = await nearby(db, statement, model, latitude, longitude, radius_km, limit, offset)
+        for row, distance in results:
+            row.distance = distance
+    return [row for row, _ in results], total
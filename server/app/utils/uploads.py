@@ -0,0 +1,321 @@
+"""
+Ingestion of uploaded images.
+
+Starlette spools a multipart body to a temporary file before the handler runs,
+so UploadLimitMiddleware caps image upload requests at MAX_UPLOAD_MB before
+they are parsed: a larger Content-Length is refused outright and a body without
+one is cut off with 413 once it passes the limit. The image checks then run on
+the spooled upload, on a worker thread: the content type is sniffed from the
+first chunk, the size is held to MAX_IMAGE_MB and the content is hashed. The
+spooled file itself is streamed to storage (S3 or the local images/ folder)
+under its content hash and then handed to the derivative workers in
+app.utils.images.
+
+Rows are saved with their derivative URLs straight away. If rendering or
+storing a derivative fails, the URLs are cleared from every row using that
+original, so clients fall back to the original image. The clear runs again
+after IMAGE_FAILURE_RECHECK seconds to catch rows the batch writers had not
+written yet.
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from fastapi import HTTPException, UploadFile, status
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from loguru import logger
+from sqlalchemy import null, select, update
+from dotenv import load_dotenv
+from database import AsyncSessionLocal
+from Model import Shelters, FoodProvidingRegions, News
+from app.utils import images, response_cache
+from app.utils.amazon import object_url, s3_object_exists, s3_upload_fileobj
+
+load_dotenv()
+
+CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_MB", "10")) * 1024 * 1024
+# Whole multipart request: the image plus the other form fields
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", str(MAX_IMAGE_BYTES // (1024 * 1024) + 1))) * 1024 * 1024
+# Bulk imports are multipart too but may be far larger than an image
+UPLOAD_LIMIT_EXEMPT_PATHS = tuple(
+    path.strip() for path in os.getenv("UPLOAD_LIMIT_EXEMPT_PATHS", "/shelter/import,/food/import").split(",") if path.strip()
+)
+STAGING_DIR = os.getenv("IMAGE_STAGING_DIR", os.path.join(tempfile.gettempdir(), "alert-staging"))
+IMAGE_FAILURE_RECHECK = float(os.getenv("IMAGE_FAILURE_RECHECK", "30"))
+
+_clearing = set()  # tasks clearing the derivatives of failed renders
+
+# Magic numbers of the image formats we accept
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+
+def sniff_image_type(head: bytes):
+    """Return the image MIME type for the first bytes of a file, or None."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class ImageStream:
+    """
+    Validates an upload while its chunks go past: type from the first chunk,
+    running size against the limit, and a SHA-256 of the content.
+    """
+
+    def __init__(self, max_bytes=MAX_IMAGE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.content_type = None
+        self.sha256 = hashlib.sha256()
+
+    def feed(self, chunk: bytes):
+        if self.content_type is None:
+            self.content_type = sniff_image_type(chunk)
+            if self.content_type is None:
+                raise HTTPException(
+                    status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                    detail="Only JPEG, PNG, GIF and WebP images are accepted.",
+                )
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Image exceeds the {self.max_bytes // (1024 * 1024)} MB limit.",
+            )
+        self.sha256.update(chunk)
+
+    def finish(self):
+        if not self.size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty image file.")
+        return self
+
+    @property
+    def digest(self):
+        return self.sha256.hexdigest()
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.content_type]
+
+
+def _inspect(file, max_bytes=MAX_IMAGE_BYTES):
+    file.seek(0)
+    stream = ImageStream(max_bytes)
+    while chunk := file.read(CHUNK_SIZE):
+        stream.feed(chunk)
+    file.seek(0)
+    return stream.finish()
+
+
+async def inspect_image(upload: UploadFile):
+    """
+    Validate and hash a spooled upload chunk by chunk on a worker thread, and
+    rewind it. Returns the ImageStream; raises HTTPException for invalid images.
+    """
+    return await run_in_threadpool(_inspect, upload.file)
+
+
+def _copy(file, path):
+    file.seek(0)
+    with open(path, "wb") as target:
+        shutil.copyfileobj(file, target, CHUNK_SIZE)
+    file.seek(0)
+
+
+def _stage(file):
+    """Copy a spooled upload to a staging file the derivative workers can open."""
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=STAGING_DIR)
+    os.close(fd)
+    try:
+        _copy(file, path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+async def _already_stored(key: str) -> bool:
+    try:
+        return await s3_object_exists(key)
+    except Exception as e:
+        logger.warning(f"Could not check for existing object {key}: {e}")
+        return False
+
+
+async def _clear_derivatives(original):
+    """Drop the derivative URLs of rows showing `original`, and their cached search results."""
+    async with AsyncSessionLocal() as db:
+        for model in (Shelters, FoodProvidingRegions, News):
+            result = await db.execute(
+                select(model.id, model.latitude, model.longitude)
+                .where(model.images == original, model.derivatives.is_not(None))
+            )
+            rows = result.all()
+            if not rows:
+                continue
+            await db.execute(update(model).where(model.id.in_([row.id for row in rows])).values(derivatives=null()))
+            await db.commit()
+            await response_cache.invalidate(model, *((row.latitude, row.longitude) for row in rows))
+            logger.warning(f"Cleared derivatives of {len(rows)} {model.__tablename__} rows using {original}")
+
+
+async def _clear_after_failure(original):
+    for delay in (0, IMAGE_FAILURE_RECHECK):
+        await asyncio.sleep(delay)
+        try:
+            await _clear_derivatives(original)
+        except Exception as e:
+            logger.error(f"Could not clear derivatives of {original}: {e}")
+
+
+def _submit(source, digest, original, folder=None, keep_source=False):
+    """Queue derivative generation, clearing the rows' derivative URLs if it fails."""
+    def done(future):
+        if future.cancelled() or future.exception() is None:
+            return
+        task = asyncio.create_task(_clear_after_failure(original))
+        _clearing.add(task)
+        task.add_done_callback(_clearing.discard)
+
+    images.submit(source, digest, folder, keep_source).add_done_callback(done)
+
+
+async def store_image(upload: UploadFile):
+    """
+    Validate an uploaded image and stream it to S3 under its content hash, then
+    queue its derivatives. An identical image that is already stored is reused.
+    Returns (url, derivative urls); raises HTTPException for invalid images or
+    failed uploads.
+    """
+    if upload is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image is required.")
+
+    stream = await inspect_image(upload)
+    key = images.original_key(stream.digest, stream.extension)
+    derivatives = images.derivative_urls(stream.digest)
+
+    # The last derivative is written after the original, so its presence
+    # means an earlier upload of the same content completed every step
+    if await _already_stored(images.derivative_key(stream.digest, images.LAST_DERIVATIVE)):
+        return object_url(key), derivatives
+
+    # The workers run in other processes and need a file of their own; copy it
+    # first, as boto closes the upload once it has been sent
+    staged = await run_in_threadpool(_stage, upload.file)
+    try:
+        url = await s3_upload_fileobj(upload.file, key, stream.content_type)
+    except BaseException:
+        os.remove(staged)
+        raise
+    if not url:
+        os.remove(staged)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to upload image.")
+
+    _submit(staged, stream.digest, url)
+    return url, derivatives
+
+
+async def save_image_locally(upload: UploadFile, folder: str):
+    """
+    Validate an uploaded image and store it in `folder` under its content hash,
+    then queue its derivatives. Returns (path, derivative paths).
+    """
+    stream = await inspect_image(upload)
+    os.makedirs(folder, exist_ok=True)
+    path = f"{folder}/{stream.digest}{stream.extension}"
+    derivatives = images.derivative_urls(stream.digest, folder)
+
+    if os.path.exists(derivatives[images.LAST_DERIVATIVE]):
+        return path, derivatives
+
+    try:
+        await run_in_threadpool(_copy, upload.file, f"{path}.part")
+        os.replace(f"{path}.part", path)
+    except BaseException:
+        if os.path.exists(f"{path}.part"):
+            os.remove(f"{path}.part")
+        raise
+
+    # Rendered from the stored original, which stays
+    _submit(path, stream.digest, path, folder, keep_source=True)
+    return path, derivatives
+
+
+async def release_local_image(db, path):
+    """
+    Delete a local original and its derivatives once no row references it any
+    more. Content-addressed files can be shared between rows, so this must run
+    after the referencing row was changed or deleted and committed.
+    """
+    if not path or not os.path.exists(path):
+        return
+    for model in (Shelters, FoodProvidingRegions, News):
+        if await db.scalar(select(model.id).where(model.images == path).limit(1)):
+            return
+
+    folder, filename = os.path.split(path)
+    digest = os.path.splitext(filename)[0]
+    for derivative in [path, *images.derivative_urls(digest, folder).values()]:
+        if os.path.exists(derivative):
+            os.remove(derivative)
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware refusing multipart requests over MAX_UPLOAD_BYTES with 413
+    before Starlette parses and spools them.
+    """
+
+    def __init__(self, app, max_bytes=MAX_UPLOAD_BYTES, exempt_paths=UPLOAD_LIMIT_EXEMPT_PATHS):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.exempt_paths = exempt_paths
+
+    def _limited(self, scope):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            return False
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        return content_type.startswith(b"multipart/form-data")
+
+    async def __call__(self, scope, receive, send):
+        if not self._limited(scope):
+            return await self.app(scope, receive, send)
+
+        detail = f"Upload exceeds the {self.max_bytes // (1024 * 1024)} MB limit."
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            return await response(scope, receive, send)
+
+        received = 0
+
+        async def capped_receive():
+            # Raised while the form is parsed, which passes HTTPException through
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, capped_receive, send)
@@ -0,0 +1,81 @@
+"""
+Cache of authenticated users for the auth dependencies.
+
+Every protected request used to decode its JWT and load the user row. Both
+results are cached here. `claims` maps a token to the email it was issued for,
+and it never outlives the token's own expiry. `users` maps an email to a
+`UserSnapshot`, a detached copy of the row without the password hash. Both are
+LRU caches with a TTL, so a stale snapshot lives at most USER_CACHE_TTL seconds.
+
+Handlers that change a user must call `invalidate(email)` after committing.
+Invalidation is per process, so with several workers the TTL is what bounds
+staleness in the other ones.
+"""
+import os
+import time
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Optional
+from dotenv import load_dotenv
+from sqlalchemy import select
+from Model import Users as User
+from app.utils.cache import TTLCache
+
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """Read-only stand-in for a Users row, safe to share between requests."""
+
+    id: int
+    fullName: Optional[str]
+    email: str
+    phoneNumber: Optional[str]
+    is_verified: Optional[bool]
+    createdAt: Optional[datetime]
+    address: Optional[str]
+    pincode: Optional[str]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    admin: Optional[bool]
+
+    @classmethod
+    def from_user(cls, user):
+        # Everything but the password hash
+        return cls(**{field.name: getattr(user, field.name) for field in fields(cls)})
+
+
+claims = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def cache_claims(token: str, payload: dict):
+    """Remember which email `token` belongs to, for no longer than the token is valid."""
+    email = payload.get("sub")
+    expires = payload.get("exp")
+    ttl = None if expires is None else float(expires) - time.time()
+    claims.set(token, email, ttl)
+
+
+async def get_user(email: str, db):
+    """Snapshot of the user with `email`, from the cache or the database; None if absent."""
+    snapshot = users.get(email)
+    if snapshot is None:
+        user = await db.scalar(select(User).where(User.email == email).limit(1))
+        if user is None:
+            return None
+        snapshot = UserSnapshot.from_user(user)
+        users.set(email, snapshot)
+    return snapshot
+
+
+def invalidate(email: str):
+    users.pop(email)
+
+
+def stats():
+    return {"claims": claims.stats(), "users": users.stats()}
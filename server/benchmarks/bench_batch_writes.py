@@ -0,0 +1,126 @@
+"""
+Sustained SOS inserts per second with and without write-behind batching.
+
+Drives POST /sos/sos in-process through httpx's ASGI transport, with
+--concurrency submissions in flight for --seconds, once with the SOS batch
+writer batching and once writing every alert in its own transaction. Rate
+limiting is off, so every submission waits until its row is committed.
+Skipping sockets keeps the load generator from competing with the server for
+CPU on small machines, so the numbers reflect the server's write path.
+
+Reports requests per second, latency, rows in the table afterwards and the
+average batch size.
+
+Use Postgres for numbers that mean something (DATABASE_URL, a database that
+can be reset); by default each run gets a fresh SQLite file.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_batch_writes --seconds 10 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+CENTER = (17.385, 78.4867)
+SECRET_KEY = "bench-secret"
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+async def drive(app, args, tokens):
+    import httpx
+
+    latencies, codes = [], []
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            deadline = time.perf_counter() + args.seconds
+
+            async def worker(seed):
+                rng = random.Random(seed)
+                while time.perf_counter() < deadline:
+                    # Scattered positions, so submissions are new alerts rather than repeats
+                    params = {
+                        "persons": rng.randint(1, 6),
+                        "latitude": CENTER[0] + rng.uniform(-0.5, 0.5),
+                        "longitude": CENTER[1] + rng.uniform(-0.5, 0.5),
+                    }
+                    start = time.perf_counter()
+                    response = await client.post("/sos/sos", params=params, headers=rng.choice(tokens))
+                    latencies.append(time.perf_counter() - start)
+                    codes.append(response.status_code)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(seed) for seed in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+    return codes, elapsed, latencies
+
+
+def run(label, args, batching):
+    import jwt
+    import main
+    import Model
+    from database import SessionLocal, engine
+    from app.utils.batch_writer import sos_writer
+
+    Model.Base.metadata.drop_all(bind=engine)
+    Model.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        for user in range(args.users):
+            db.add(Model.Users(fullName=f"u{user}", email=f"u{user}@example.com", password="x", is_verified=True, createdAt=datetime.utcnow()))
+        db.commit()
+    tokens = [
+        {"Authorization": "Bearer " + jwt.encode({"sub": f"u{user}@example.com"}, SECRET_KEY, algorithm="HS256")}
+        for user in range(args.users)
+    ]
+
+    sos_writer.batching = batching
+    batches_before = sos_writer.batches
+    codes, elapsed, latencies = asyncio.run(drive(main.app, args, tokens))
+
+    with SessionLocal() as db:
+        rows = db.query(Model.SOS).count()
+    batches = sos_writer.batches - batches_before
+    average = f"{rows / batches:.1f}" if batches else "-"
+    errors = sum(1 for code in codes if code >= 400)
+    print(
+        f"{label:>8} {len(codes) / elapsed:>8.1f} {rows:>7} {errors:>7} {percentile(latencies, 0.5):>8.1f}"
+        f" {percentile(latencies, 0.99):>8.1f} {average:>7}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--flush-ms", type=float, default=10, help="BATCH_FLUSH_MS for the batched run")
+    args = parser.parse_args()
+
+    # Configure before the app and its engine are imported
+    if not os.getenv("DATABASE_URL"):
+        os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp(prefix='alert-batch-')}/bench.db"
+    os.environ.update(
+        SECRET_KEY=SECRET_KEY,
+        SPATIAL_INDEX_ENABLED="false",
+        SOS_RATE_LIMIT_ENABLED="false",
+        BATCH_FLUSH_MS=str(args.flush_ms),
+        LOGURU_LEVEL="WARNING",
+    )
+
+    print(f"{args.seconds:g}s, concurrency {args.concurrency}, {args.users} users, flush {args.flush_ms:g} ms")
+    print(f"{'batching':>8} {'req/s':>8} {'rows':>7} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8} {'batch':>7}")
+    run("off", args, batching=False)
+    run("on", args, batching=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Request throughput of the async database layer against the old sync engine.
+
+The baseline is the server as it was before the handlers moved to
+`get_async_db`, exported from git (by default the parent of the commit that
+introduced it). Each tree serves a fresh database seeded with the same rows. The
+parent then runs the same mix of nearby shelter, news and SOS reads plus
+authenticated SOS writes against it.
+
+Use Postgres for numbers that mean something (DATABASE_URL, one database that
+is reset between runs); SQLite only shows that both paths work.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_db_throughput --requests 3000 --concurrency 32
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+import httpx
+import jwt
+
+PORT = 8795
+SECRET_KEY = "bench-secret"
+CENTER = (17.385, 78.4867)
+
+SERVE = """
+import os, random, sys
+from datetime import datetime, timedelta
+sys.path.insert(0, os.getcwd())
+import uvicorn, main, Model
+from database import SessionLocal, engine
+
+Model.Base.metadata.drop_all(bind=engine)
+Model.Base.metadata.create_all(bind=engine)
+random.seed(7)
+db = SessionLocal()
+db.add(Model.Users(fullName="bench", email="bench@example.com", password="x", is_verified=True, createdAt=datetime.utcnow()))
+now = datetime.now()
+for i in range(int(os.environ["BENCH_ROWS"])):
+    lat = 17.385 + random.uniform(-0.5, 0.5)
+    lon = 78.4867 + random.uniform(-0.5, 0.5)
+    db.add(Model.Shelters(name=f"s{i}", address="a", pincode="500001", createdAt=now, updatedAt=now, latitude=lat, longitude=lon))
+    db.add(Model.News(title=f"n{i}", description="d", createdAt=now - timedelta(days=i % 6), updatedAt=now, latitude=lat, longitude=lon))
+    db.add(Model.SOS(createdAt=datetime.utcnow() - timedelta(hours=i % 40), latitude=lat, longitude=lon, persons=1, resolved=False))
+db.commit()
+db.close()
+uvicorn.run(main.app, port=int(os.environ["BENCH_PORT"]), log_level="warning")
+"""
+
+
+def baseline_tree(ref):
+    """Export the server directory at `ref` into a temporary directory."""
+    if ref is None:
+        introduced = subprocess.run(
+            ["git", "log", "--format=%H", "-S", "get_async_db", "--", "database.py"],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        ref = f"{introduced[-1]}~1"
+    top, prefix = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel", "--show-prefix"], capture_output=True, text=True, check=True
+    ).stdout.splitlines()
+    archive = subprocess.run(
+        ["git", "-C", top, "archive", "--format=tar", f"{ref}:{prefix}"], capture_output=True, check=True
+    ).stdout
+    target = tempfile.mkdtemp(prefix="alert-baseline-")
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return ref, target
+
+
+def token():
+    expire = datetime.utcnow() + timedelta(hours=1)
+    return jwt.encode({"sub": "bench@example.com", "exp": expire}, SECRET_KEY, algorithm="HS256")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def request_for(index, rng):
+    lat = CENTER[0] + rng.uniform(-0.3, 0.3)
+    lon = CENTER[1] + rng.uniform(-0.3, 0.3)
+    kind = index % 10
+    if kind < 4:
+        return "GET", "/shelter/get-shelters", {"latitude": lat, "longitude": lon, "dist": 10, "limit": 20}
+    if kind < 7:
+        return "GET", "/news/news", {"latitude": lat, "longitude": lon, "distance": 10, "limit": 20}
+    if kind < 9:
+        return "GET", "/sos/all", {"admin_latitude": lat, "admin_longitude": lon, "radius": 10, "limit": 50}
+    return "POST", "/sos/sos", {"persons": 1, "latitude": lat, "longitude": lon}
+
+
+async def drive(requests, concurrency):
+    headers = {"Authorization": f"Bearer {token()}"}
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=120, limits=limits) as client:
+        for _ in range(300):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+        rng = random.Random(11)
+        plan = [request_for(i, rng) for i in range(requests)]
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(method, path, params):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, params=params, headers=headers)
+                    code = response.status_code
+                except httpx.HTTPError:
+                    code = 599  # dropped connection or client timeout
+                latencies.append(time.perf_counter() - start)
+                return code
+
+        start = time.perf_counter()
+        codes = await asyncio.gather(*(send(*request) for request in plan))
+        return codes, time.perf_counter() - start, latencies
+
+
+def run(label, tree, args, database_url):
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        SECRET_KEY=SECRET_KEY,
+        BENCH_ROWS=str(args.rows),
+        BENCH_PORT=str(PORT),
+        SPATIAL_INDEX_ENABLED="false",
+    )
+    server = subprocess.Popen([sys.executable, "-c", SERVE], cwd=tree, env=env)
+    try:
+        codes, elapsed, latencies = asyncio.run(drive(args.requests, args.concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+    errors = sum(1 for code in codes if code >= 500)
+    print(
+        f"{label:>8} {len(codes) / elapsed:>8.1f} {errors:>7} {percentile(latencies, 0.5):>8.1f}"
+        f" {percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rows", type=int, default=5000, help="shelters, news and SOS rows to seed")
+    parser.add_argument("--baseline-ref", help="git ref of the sync baseline")
+    args = parser.parse_args()
+
+    ref, baseline = baseline_tree(args.baseline_ref)
+    workdir = tempfile.mkdtemp(prefix="alert-bench-")
+    database_url = os.getenv("DATABASE_URL") or f"sqlite:///{workdir}/bench.db"
+
+    print(f"baseline {ref}, {args.requests} requests, concurrency {args.concurrency}, {args.rows} rows")
+    print(f"{'engine':>8} {'req/s':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    run("sync", baseline, args, database_url)
+    run("async", os.getcwd(), args, database_url)
+
+
+if __name__ == "__main__":
+    main()
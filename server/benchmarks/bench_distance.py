@@ -0,0 +1,57 @@
+"""
+Microbenchmark: scalar haversine loop vs. the vectorized distance kernel.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_distance
+"""
+import random
+import time
+from app.utils.distance import Points, distances, haversine, within_radius
+
+SIZES = (10_000, 100_000, 1_000_000)
+CENTER = (17.385, 78.4867)  # Hyderabad
+RADIUS_KM = 10
+
+
+def best_of(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    random.seed(42)
+    print(f"{'points':>10} {'scalar ms':>12} {'vector ms':>12} {'mask ms':>10} {'speedup':>9}")
+    for size in SIZES:
+        lats = [CENTER[0] + random.uniform(-2, 2) for _ in range(size)]
+        lons = [CENTER[1] + random.uniform(-2, 2) for _ in range(size)]
+
+        def scalar():
+            return [
+                d for d in (haversine(CENTER[0], CENTER[1], lat, lon) for lat, lon in zip(lats, lons))
+                if d <= RADIUS_KM
+            ]
+
+        points = Points(lats, lons)
+
+        scalar_s = best_of(scalar, repeat=1 if size >= 1_000_000 else 3)
+        vector_s = best_of(lambda: distances(points, *CENTER))
+        mask_s = best_of(lambda: within_radius(points, CENTER, RADIUS_KM))
+
+        # Both paths must agree before the timings mean anything
+        expected = scalar()
+        got = distances(points, *CENTER)[within_radius(points, CENTER, RADIUS_KM)]
+        assert len(expected) == len(got)
+
+        print(
+            f"{size:>10} {scalar_s * 1000:>12.2f} {vector_s * 1000:>12.2f} "
+            f"{mask_s * 1000:>10.2f} {scalar_s / vector_s:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
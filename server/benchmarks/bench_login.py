@@ -0,0 +1,141 @@
+"""
+Login throughput against the size of the password hashing pool.
+
+For each pool size the API runs in a child process on a throwaway SQLite
+database seeded with verified users. The parent sends a storm of concurrent
+/auth/login requests and meanwhile probes GET / to show how responsive the
+event loop stays. Throughput stops scaling once the pool has as many workers as
+there are cores.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_login --workers 1 2 4 --logins 200 --rounds 12
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+PORT = 8797
+PASSWORD = "bench-password"
+USERS = 20
+
+
+def serve():
+    from datetime import datetime
+    import bcrypt
+    import uvicorn
+    import main
+    import Model
+    from database import SessionLocal
+
+    rounds = int(os.environ["BCRYPT_ROUNDS"])
+    hashed = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    db = SessionLocal()
+    for i in range(USERS):
+        db.add(Model.Users(
+            fullName=f"bench {i}", email=f"bench{i}@example.com", password=hashed,
+            is_verified=True, createdAt=datetime.utcnow(),
+        ))
+    db.commit()
+    db.close()
+    uvicorn.run(main.app, port=PORT, log_level="warning")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+async def login(client, index, latencies):
+    start = time.perf_counter()
+    response = await client.post("/auth/login", json={
+        "email": f"bench{index % USERS}@example.com",
+        "password": PASSWORD,
+        "coordinates": {"latitude": 17.385, "longitude": 78.4867},
+    })
+    latencies.append(time.perf_counter() - start)
+    return response.status_code
+
+
+async def probe(client, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get("/")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+
+
+async def drive(logins, concurrency):
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=300, limits=limits) as client:
+        for _ in range(200):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+        login_latencies, probe_latencies = [], []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(index):
+            async with semaphore:
+                return await login(client, index, login_latencies)
+
+        stop = asyncio.Event()
+        prober = asyncio.create_task(probe(client, stop, probe_latencies))
+        start = time.perf_counter()
+        codes = await asyncio.gather(*(bounded(i) for i in range(logins)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await prober
+        return codes, elapsed, login_latencies, probe_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--queue", type=int, help="PASSWORD_QUEUE for the server; defaults to --concurrency so nothing is shed")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    print(f"{os.cpu_count()} CPUs, bcrypt cost {args.rounds}, {args.logins} logins, concurrency {args.concurrency}")
+    print(f"{'workers':>7} {'logins/s':>9} {'ok':>5} {'503':>5} {'p50 ms':>8} {'p99 ms':>8} {'GET / p99 ms':>13}")
+    for workers in args.workers:
+        workdir = tempfile.mkdtemp(prefix="alert-bench-")
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{workdir}/bench.db",
+            BCRYPT_ROUNDS=str(args.rounds),
+            PASSWORD_WORKERS=str(workers),
+            PASSWORD_QUEUE=str(args.queue or args.concurrency),
+        )
+        server = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_login", "--serve"], env=env)
+        try:
+            codes, elapsed, logins, probes = asyncio.run(drive(args.logins, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+        ok = sum(1 for code in codes if code == 200)
+        shed = sum(1 for code in codes if code == 503)
+        print(
+            f"{workers:>7} {ok / elapsed:>9.1f} {ok:>5} {shed:>5} {percentile(logins, 0.5):>8.1f}"
+            f" {percentile(logins, 0.99):>8.1f} {percentile(probes, 0.99):>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
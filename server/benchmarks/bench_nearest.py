@@ -0,0 +1,105 @@
+"""
+Microbenchmark: /shelter/nearest lookups from the in-memory grid index.
+
+Builds a GridIndex of --shelters synthetic shelters (most clustered around a few
+cities, the rest spread over the country) with random capacity and occupancy,
+then times GridIndex.nearest with the endpoint's ranking: shelters that are full
+are skipped, and shelters within the same NEAREST_TIE_KM rank by free places.
+Queries run twice; the first pass also builds the per-cell arrays, the second
+shows the steady state. A few answers are checked against a brute-force
+ranking of every shelter first.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_nearest --shelters 1000000
+"""
+import argparse
+import random
+import time
+from math import floor
+import numpy as np
+from app.utils.distance import Points, distances
+from app.utils.nearest_shelters import NEAREST_TIE_KM, _tie_break, has_space
+from app.utils.spatial_index import CELL_SIZE_DEG, GridIndex
+
+CITIES = (
+    (17.385, 78.4867), (13.0827, 80.2707), (19.076, 72.8777), (22.5726, 88.3639), (26.1445, 91.7362),
+    (9.9312, 76.2673), (25.5941, 85.1376), (20.2961, 85.8245), (28.6139, 77.209), (12.9716, 77.5946),
+)
+CLUSTERED = 0.7  # share of shelters around the cities
+
+
+def place(rng):
+    if rng.random() < CLUSTERED:
+        latitude, longitude = rng.choice(CITIES)
+        return latitude + rng.gauss(0, 0.15), longitude + rng.gauss(0, 0.15)
+    return rng.uniform(8, 32), rng.uniform(69, 95)
+
+
+def brute_force(lats, lons, payloads, latitude, longitude, k):
+    all_distances = distances(Points(lats, lons), latitude, longitude)
+    ranked = sorted(
+        (floor(distance / NEAREST_TIE_KM), _tie_break(payload), distance, payload["id"])
+        for distance, payload in zip(all_distances.tolist(), payloads)
+        if has_space(payload)
+    )
+    return [entry[3] for entry in ranked[:k]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shelters", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=3000)
+    parser.add_argument("--cell-deg", type=float, default=CELL_SIZE_DEG)
+    parser.add_argument("--check", type=int, default=20, help="answers to verify by brute force")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    grid = GridIndex(args.cell_deg)
+    lats, lons, payloads = [], [], []
+    start = time.perf_counter()
+    for shelter_id in range(args.shelters):
+        latitude, longitude = place(rng)
+        capacity = rng.choice((None, 50, 200, 1000))
+        payload = {
+            "id": shelter_id,
+            "capacity": capacity,
+            "occupancy": None if capacity is None else rng.randint(0, capacity),
+        }
+        grid.insert(shelter_id, latitude, longitude, payload)
+        lats.append(latitude)
+        lons.append(longitude)
+        payloads.append(payload)
+    print(f"{args.shelters} shelters in {len(grid._cells)} cells, built in {time.perf_counter() - start:.1f}s")
+
+    def search(latitude, longitude, k):
+        return grid.nearest(
+            latitude, longitude, k, where=has_space, tie_break=_tie_break, resolution_km=NEAREST_TIE_KM
+        )
+
+    # Users ask from where people are: mostly around the cities
+    queries = [place(rng) for _ in range(args.queries)]
+
+    for latitude, longitude in queries[:args.check]:
+        got = [point_id for point_id, _, _ in search(latitude, longitude, 5)]
+        assert got == brute_force(lats, lons, payloads, latitude, longitude, 5), (latitude, longitude)
+
+    print(f"{'k':>4} {'pass':>6} {'mean us':>9} {'p50 us':>8} {'p99 us':>8}")
+    for k in (1, 5, 20, 50):
+        for label in ("cold", "warm"):
+            if label == "cold":
+                grid._arrays.clear()
+            timings = []
+            for latitude, longitude in queries:
+                began = time.perf_counter()
+                search(latitude, longitude, k)
+                timings.append(time.perf_counter() - began)
+            timings = np.array(timings) * 1e6
+            print(
+                f"{k:>4} {label:>6} {timings.mean():>9.0f} {np.percentile(timings, 50):>8.0f} "
+                f"{np.percentile(timings, 99):>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
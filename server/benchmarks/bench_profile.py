@@ -0,0 +1,125 @@
+"""
+/auth/profile latency with and without the authenticated-user cache.
+
+The API runs in a child process on a throwaway SQLite database seeded with
+users; the parent signs their access tokens and sends concurrent /auth/profile
+requests. The run is repeated with USER_CACHE_TTL=0 (cache disabled, one user
+query per request) and with the cache on, and the cache hit ratio is read back
+from /auth/user-cache.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_profile --requests 5000 --users 100
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import httpx
+import jwt
+
+PORT = 8796
+SECRET_KEY = "bench-secret"
+
+
+def serve():
+    import uvicorn
+    import main
+    import Model
+    from database import SessionLocal
+
+    db = SessionLocal()
+    for i in range(int(os.environ["BENCH_USERS"])):
+        db.add(Model.Users(
+            fullName=f"bench {i}", email=f"bench{i}@example.com", password="x",
+            is_verified=True, admin=(i == 0), createdAt=datetime.utcnow(),
+        ))
+    db.commit()
+    db.close()
+    uvicorn.run(main.app, port=PORT, log_level="warning")
+
+
+def token(index):
+    expire = datetime.utcnow() + timedelta(hours=1)
+    return jwt.encode({"sub": f"bench{index}@example.com", "exp": expire}, SECRET_KEY, algorithm="HS256")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+async def drive(requests, users, concurrency):
+    tokens = [token(i) for i in range(users)]
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=60, limits=limits) as client:
+        for _ in range(200):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def profile(index):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(
+                    "/auth/profile", headers={"Authorization": f"Bearer {tokens[index % users]}"}
+                )
+                latencies.append(time.perf_counter() - start)
+                return response.status_code
+
+        start = time.perf_counter()
+        codes = await asyncio.gather(*(profile(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+        stats = (await client.get("/auth/user-cache", headers={"Authorization": f"Bearer {tokens[0]}"})).json()
+        return codes, elapsed, latencies, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    print(f"{args.requests} requests over {args.users} users, concurrency {args.concurrency}")
+    print(f"{'cache':>5} {'req/s':>8} {'ok':>6} {'p50 ms':>8} {'p99 ms':>8} {'user hit ratio':>15}")
+    for label, ttl in (("off", "0"), ("on", "60")):
+        workdir = tempfile.mkdtemp(prefix="alert-bench-")
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{workdir}/bench.db",
+            SECRET_KEY=SECRET_KEY,
+            USER_CACHE_TTL=ttl,
+            BENCH_USERS=str(args.users),
+        )
+        server = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_profile", "--serve"], env=env)
+        try:
+            codes, elapsed, latencies, stats = asyncio.run(drive(args.requests, args.users, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+
+        ok = sum(1 for code in codes if code == 200)
+        print(
+            f"{label:>5} {len(codes) / elapsed:>8.1f} {ok:>6} {percentile(latencies, 0.5):>8.2f}"
+            f" {percentile(latencies, 0.99):>8.2f} {str(stats['users']['hit_ratio']):>15}"
+        )
+
+
+if __name__ == "__main__":
+    main()
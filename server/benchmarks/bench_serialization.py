@@ -0,0 +1,86 @@
+"""
+Cost of turning a page of shelters into a JSON response body.
+
+Compares the generic path handlers used to take (jsonable_encoder over the ORM
+objects, then JSONResponse) with the declared response model rendered by
+ORJSONResponse, and with the model's own model_dump_json used for cached
+responses. Rows are transient Shelters objects, as loaded by the database path,
+and plain dicts, as returned by the spatial index.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_serialization --sizes 1000 10000 100000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from Model import Shelters
+from app.schemas.layers import ShelterList
+from app.utils.spatial_index import snapshot
+
+
+def make_rows(count):
+    rng = random.Random(3)
+    now = datetime(2025, 1, 1)
+    rows = []
+    for i in range(count):
+        row = Shelters(
+            id=i + 1, name=f"shelter {i}", address="12 Main Road", pincode="500001",
+            images=f"https://bucket.example.com/shelters/{i}.jpg",
+            derivatives={"thumbnail": f"https://bucket.example.com/t/{i}.webp"},
+            description="School hall with water and beds", createdAt=now - timedelta(minutes=i),
+            updatedAt=now, latitude=17.385 + rng.uniform(-0.5, 0.5),
+            longitude=78.4867 + rng.uniform(-0.5, 0.5), userId=i % 50 + 1,
+        )
+        row.distance = rng.uniform(0, 30)
+        rows.append(row)
+    return rows
+
+
+def generic(rows):
+    return JSONResponse(content=jsonable_encoder({"shelters": rows, "total": len(rows)})).body
+
+
+def response_model(rows):
+    # What FastAPI does for a route with response_model and response_class=ORJSONResponse
+    payload = ShelterList.model_validate({"shelters": rows, "total": len(rows)}, from_attributes=True)
+    return ORJSONResponse(content=payload.model_dump(mode="json")).body
+
+
+def model_dump_json(rows):
+    return ShelterList(shelters=rows, total=len(rows)).model_dump_json().encode()
+
+
+def best_of(function, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function(rows)
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'rows':>7} {'source':>6} {'path':>16} {'ms':>9} {'rows/s':>11} {'MB':>6}")
+    for size in args.sizes:
+        orm_rows = make_rows(size)
+        sources = {"orm": orm_rows, "dict": [dict(snapshot(row), distance=row.distance) for row in orm_rows]}
+        for source, rows in sources.items():
+            for name, function in (("generic", generic), ("response_model", response_model), ("model_dump_json", model_dump_json)):
+                elapsed, length = best_of(function, rows, args.repeat)
+                print(
+                    f"{size:>7} {source:>6} {name:>16} {elapsed * 1000:>9.1f} {size / elapsed:>11.0f}"
+                    f" {length / 1e6:>6.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Throughput of the incremental SOS clustering engine.
+
+Replays a synthetic hour of alerts (by default 100k) into a ClusterEngine:
+most alerts fall around incident hotspots and the rest are scattered over the
+region. Along the way a share of alerts is resolved and the cluster list is read
+periodically, as admins polling /sos/clusters would. It reports the insert
+rate, resolve cost and read latency, plus a full recompute of the final state
+for comparison.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_sos_clusters --alerts 100000 --hotspots 50
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from app.utils.sos_clusters import ClusterEngine
+
+CENTER = (17.385, 78.4867)
+
+
+def synthetic_alerts(count, hotspots, spread_km, seed=5):
+    rng = random.Random(seed)
+    degree = 1 / 111.0
+    centres = [
+        (CENTER[0] + rng.uniform(-0.4, 0.4), CENTER[1] + rng.uniform(-0.4, 0.4)) for _ in range(hotspots)
+    ]
+    start = datetime.utcnow() - timedelta(hours=1)
+    for i in range(count):
+        created_at = start + timedelta(seconds=3600 * i / count)
+        if rng.random() < 0.7:
+            lat, lon = rng.choice(centres)
+            lat += rng.gauss(0, spread_km * degree)
+            lon += rng.gauss(0, spread_km * degree)
+        else:
+            lat = CENTER[0] + rng.uniform(-0.5, 0.5)
+            lon = CENTER[1] + rng.uniform(-0.5, 0.5)
+        yield i + 1, lat, lon, created_at, rng.randint(1, 5), rng.randint(1, count // 3)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alerts", type=int, default=100_000)
+    parser.add_argument("--hotspots", type=int, default=50)
+    parser.add_argument("--spread-km", type=float, default=0.3, help="standard deviation around a hotspot")
+    parser.add_argument("--radius-km", type=float, default=0.5)
+    parser.add_argument("--window-minutes", type=float, default=60)
+    parser.add_argument("--resolve-every", type=int, default=20, help="resolve one earlier alert every N inserts")
+    parser.add_argument("--read-every", type=int, default=5000, help="list clusters every N inserts")
+    args = parser.parse_args()
+
+    engine = ClusterEngine(args.radius_km, args.window_minutes * 60, 48 * 3600)
+    alerts = list(synthetic_alerts(args.alerts, args.hotspots, args.spread_km))
+    rng = random.Random(9)
+
+    insert_time = resolve_time = 0.0
+    resolves = 0
+    reads = []
+    for index, alert in enumerate(alerts, start=1):
+        start = time.perf_counter()
+        engine.add(*alert)
+        insert_time += time.perf_counter() - start
+
+        if index % args.resolve_every == 0:
+            start = time.perf_counter()
+            engine.remove(rng.randint(1, index))
+            resolve_time += time.perf_counter() - start
+            resolves += 1
+        if index % args.read_every == 0:
+            start = time.perf_counter()
+            engine.clusters(CENTER[0], CENTER[1], 20, min_alerts=2)
+            reads.append(time.perf_counter() - start)
+
+    stats = engine.stats()
+    print(f"{args.alerts} alerts, {args.hotspots} hotspots, radius {args.radius_km} km, window {args.window_minutes} min")
+    print(f"insert        {args.alerts / insert_time:>10.0f} alerts/s  ({insert_time * 1e6 / args.alerts:.1f} us each)")
+    print(f"resolve       {resolve_time * 1e6 / max(resolves, 1):>10.1f} us each, {resolves} resolved")
+    print(f"read+settle   {max(reads) * 1000:>10.1f} ms worst, {sum(reads) / len(reads) * 1000:.1f} ms mean over {len(reads)} reads")
+    print(f"state         {stats['alerts']} alerts in {stats['clusters']} clusters, {stats['merges']} merges, {stats['splits']} splits")
+
+    # Full recompute of the same final state, what the engine avoids doing per request
+    survivors = [alert for alert in alerts if alert[0] in engine._alerts]
+    start = time.perf_counter()
+    fresh = ClusterEngine(args.radius_km, args.window_minutes * 60, 48 * 3600)
+    for alert in survivors:
+        fresh.add(*alert)
+    recompute = time.perf_counter() - start
+    print(f"full rebuild  {recompute * 1000:>10.1f} ms, {fresh.stats()['clusters']} clusters")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Peak server RSS while 50 clients each upload a 10 MB image to /news/add.
+
+The API runs in a child process against a throwaway SQLite database with
+authentication stubbed out. The parent hosts the S3 stand-in (moto server), so
+stored objects do not count against the API process, drives the uploads and
+reads the child's peak RSS (VmHWM) from /proc. Linux only; needs moto.
+
+Run from the server directory:
+
+    python -m benchmarks.bench_upload_memory --clients 50 --size-mb 10
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+PORT = 8799
+S3_PORT = 8798
+
+
+def serve():
+    from types import SimpleNamespace
+    import uvicorn
+    import main
+    from app.utils.dependencies import get_current_user
+
+    main.app.dependency_overrides[get_current_user] = lambda: SimpleNamespace(id=None, admin=True)
+    uvicorn.run(main.app, port=PORT, log_level="warning")
+
+
+def peak_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def upload(client, path, index):
+    with open(path, "rb") as image:
+        response = await client.post(
+            "/news/add",
+            data={"title": f"bench {index}", "description": "bench", "latitude": "17.385", "longitude": "78.4867"},
+            files={"image": (f"bench_{index}.jpg", image, "image/jpeg")},
+        )
+    return response.status_code
+
+
+async def drive(clients, path):
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=300) as client:
+        for _ in range(100):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        codes = await asyncio.gather(*(upload(client, path, i) for i in range(clients)))
+        return codes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--size-mb", type=int, default=10)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+        return
+
+    workdir = tempfile.mkdtemp(prefix="alert-bench-")
+    image_path = os.path.join(workdir, "image.jpg")
+    with open(image_path, "wb") as image:
+        image.write(b"\xff\xd8\xff\xe0")
+        image.write(os.urandom(args.size_mb * 1024 * 1024 - 4))
+
+    from moto.server import ThreadedMotoServer
+    import boto3
+    import logging
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    s3_server = ThreadedMotoServer(port=S3_PORT, verbose=False)
+    s3_server.start()
+    endpoint = f"http://127.0.0.1:{S3_PORT}"
+    boto3.client(
+        "s3", endpoint_url=endpoint, region_name="us-east-1",
+        aws_access_key_id="bench", aws_secret_access_key="bench",
+    ).create_bucket(Bucket="alert-bench")
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{workdir}/bench.db",
+        AWS_BUCKET="alert-bench",
+        AWS_ACCESS_KEY_ID="bench",
+        AWS_SECRET_ACCESS_KEY="bench",
+        AWS_REGION="us-east-1",
+        AWS_S3_ENDPOINT_URL=endpoint,
+        MAX_IMAGE_MB=str(args.size_mb),
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.bench_upload_memory", "--serve"], env=env
+    )
+    try:
+        codes, elapsed = asyncio.run(drive(args.clients, image_path))
+        peak = peak_rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        s3_server.stop()
+
+    ok = sum(1 for code in codes if code == 200)
+    print(f"uploads            {ok}/{args.clients} x {args.size_mb} MB succeeded in {elapsed:.2f}s")
+    print(f"server peak RSS    {peak:.1f} MB")
+    print(f"body total         {args.clients * args.size_mb} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+SOS submission latency under a sudden 10x burst, with and without ingress rate
+limiting.
+
+A server on a fresh database takes open-loop POST /sos/sos traffic from many
+users: a steady phase at --rate submissions per second, a burst phase at
+--burst-factor times that rate (users around a few incidents resubmitting, as
+happens when a disaster strikes), then steady again. Each phase reports p50 and
+p99 latency. With the limiter on, submissions above SOS_GLOBAL_RATE_PER_SECOND
+or a user's own budget are answered 202 and written in batches by the SOS
+buffer, so p99 should stay close to the steady phase; with it off, every
+submission waits until its own row is committed.
+
+Latency is measured from when each request was due, so time spent waiting for
+a free client connection counts against the server.
+
+After each run it prints how many submissions were accepted and how many alerts
+were saved; the difference is repeats merged into an alert nearby, not losses.
+
+Run from the server directory:
+
+    python -m benchmarks.load_sos_burst --rate 20 --burst-factor 10 --seconds 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import httpx
+import jwt
+
+PORT = 8797
+SECRET_KEY = "bench-secret"
+CENTER = (17.385, 78.4867)
+
+SERVE = """
+import os, sys
+from datetime import datetime
+sys.path.insert(0, os.getcwd())
+import uvicorn, main, Model
+from database import SessionLocal, engine
+
+Model.Base.metadata.drop_all(bind=engine)
+Model.Base.metadata.create_all(bind=engine)
+db = SessionLocal()
+for i in range(int(os.environ["BENCH_USERS"])):
+    db.add(Model.Users(fullName=f"u{i}", email=f"u{i}@example.com", password="x", is_verified=True, createdAt=datetime.utcnow()))
+db.commit()
+db.close()
+uvicorn.run(main.app, port=int(os.environ["BENCH_PORT"]), log_level="warning")
+"""
+
+
+def token(user):
+    expire = datetime.utcnow() + timedelta(hours=1)
+    return jwt.encode({"sub": f"u{user}@example.com", "exp": expire}, SECRET_KEY, algorithm="HS256")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def schedule(args, rng):
+    """(send at, phase, user, params) for every submission, open loop."""
+    incidents = [
+        (CENTER[0] + rng.uniform(-0.2, 0.2), CENTER[1] + rng.uniform(-0.2, 0.2)) for _ in range(5)
+    ]
+    phases = [("steady", args.rate), ("burst", args.rate * args.burst_factor), ("after", args.rate)]
+    plan, start = [], 0.0
+    for phase, rate in phases:
+        count = int(rate * args.seconds)
+        for i in range(count):
+            if phase == "burst":
+                # Fewer, more anxious senders around the incidents
+                user = rng.randrange(args.users // 4)
+                lat, lon = incidents[user % len(incidents)]
+                lat += rng.gauss(0, 0.002)
+                lon += rng.gauss(0, 0.002)
+            else:
+                user = rng.randrange(args.users)
+                lat = CENTER[0] + rng.uniform(-0.3, 0.3)
+                lon = CENTER[1] + rng.uniform(-0.3, 0.3)
+            params = {"persons": rng.randint(1, 6), "latitude": lat, "longitude": lon}
+            plan.append((start + i / rate, phase, user, params))
+        start += args.seconds
+    return plan
+
+
+async def drive(args):
+    rng = random.Random(17)
+    tokens = [{"Authorization": f"Bearer {token(user)}"} for user in range(args.users)]
+    # One connection per client: a single large httpx pool costs more CPU than
+    # the server does per request on a small machine
+    clients = [httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=120) for _ in range(args.connections)]
+    for _ in range(300):
+        try:
+            await clients[0].get("/")
+            break
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+
+    plan = schedule(args, rng)
+    queue = asyncio.Queue()
+    results = []
+
+    async def worker(client):
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            at, phase, user, params = entry
+            try:
+                response = await client.post("/sos/sos", params=params, headers=tokens[user])
+                code = response.status_code
+            except httpx.HTTPError:
+                code = 599
+            # Measured from when the request was due, so time spent waiting for a free connection counts
+            results.append((phase, code, time.perf_counter() - began - at))
+
+    workers = [asyncio.create_task(worker(client)) for client in clients]
+    began = time.perf_counter()
+    for entry in plan:
+        delay = entry[0] - (time.perf_counter() - began)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        queue.put_nowait(entry)
+    for _ in workers:
+        queue.put_nowait(None)
+    await asyncio.gather(*workers)
+    for client in clients:
+        await client.aclose()
+    return results
+
+
+def run(label, args, limited):
+    workdir = tempfile.mkdtemp(prefix="alert-burst-")
+    database = f"{workdir}/bench.db"
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{database}",
+        SECRET_KEY=SECRET_KEY,
+        BENCH_USERS=str(args.users),
+        BENCH_PORT=str(PORT),
+        SPATIAL_INDEX_ENABLED="false",
+        SOS_RATE_LIMIT_ENABLED="true" if limited else "false",
+        SOS_GLOBAL_RATE_PER_SECOND=str(args.global_rate or args.rate * 2),
+        SOS_GLOBAL_BURST=str(args.global_rate or args.rate * 2),
+        # Every simulated user connects from 127.0.0.1
+        SOS_IP_RATE_PER_MINUTE="1000000",
+        SOS_IP_BURST="1000000",
+    )
+    server = subprocess.Popen([sys.executable, "-c", SERVE], env=env)
+    try:
+        results = asyncio.run(drive(args))
+    finally:
+        # SIGTERM runs the lifespan shutdown, which flushes the SOS buffer
+        server.terminate()
+        server.wait()
+
+    for phase in ("steady", "burst", "after"):
+        latencies = [elapsed for name, code, elapsed in results if name == phase]
+        queued = sum(1 for name, code, _ in results if name == phase and code == 202)
+        errors = sum(1 for name, code, _ in results if name == phase and code >= 400)
+        print(
+            f"{label:>8} {phase:>7} {len(latencies):>6} {queued:>7} {errors:>7}"
+            f" {percentile(latencies, 0.5):>8.1f} {percentile(latencies, 0.99):>8.1f}"
+        )
+
+    accepted = sum(1 for _, code, _ in results if code < 400)
+    with sqlite3.connect(database) as conn:
+        alerts = conn.execute("SELECT count(*) FROM sos").fetchone()[0]
+    print(f"{label:>8} {accepted} accepted, {alerts} alerts saved (the rest merged into nearby repeats)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=20, help="steady submissions per second")
+    parser.add_argument("--burst-factor", type=float, default=10)
+    parser.add_argument("--seconds", type=float, default=5, help="length of each phase")
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--global-rate", type=float, help="SOS_GLOBAL_RATE_PER_SECOND (default twice --rate)")
+    args = parser.parse_args()
+
+    print(f"{args.rate:g}/s steady, {args.rate * args.burst_factor:g}/s burst, {args.seconds:g}s phases, {args.users} users")
+    print(f"{'limiter':>8} {'phase':>7} {'sent':>6} {'queued':>7} {'errors':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    run("off", args, limited=False)
+    run("on", args, limited=True)
+
+
+if __name__ == "__main__":
+    main()
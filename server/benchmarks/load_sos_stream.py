@@ -0,0 +1,100 @@
+"""
+Load test for the SOS push feed: thousands of concurrent subscribers on the
+in-process broker, with alerts published from worker threads the way the sync
+route handlers do it.
+
+Run from the server directory:
+
+    python -m benchmarks.load_sos_stream --subscribers 5000 --events 500
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import threading
+import time
+from app.utils.pubsub import GeoBroker
+
+CENTER = (17.385, 78.4867)  # Hyderabad
+RADII = (5, 10, 15, 20)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def run(subscriber_count, event_count, rate):
+    broker = GeoBroker()
+    latencies = []
+    received = 0
+
+    subscriptions = [
+        broker.subscribe(
+            CENTER[0] + random.uniform(-0.5, 0.5),
+            CENTER[1] + random.uniform(-0.5, 0.5),
+            random.choice(RADII),
+        )
+        for _ in range(subscriber_count)
+    ]
+
+    async def consume(subscription):
+        nonlocal received
+        while True:
+            event = await subscription.get()
+            if event.get("type") == "stop":
+                return
+            if "sent" in event:
+                latencies.append(time.perf_counter() - event["sent"])
+                received += 1
+
+    consumers = [asyncio.create_task(consume(s)) for s in subscriptions]
+
+    def produce():
+        for i in range(event_count):
+            broker.publish({
+                "type": "sos",
+                "id": i,
+                "latitude": CENTER[0] + random.uniform(-0.6, 0.6),
+                "longitude": CENTER[1] + random.uniform(-0.6, 0.6),
+                "sent": time.perf_counter(),
+            })
+            time.sleep(1 / rate)
+
+    start = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while producer.is_alive():
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)  # let the last fan-outs drain
+    elapsed = time.perf_counter() - start
+
+    for subscription in subscriptions:
+        subscription.deliver({"type": "stop"})
+    await asyncio.gather(*consumers)
+
+    stats = broker.stats()
+    print(f"subscribers        {subscriber_count}")
+    print(f"events published   {stats['published']} in {elapsed:.2f}s")
+    print(f"deliveries         {received} ({received / max(stats['published'], 1):.0f} per event)")
+    print(f"queue overflows    {stats['overflows']}")
+    if latencies:
+        print(f"latency p50        {statistics.median(latencies) * 1000:.2f} ms")
+        print(f"latency p99        {percentile(latencies, 99) * 1000:.2f} ms")
+        print(f"latency max        {max(latencies) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200, help="events per second")
+    args = parser.parse_args()
+    random.seed(42)
+    asyncio.run(run(args.subscribers, args.events, args.rate))
+
+
+if __name__ == "__main__":
+    main()
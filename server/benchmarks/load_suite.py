@@ -0,0 +1,631 @@
+"""
+Load test of the auth, shelter, food, news and SOS routers against a freshly
+seeded database, with per-route throughput and latency and stored baselines.
+
+The server runs in a subprocess on a database that is dropped and seeded with
+synthetic users, shelters, food regions, news and SOS alerts scattered around
+flood-prone Indian cities. A closed-loop workload of --concurrency clients
+then sends a weighted mix of requests for --duration seconds (after --warmup
+seconds that are not counted): nearby, nearest-shelter and full-text
+searches, map tiles, per-user listings, updates, logins, token refreshes, registrations,
+SOS submissions and resolutions. Pass --mix to change the weights, e.g. --mix
+"sos.post=20,shelter.nearby=5"; a weight of 0 drops a route. The /add routes
+upload an image to S3 and only run with --uploads, against AWS_* settings for
+an S3-compatible endpoint.
+
+Results are printed per route as requests, req/s, client and server errors and
+p50/p95/p99 latency. --save-baseline stores them as JSON (by default
+benchmarks/baselines/<database>.json); later runs compare against that file
+and exit with status 1 when a route's p95, the total throughput or the error
+rate got worse than --tolerance allows.
+
+The database is SQLite in a temporary directory unless DATABASE_URL or
+--database-url points elsewhere (it is wiped). --postgres starts a throwaway
+Postgres from the pgserver package instead, no Docker needed.
+
+Run from the server directory:
+
+    python -m benchmarks.load_suite --duration 30 --concurrency 32 --save-baseline
+    python -m benchmarks.load_suite --duration 30 --concurrency 32
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import httpx
+import jwt
+
+PORT = 8793
+SECRET_KEY = "bench-secret"
+PASSWORD = "bench-password"
+
+# name: (latitude, longitude, pincode prefix)
+CITIES = {
+    "hyderabad": (17.3850, 78.4867, "500"),
+    "chennai": (13.0827, 80.2707, "600"),
+    "mumbai": (19.0760, 72.8777, "400"),
+    "kolkata": (22.5726, 88.3639, "700"),
+    "guwahati": (26.1445, 91.7362, "781"),
+    "kochi": (9.9312, 76.2673, "682"),
+    "patna": (25.5941, 85.1376, "800"),
+    "bhubaneswar": (20.2961, 85.8245, "751"),
+}
+SPREAD_DEG = 0.06  # about 6 km around the city centre
+
+SIZES = {"users": 1000, "shelters": 5000, "food": 3000, "news": 5000, "sos": 5000}
+
+DEFAULT_MIX = {
+    "auth.login": 2,
+    "auth.profile": 6,
+    "auth.refresh": 2,
+    "auth.register": 1,
+    "shelter.nearby": 18,
+    "shelter.nearest": 4,
+    "shelter.mine": 4,
+    "shelter.update": 2,
+    "shelter.search": 2,
+    "food.nearby": 12,
+    "food.mine": 3,
+    "food.update": 1,
+    "news.nearby": 14,
+    "news.mine": 3,
+    "news.update": 1,
+    "news.search": 2,
+    "sos.post": 8,
+    "sos.all": 8,
+    "sos.clusters": 4,
+    "sos.resolve": 1,
+    "stats.pincode": 1,
+    "tiles.get": 8,
+}
+UPLOAD_MIX = {"shelter.add": 1, "food.add": 1, "news.add": 1}
+
+
+def place(rng):
+    """A random point near one of the cities, and its pincode."""
+    latitude, longitude, prefix = CITIES[rng.choice(list(CITIES))]
+    return (
+        latitude + rng.gauss(0, SPREAD_DEG),
+        longitude + rng.gauss(0, SPREAD_DEG),
+        f"{prefix}{rng.randint(1, 99):03d}",
+    )
+
+
+def tile(latitude, longitude, z):
+    """Web Mercator (x, y) of the map tile holding the point at zoom z."""
+    n = 1 << z
+    y = (1 - math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2)) / math.pi) / 2 * n
+    return int((longitude + 180) / 360 * n), int(y)
+
+
+def owner(index, users):
+    """User id owning the index-th seeded shelter, food region or news item."""
+    return index % users + 1
+
+
+def resolved(index):
+    """Whether the index-th seeded SOS alert starts out resolved."""
+    return index % 5 == 0
+
+
+# Seeding, run in the server process
+
+
+def seed(engine, sizes, password_hash):
+    import Model
+    from sqlalchemy import insert
+
+    rng = random.Random(42)
+    now = datetime.utcnow()
+
+    def rows(count, make):
+        batch = []
+        for index in range(count):
+            batch.append(make(index))
+            if len(batch) == 1000:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def user(index):
+        latitude, longitude, pincode = place(rng)
+        return {
+            "id": index + 1, "fullName": f"Bench User {index}", "email": f"user{index}@bench.example",
+            "password": password_hash, "phoneNumber": f"9{index:09d}", "is_verified": True, "admin": index == 0,
+            "createdAt": now, "address": "Bench Street", "pincode": pincode, "latitude": latitude, "longitude": longitude,
+        }
+
+    def shelter(index):
+        latitude, longitude, pincode = place(rng)
+        capacity = rng.choice([None, 50, 200, 1000])
+        return {
+            "id": index + 1, "name": f"Relief camp {index}", "address": f"{index} Camp Road", "pincode": pincode,
+            "description": "School building, ground floor", "createdAt": now, "updatedAt": now,
+            "latitude": latitude, "longitude": longitude, "userId": owner(index, sizes["users"]), "distance": 0,
+            "capacity": capacity, "occupancy": None if capacity is None else rng.randint(0, capacity),
+        }
+
+    def food(index):
+        latitude, longitude, pincode = place(rng)
+        return {
+            "id": index + 1, "address": f"{index} Market Street", "pincode": pincode,
+            "description": "Cooked meals twice a day", "createdAt": now - timedelta(hours=rng.uniform(0, 72)),
+            "latitude": latitude, "longitude": longitude, "userId": owner(index, sizes["users"]), "distance": 0,
+        }
+
+    def news(index):
+        latitude, longitude, _ = place(rng)
+        created = now - timedelta(hours=rng.uniform(0, 7 * 24))
+        return {
+            "id": index + 1, "title": f"Water level update {index}", "description": "River above danger mark",
+            "createdAt": created, "updatedAt": created, "latitude": latitude, "longitude": longitude,
+            "userId": owner(index, sizes["users"]), "distance": 0,
+        }
+
+    def sos(index):
+        latitude, longitude, pincode = place(rng)
+        return {
+            "id": index + 1, "createdAt": now - timedelta(hours=rng.uniform(0, 48)), "issue_rectified": False,
+            "latitude": latitude, "longitude": longitude, "persons": rng.randint(1, 8),
+            "userId": rng.randint(1, sizes["users"]), "resolved": resolved(index), "pincode": pincode,
+        }
+
+    tables = [
+        (Model.Users, "users", user),
+        (Model.Shelters, "shelters", shelter),
+        (Model.FoodProvidingRegions, "food", food),
+        (Model.News, "news", news),
+        (Model.SOS, "sos", sos),
+    ]
+    with engine.begin() as conn:
+        for model, name, make in tables:
+            for batch in rows(sizes[name], make):
+                conn.execute(insert(model), batch)
+        if engine.dialect.name == "postgresql":
+            # Explicit ids leave the sequences behind
+            for model, _, _ in tables:
+                table = model.__tablename__
+                conn.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce(max(id), 1)) FROM {table}"
+                )
+
+
+def serve():
+    """Entry point of the server subprocess: reset and seed the database, then serve."""
+    sys.path.insert(0, os.getcwd())
+    import bcrypt
+    import uvicorn
+    import main
+    import Model
+    from database import engine
+    from app.utils.passwords import BCRYPT_ROUNDS
+
+    Model.Base.metadata.drop_all(bind=engine)
+    Model.Base.metadata.create_all(bind=engine)
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+    seed(engine, json.loads(os.environ["BENCH_SIZES"]), password_hash)
+    uvicorn.run(main.app, port=int(os.environ["BENCH_PORT"]), log_level="warning")
+
+
+# Workload
+
+
+def jpeg():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (40, 90, 160)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class Workload:
+    """Builds the requests of each route for random users and rows."""
+
+    def __init__(self, sizes, mix, seed=7):
+        self.sizes = sizes
+        self.mix = mix
+        self.rng = random.Random(seed)
+        self._tokens = {}
+        self._registered = 0
+        # Each seeded unresolved alert is resolved at most once
+        self._unresolved = [index + 1 for index in range(sizes["sos"]) if not resolved(index)]
+        self.rng.shuffle(self._unresolved)
+        self._image = jpeg() if any(name.endswith(".add") for name in mix) else None
+
+    def user(self):
+        return self.rng.randint(1, self.sizes["users"])
+
+    def email(self, user_id):
+        return f"user{user_id - 1}@bench.example"
+
+    def auth(self, user_id):
+        token = self._tokens.get(user_id)
+        if token is None:
+            expire = datetime.utcnow() + timedelta(hours=6)
+            token = self._tokens[user_id] = jwt.encode(
+                {"sub": self.email(user_id), "exp": expire}, SECRET_KEY, algorithm="HS256"
+            )
+        return {"Authorization": f"Bearer {token}"}
+
+    def owned(self, table):
+        """A row of `table` and the headers of its owner."""
+        index = self.rng.randrange(self.sizes[table])
+        return index + 1, self.auth(owner(index, self.sizes["users"]))
+
+    def coordinates(self):
+        latitude, longitude, _ = place(self.rng)
+        return {"latitude": latitude, "longitude": longitude}
+
+    def next_request(self):
+        name = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        return name, getattr(self, name.replace(".", "_"))()
+
+    # One method per route: (method, path, httpx request arguments)
+
+    def auth_login(self):
+        body = {"email": self.email(self.user()), "password": PASSWORD, "coordinates": self.coordinates()}
+        return "POST", "/auth/login", {"json": body}
+
+    def auth_profile(self):
+        return "GET", "/auth/profile", {"headers": self.auth(self.user())}
+
+    def auth_refresh(self):
+        expire = datetime.utcnow() + timedelta(days=1)
+        token = jwt.encode({"sub": self.email(self.user()), "exp": expire}, SECRET_KEY, algorithm="HS256")
+        return "POST", "/auth/refresh", {"json": {"refresh_token": token}}
+
+    def auth_register(self):
+        self._registered += 1
+        number = f"{self.rng.randrange(10 ** 9)}-{self._registered}"
+        body = {
+            "fullName": "New Volunteer", "email": f"new{number}@bench.example", "password": PASSWORD,
+            "phoneNumber": f"8{number}", "address": "Bench Street", "pincode": "500001",
+            "coordinates": self.coordinates(),
+        }
+        return "POST", "/auth/register", {"json": body}
+
+    def shelter_nearby(self):
+        params = dict(self.coordinates(), dist=self.rng.choice([5, 10, 20]), limit=50)
+        return "GET", "/shelter/get-shelters", {"params": params}
+
+    def shelter_nearest(self):
+        params = dict(self.coordinates(), k=self.rng.choice([1, 5, 10]))
+        return "GET", "/shelter/nearest", {"params": params}
+
+    def shelter_mine(self):
+        return "GET", "/shelter/get-shelters-by-user", {"headers": self.auth(self.user())}
+
+    def shelter_update(self):
+        shelter_id, headers = self.owned("shelters")
+        latitude, longitude, pincode = place(self.rng)
+        form = {
+            "name": f"Relief camp {shelter_id}", "address": "Camp Road", "pincode": pincode,
+            "latitude": latitude, "longitude": longitude, "description": "Capacity updated",
+        }
+        return "PUT", f"/shelter/update/{shelter_id}", {"data": form, "headers": headers}
+
+    def shelter_search(self):
+        params = {"q": self.rng.choice(["relief", "camp road", "scho", "ground floor"])}
+        if self.rng.random() < 0.5:
+            params.update(self.coordinates(), dist=20)
+        return "GET", "/shelter/search", {"params": params}
+
+    def shelter_add(self):
+        latitude, longitude, pincode = place(self.rng)
+        form = {
+            "name": "New camp", "address": "Camp Road", "pincode": pincode, "latitude": latitude,
+            "longitude": longitude, "userLatitude": latitude, "userLongitude": longitude,
+        }
+        files = {"image": ("camp.jpg", self._image, "image/jpeg")}
+        return "POST", "/shelter/add", {"data": form, "files": files, "headers": self.auth(self.user())}
+
+    def food_nearby(self):
+        params = dict(self.coordinates(), dist=self.rng.choice([5, 10, 20]), limit=50)
+        return "GET", "/food/food", {"params": params}
+
+    def food_mine(self):
+        return "GET", "/food/get-food-regions", {"headers": self.auth(self.user())}
+
+    def food_update(self):
+        food_id, headers = self.owned("food")
+        latitude, longitude, pincode = place(self.rng)
+        form = {
+            "address": "Market Street", "pincode": pincode, "description": "Dry rations only",
+            "latitude": latitude, "longitude": longitude,
+        }
+        return "PUT", f"/food/update/{food_id}", {"data": form, "headers": headers}
+
+    def food_add(self):
+        latitude, longitude, pincode = place(self.rng)
+        form = {
+            "address": "Market Street", "pincode": pincode, "description": "Community kitchen",
+            "latitude": latitude, "longitude": longitude, "userLatitude": latitude, "userLongitude": longitude,
+        }
+        files = {"image": ("kitchen.jpg", self._image, "image/jpeg")}
+        return "POST", "/food/add", {"data": form, "files": files, "headers": self.auth(self.user())}
+
+    def news_nearby(self):
+        params = dict(self.coordinates(), distance=self.rng.choice([5, 10, 20]), limit=50)
+        return "GET", "/news/news", {"params": params}
+
+    def news_mine(self):
+        return "GET", "/news/mynews", {"headers": self.auth(self.user())}
+
+    def news_update(self):
+        news_id, headers = self.owned("news")
+        latitude, longitude, _ = place(self.rng)
+        form = {
+            "title": f"Water level update {news_id}", "description": "Water receding",
+            "latitude": latitude, "longitude": longitude,
+        }
+        return "PUT", f"/news/update/{news_id}", {"data": form, "headers": headers}
+
+    def news_search(self):
+        params = {"q": self.rng.choice(["water", "river dan", "updat", "level"])}
+        if self.rng.random() < 0.5:
+            params.update(self.coordinates(), distance=20)
+        return "GET", "/news/search", {"params": params}
+
+    def news_add(self):
+        latitude, longitude, _ = place(self.rng)
+        form = {"title": "Road closed", "description": "Bridge under water", "latitude": latitude, "longitude": longitude}
+        files = {"image": ("road.jpg", self._image, "image/jpeg")}
+        return "POST", "/news/add", {"data": form, "files": files, "headers": self.auth(self.user())}
+
+    def sos_post(self):
+        params = dict(self.coordinates(), persons=self.rng.randint(1, 6))
+        return "POST", "/sos/sos", {"params": params, "headers": self.auth(self.user())}
+
+    def sos_all(self):
+        latitude, longitude, _ = place(self.rng)
+        params = {"admin_latitude": latitude, "admin_longitude": longitude, "radius": 20, "limit": 100}
+        return "GET", "/sos/all", {"params": params}
+
+    def sos_clusters(self):
+        params = dict(self.coordinates(), radius=20, min_alerts=2)
+        return "GET", "/sos/clusters", {"params": params}
+
+    def sos_resolve(self):
+        alert_id = self._unresolved.pop() if self._unresolved else self.rng.randint(1, self.sizes["sos"])
+        return "PUT", f"/sos/resolve/{alert_id}", {}
+
+    def stats_pincode(self):
+        # User 1 (the first seeded) is the admin
+        if self.rng.random() < 0.5:
+            return "GET", "/stats/pincode", {"params": {"limit": 50}, "headers": self.auth(1)}
+        _, _, pincode = place(self.rng)
+        return "GET", f"/stats/pincode/{pincode}", {"headers": self.auth(1)}
+
+    def tiles_get(self):
+        latitude, longitude, _ = place(self.rng)
+        z = self.rng.randint(5, 15)
+        x, y = tile(latitude, longitude, z)
+        return "GET", f"/tiles/{self.rng.choice(['shelters', 'food', 'sos'])}/{z}/{x}/{y}", {}
+
+
+async def drive(workload, args):
+    # One connection per client: a single large httpx pool costs more CPU than
+    # the server does per request on a small machine
+    clients = [httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=120) for _ in range(args.concurrency)]
+    for _ in range(600):
+        try:
+            await clients[0].get("/")
+            break
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+
+    results = []
+    started = time.perf_counter()
+    measure_from = started + args.warmup
+    deadline = measure_from + args.duration
+
+    async def client_loop(client):
+        while time.perf_counter() < deadline:
+            name, (method, path, kwargs) = workload.next_request()
+            start = time.perf_counter()
+            try:
+                code = (await client.request(method, path, **kwargs)).status_code
+            except httpx.HTTPError:
+                code = 599  # dropped connection or client timeout
+            if start >= measure_from:
+                results.append((name, code, time.perf_counter() - start))
+
+    await asyncio.gather(*(client_loop(client) for client in clients))
+    for client in clients:
+        await client.aclose()
+    return results, time.perf_counter() - measure_from
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] * 1000 if values else 0.0
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for name in sorted({name for name, _, _ in results}):
+        latencies = sorted(latency for route, _, latency in results if route == name)
+        codes = [code for route, code, _ in results if route == name]
+        routes[name] = {
+            "requests": len(latencies),
+            "rps": round(len(latencies) / elapsed, 2),
+            "client_errors": sum(1 for code in codes if 400 <= code < 500),
+            "errors": sum(1 for code in codes if code >= 500),
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+        }
+    latencies = sorted(latency for _, _, latency in results)
+    routes["total"] = {
+        "requests": len(results),
+        "rps": round(len(results) / elapsed, 2),
+        "client_errors": sum(route["client_errors"] for route in routes.values()),
+        "errors": sum(route["errors"] for route in routes.values()),
+        "p50": round(percentile(latencies, 0.50), 2),
+        "p95": round(percentile(latencies, 0.95), 2),
+        "p99": round(percentile(latencies, 0.99), 2),
+    }
+    return routes
+
+
+def report(routes):
+    print(f"{'route':<16} {'requests':>8} {'req/s':>8} {'4xx':>5} {'5xx':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, route in routes.items():
+        print(
+            f"{name:<16} {route['requests']:>8} {route['rps']:>8.1f} {route['client_errors']:>5} {route['errors']:>5}"
+            f" {route['p50']:>8.1f} {route['p95']:>8.1f} {route['p99']:>8.1f}"
+        )
+
+
+def compare(routes, baseline, tolerance, floor_ms, min_requests):
+    """
+    Print each route against the baseline. A route regresses when its p95 grew
+    by more than `tolerance` (and by more than `floor_ms`, so fast routes don't
+    trip on noise) or it started failing; throughput is only judged on the
+    total, since each route's share of it is set by the mix. Routes with fewer
+    than `min_requests` requests in either run are reported but not judged.
+    Returns the names of the routes that regressed.
+    """
+    regressions = []
+    print(f"\n{'route':<16} {'p95 base':>9} {'p95 now':>9} {'req/s base':>11} {'req/s now':>10}  verdict")
+    for name, route in routes.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<16} {'-':>9} {route['p95']:>9.1f} {'-':>11} {route['rps']:>10.1f}  new")
+            continue
+        problems = []
+        if min(route["requests"], base["requests"]) < min_requests:
+            problems.append("too few requests to judge")
+        else:
+            if route["p95"] > base["p95"] * (1 + tolerance) and route["p95"] - base["p95"] > floor_ms:
+                problems.append("slower")
+            if name == "total" and route["rps"] < base["rps"] * (1 - tolerance):
+                problems.append("less throughput")
+            if route["errors"] / route["requests"] > base["errors"] / base["requests"] + 0.01:
+                problems.append("more errors")
+            if problems:
+                regressions.append(name)
+        print(
+            f"{name:<16} {base['p95']:>9.1f} {route['p95']:>9.1f} {base['rps']:>11.1f} {route['rps']:>10.1f}"
+            f"  {', '.join(problems) or 'ok'}"
+        )
+    return regressions
+
+
+def parse_mix(text, uploads):
+    mix = dict(DEFAULT_MIX, **(UPLOAD_MIX if uploads else {}))
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        name, _, weight = item.partition("=")
+        if name not in DEFAULT_MIX and name not in UPLOAD_MIX:
+            raise SystemExit(f"Unknown route {name!r}; routes are {', '.join(list(DEFAULT_MIX) + list(UPLOAD_MIX))}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def start_postgres(directory):
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit("--postgres needs the pgserver package (pip install pgserver)")
+    server = pgserver.get_server(directory, cleanup_mode="stop")
+    return server, server.get_uri().replace("postgresql://", "postgresql+psycopg2://", 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", help='route weights, e.g. "sos.post=20,auth.login=0"')
+    parser.add_argument("--uploads", action="store_true", help="include the /add routes (needs S3 settings)")
+    for name, default in SIZES.items():
+        parser.add_argument(f"--{name}", type=int, default=default, help=f"{name} rows to seed")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="database to wipe and seed")
+    parser.add_argument("--postgres", action="store_true", help="run against a throwaway pgserver Postgres")
+    parser.add_argument("--baseline", help="baseline file (default benchmarks/baselines/<database>.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95 and req/s change")
+    parser.add_argument("--floor-ms", type=float, default=5, help="ignore p95 increases smaller than this")
+    parser.add_argument("--min-requests", type=int, default=100, help="don't judge routes with fewer requests")
+    parser.add_argument("--output", help="also write this run's results as JSON here")
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) for name in SIZES}
+    mix = parse_mix(args.mix, args.uploads)
+    workdir = tempfile.mkdtemp(prefix="alert-suite-")
+    postgres = None
+    if args.postgres:
+        postgres, database_url = start_postgres(os.path.join(workdir, "pgdata"))
+    else:
+        database_url = args.database_url or f"sqlite:///{workdir}/bench.db"
+    backend = database_url.split(":", 1)[0].split("+", 1)[0]
+    baseline_path = args.baseline or os.path.join(os.path.dirname(__file__), "baselines", f"{backend}.json")
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        SECRET_KEY=SECRET_KEY,
+        BENCH_SIZES=json.dumps(sizes),
+        BENCH_PORT=str(PORT),
+    )
+    print(
+        f"{backend}, concurrency {args.concurrency}, {args.duration:g}s after {args.warmup:g}s warmup, "
+        + ", ".join(f"{count} {name}" for name, count in sizes.items())
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-c", "from benchmarks.load_suite import serve; serve()"], env=env
+    )
+    try:
+        results, elapsed = asyncio.run(drive(Workload(sizes, mix), args))
+    finally:
+        server.terminate()
+        server.wait()
+        if postgres is not None:
+            postgres.cleanup()
+
+    routes = summarize(results, elapsed)
+    report(routes)
+    run = {
+        "recorded": datetime.utcnow().isoformat(timespec="seconds"),
+        "config": {
+            "database": backend, "concurrency": args.concurrency, "duration": args.duration,
+            "sizes": sizes, "mix": mix,
+        },
+        "routes": routes,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(run, file, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w") as file:
+            json.dump(run, file, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+        return
+    if not os.path.exists(baseline_path):
+        print(f"\nNo baseline at {baseline_path}; rerun with --save-baseline to record one")
+        return
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    if baseline["config"] != run["config"]:
+        print("\nWarning: the baseline was recorded with a different configuration:")
+        print(json.dumps(baseline["config"]))
+    regressions = compare(routes, baseline["routes"], args.tolerance, args.floor_ms, args.min_requests)
+    if regressions:
+        print(f"\nRegressed: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,73 @@
-from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session
+import os
+import sys
+from fastapi import FastAPI, Depends, Query
 from typing import Annotated
-from database import SessionLocal, engine
+from database import AsyncSessionLocal, async_engine, engine, get_async_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import Model
 from pydantic import BaseModel
-from app.api import auth, shelters, sos,food, news
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from app.schemas.auth import UserOut
+from app.api import auth, shelters, sos,food, news, spatial, stats, tiles
+from app.utils import spatial_index, images, passwords, response_cache, sos_clusters, batch_writer, metrics, search
+from app.utils.dependencies import get_admin_user
+from app.utils.mailer import mailer
+from app.utils.sos_buffer import sos_buffer
+from app.utils.pincode_stats import pincode_stats
+from app.utils.uploads import UploadLimitMiddleware
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from loguru import logger
 
-app = FastAPI()
+# Debug output (request parameters and the like) is off unless asked for
+logger.remove()
+logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", os.getenv("LOGURU_LEVEL", "INFO")).upper())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the optional in-memory spatial index before serving requests
+    if spatial_index.SPATIAL_INDEX_ENABLED:
+        async with AsyncSessionLocal() as db:
+            await spatial_index.rebuild_all(db)
+    if sos_clusters.SOS_CLUSTERING_ENABLED:
+        async with AsyncSessionLocal() as db:
+            await sos_clusters.engine.rebuild(db)
+    passwords.warm_up()
+    # Deliver queued mail, including anything left pending before a restart
+    mailer.start()
+    sos_buffer.start()
+    # Recounts the per-pincode stats, then keeps them current
+    pincode_stats.start()
+    if metrics.PROFILER_ENABLED:
+        metrics.profiler.start()
+    yield
+    metrics.profiler.stop()
+    # Save rate limited SOS alerts still waiting before the engine goes away
+    await sos_buffer.stop()
+    await batch_writer.stop()
+    await pincode_stats.stop()
+    await mailer.stop()
+    images.shutdown()
+    passwords.shutdown()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ['*']
 
+if metrics.METRICS_ENABLED:
+    metrics.instrument_engine(engine)
+    metrics.instrument_engine(async_engine.sync_engine)
+    metrics.gauge("sos_buffer_pending", "Rate limited SOS alerts waiting to be written", lambda: len(sos_buffer))
+    metrics.gauge("batch_writes_queued", "Rows waiting in the write-behind batch writers", lambda: sum(len(writer) for writer in batch_writer.WRITERS))
+    app.add_middleware(metrics.MetricsMiddleware)
+
+# Refuses oversized image uploads before they are spooled to disk
+app.add_middleware(UploadLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,  # Allow only specified origins
@@ -21,16 +78,10 @@ app.add_middleware(
 
 # Create tables in the database
 Model.Base.metadata.create_all(bind=engine)
+with engine.begin() as connection:
+    search.create_index(connection)
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
 
 class user(BaseModel):
     username: str
@@ -41,15 +92,53 @@ class user(BaseModel):
 def read_root():
     return {"message": "Hello, FastAPI!"}
 
-@app.get("/users")
+@app.get("/users", response_model=list[UserOut], response_class=ORJSONResponse)
 async def get_users(db: db_dependency):
-    users = db.query(Model.Users).all()
+    users = (await db.scalars(select(Model.Users))).all()
     return users
 
+@app.get("/response-cache")
+def get_response_cache_stats(current_user=Depends(get_admin_user)):
+    """
+    Report backend, size and hit ratio of the shelter, food and news response cache.
+    """
+    return response_cache.stats()
+
+
+@app.get("/batch-writes")
+def get_batch_write_stats(current_user=Depends(get_admin_user)):
+    """
+    Report queued, written and failed rows of each write-behind batch writer.
+    """
+    return batch_writer.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """
+    Request, database, S3 and mail timings in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.put("/metrics/profiler")
+async def set_profiler(enabled: bool = Query(...), current_user=Depends(get_admin_user)):
+    """
+    Turn the sampling profiler for slow requests on or off.
+    """
+    if enabled:
+        # Runs on the event loop thread, which is the one to sample
+        metrics.profiler.start()
+    else:
+        metrics.profiler.stop()
+    return metrics.profiler.stats()
 
 
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(shelters.router, prefix="/shelter", tags=["shelters"])
 app.include_router(sos.router, prefix="/sos", tags=["sos"])
 app.include_router(food.router, prefix="/food", tags=["food"])
-app.include_router(news.router, prefix="/news", tags=["news"])
\ No newline at end of file
+app.include_router(news.router, prefix="/news", tags=["news"])
+app.include_router(spatial.router, prefix="/spatial-index", tags=["spatial-index"])
+app.include_router(stats.router, prefix="/stats", tags=["stats"])
+app.include_router(tiles.router, prefix="/tiles", tags=["tiles"])
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""Index latitude/longitude on shelters, food and news
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+TABLES = ("shelters", "food", "news")
+
+
+def upgrade():
+    # Tables are created by Base.metadata.create_all, which already adds these
+    # indexes on fresh databases; only existing databases need them here.
+    for table in TABLES:
+        op.create_index(f"ix_{table}_latitude", table, ["latitude"], if_not_exists=True)
+        op.create_index(f"ix_{table}_longitude", table, ["longitude"], if_not_exists=True)
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_index(f"ix_{table}_longitude", table_name=table, if_exists=True)
+        op.drop_index(f"ix_{table}_latitude", table_name=table, if_exists=True)
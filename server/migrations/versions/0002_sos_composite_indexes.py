@@ -0,0 +1,26 @@
+"""Composite indexes for SOS alert queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_sos_resolved_createdAt", "sos", ["resolved", "createdAt"], if_not_exists=True
+    )
+    op.create_index(
+        "ix_sos_latitude_longitude", "sos", ["latitude", "longitude"], if_not_exists=True
+    )
+
+
+def downgrade():
+    op.drop_index("ix_sos_latitude_longitude", table_name="sos", if_exists=True)
+    op.drop_index("ix_sos_resolved_createdAt", table_name="sos", if_exists=True)
@@ -0,0 +1,27 @@
+"""Store derivative image URLs on shelters, food and news
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+TABLES = ("shelters", "food", "news")
+
+
+def upgrade():
+    for table in TABLES:
+        columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns(table)}
+        if "derivatives" not in columns:
+            op.add_column(table, sa.Column("derivatives", sa.JSON(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, "derivatives")
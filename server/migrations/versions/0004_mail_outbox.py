@@ -0,0 +1,40 @@
+"""Persistent outbox for the background mail dispatcher
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table("mail_outbox"):
+        return
+    op.create_table(
+        "mail_outbox",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("recipients", sa.JSON(), nullable=False),
+        sa.Column("subject", sa.String(), nullable=False),
+        sa.Column("body", sa.String(), nullable=False),
+        sa.Column("subtype", sa.String(), nullable=False),
+        sa.Column("status", sa.String(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("lastError", sa.String(), nullable=True),
+        sa.Column("createdAt", sa.DateTime(), nullable=False),
+        sa.Column("nextAttemptAt", sa.DateTime(), nullable=False),
+        sa.Column("sentAt", sa.DateTime(), nullable=True),
+    )
+    op.create_index("ix_mail_outbox_id", "mail_outbox", ["id"])
+    op.create_index(
+        "ix_mail_outbox_status_nextAttemptAt", "mail_outbox", ["status", "nextAttemptAt"]
+    )
+
+
+def downgrade():
+    op.drop_table("mail_outbox")
@@ -0,0 +1,22 @@
+"""Index news by creation time and position for the feed's time window
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_news_createdAt_latitude_longitude", "news", ["createdAt", "latitude", "longitude"], if_not_exists=True
+    )
+
+
+def downgrade():
+    op.drop_index("ix_news_createdAt_latitude_longitude", table_name="news", if_exists=True)
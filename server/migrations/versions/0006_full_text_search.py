@@ -0,0 +1,40 @@
+"""Full-text search indexes on news and shelters
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from Model import search_document
+from app.utils import search
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+COLUMNS = {"news": ("title", "description"), "shelters": ("name", "description")}
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == "sqlite":
+        # FTS5 tables and the triggers that keep them in sync, filled from the existing rows
+        search.create_index(bind)
+        return
+    for table, columns in COLUMNS.items():
+        op.create_index(
+            f"ix_{table}_search", table, [sa.text(search_document(*columns))], postgresql_using="gin", if_not_exists=True
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    for table in COLUMNS:
+        if bind.dialect.name == "sqlite":
+            for trigger in ("insert", "delete", "update"):
+                op.execute(f"DROP TRIGGER IF EXISTS {table}_fts_{trigger}")
+            op.execute(f"DROP TABLE IF EXISTS {table}_fts")
+        else:
+            op.drop_index(f"ix_{table}_search", table_name=table, if_exists=True)
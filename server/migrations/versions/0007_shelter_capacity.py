@@ -0,0 +1,27 @@
+"""Record shelter capacity and occupancy for nearest-shelter routing
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+COLUMNS = ("capacity", "occupancy")
+
+
+def upgrade():
+    columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("shelters")}
+    for name in COLUMNS:
+        if name not in columns:
+            op.add_column("shelters", sa.Column(name, sa.Integer(), nullable=True))
+
+
+def downgrade():
+    for name in COLUMNS:
+        op.drop_column("shelters", name)
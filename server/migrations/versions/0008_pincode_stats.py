@@ -0,0 +1,43 @@
+"""Per-pincode summary table, and the sender's pincode on SOS alerts
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {column["name"] for column in sa.inspect(bind).get_columns("sos")}
+    if "pincode" not in columns:
+        op.add_column("sos", sa.Column("pincode", sa.String(), nullable=True))
+        # Alerts sent so far count under their sender's current pincode
+        op.execute('UPDATE sos SET pincode = (SELECT pincode FROM users WHERE users.id = sos."userId")')
+
+    if not sa.inspect(bind).has_table("pincode_stats"):
+        # Filled by the recount the server runs at startup
+        op.create_table(
+            "pincode_stats",
+            sa.Column("pincode", sa.String(), primary_key=True),
+            sa.Column("shelters", sa.Integer(), nullable=False),
+            sa.Column("food", sa.Integer(), nullable=False),
+            sa.Column("sos_unresolved", sa.Integer(), nullable=False),
+            sa.Column("persons", sa.Integer(), nullable=False),
+            sa.Column("updatedAt", sa.DateTime(), nullable=False),
+        )
+    op.create_index(
+        "ix_pincode_stats_persons_pincode", "pincode_stats", [sa.text("persons DESC"), "pincode"], if_not_exists=True
+    )
+
+
+def downgrade():
+    op.drop_index("ix_pincode_stats_persons_pincode", table_name="pincode_stats", if_exists=True)
+    op.drop_table("pincode_stats")
+    op.drop_column("sos", "pincode")
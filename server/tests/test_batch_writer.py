@@ -0,0 +1,55 @@
+import asyncio
+import os
+from datetime import datetime
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test.db")
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from database import Base
+from Model import SOS
+from app.utils.batch_writer import BatchWriter
+
+
+class SlowWriter(BatchWriter):
+    """Holds every batch open for a while, so stop() lands in the middle of a flush."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = asyncio.Event()
+
+    async def _write(self, db, inserts, updates):
+        self.writing.set()
+        await asyncio.sleep(0.2)
+        return await super()._write(db, inserts, updates)
+
+
+def alert(number):
+    return {"createdAt": datetime.now(), "latitude": 17.0 + number / 1000, "longitude": 78.0, "persons": number}
+
+
+def test_stop_writes_the_batch_in_flight_and_the_queue(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'batch.db'}")
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+        writer = SlowWriter(SOS, flush_ms=0, session_factory=sessions)
+        writer.batching = True
+
+        in_flight = [writer.insert(alert(number)) for number in range(5)]
+        await writer.writing.wait()
+        queued = [writer.insert(alert(number)) for number in range(5, 10)]
+        await writer.stop()
+
+        # Futures of a lost batch never resolve
+        ids = await asyncio.wait_for(asyncio.gather(*in_flight, *queued), 5)
+        async with sessions() as db:
+            count = await db.scalar(select(func.count()).select_from(SOS))
+        await engine.dispose()
+        return ids, count, writer
+
+    ids, count, writer = asyncio.run(scenario())
+    assert len(set(ids)) == 10 and None not in ids
+    assert count == 10
+    assert len(writer) == 0